@@ -0,0 +1,379 @@
+"Static analysis of grammars: nullability, FIRST sets, and how far regexes read."
+
+import functools
+import re
+from collections import namedtuple
+
+from parseltongue import AndMatcher
+from parseltongue import Builder
+from parseltongue import CaptureMatcher
+from parseltongue import ChoiceMatcher
+from parseltongue import CutMatcher
+from parseltongue import EofMatcher
+from parseltongue import ImplicitMatcher
+from parseltongue import MemoMatcher
+from parseltongue import NothingMatcher
+from parseltongue import NotMatcher
+from parseltongue import OptionalMatcher
+from parseltongue import PlusMatcher
+from parseltongue import RegexMatcher
+from parseltongue import RuleMatcher
+from parseltongue import SequenceMatcher
+from parseltongue import StarMatcher
+from parseltongue import StringMatcher
+from parseltongue import TokenMatcher
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# Character classes bigger than this are treated as matching anything.
+MAX_FIRST_SET = 256
+
+EMPTY = frozenset()
+
+# (nullable, first) for matchers we can't see into: they might match
+# anything, including nothing. A first set of None means "any character".
+UNKNOWN = (True, None)
+
+
+def union(a, b):
+    return None if a is None or b is None else a | b
+
+
+def sequence(parts):
+    "Combine (nullable, first) pairs of consecutive elements."
+    first = EMPTY
+    for nullable, f in parts:
+        first = union(first, f)
+        if not nullable:
+            return False, first
+    return True, first
+
+
+@functools.lru_cache(maxsize=None)
+def regex_first(pattern):
+    "(nullable, first) for a regex pattern, falling back to UNKNOWN for constructs we don't model."
+    try:
+        if re.compile(pattern).flags & (re.IGNORECASE | re.LOCALE):
+            return UNKNOWN
+        return RegexAnalysis(int if isinstance(pattern, bytes) else chr).items(sre_parse.parse(pattern))
+    except (re.error, TypeError, ValueError):
+        return UNKNOWN
+
+
+class RegexAnalysis:
+    "Characters are built with char: chr for str patterns, int for bytes ones, matching what indexing the input gives."
+
+    def __init__(self, char):
+        self.char = char
+        self.groups = {}
+
+    def items(self, items):
+        return sequence(self.item(str(op), av) for op, av in items)
+
+    def item(self, op, av):
+        if op == "LITERAL":
+            return False, frozenset([self.char(av)])
+        elif op == "IN":
+            return False, self.charset(av)
+        elif op in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT"):
+            low, _, sub = av
+            nullable, first = self.items(sub)
+            return nullable or low == 0, first
+        elif op == "SUBPATTERN":
+            group, add_flags, _, sub = av
+            if add_flags:
+                return UNKNOWN
+            result = self.items(sub)
+            if group is not None:
+                self.groups[group] = result
+            return result
+        elif op == "ATOMIC_GROUP":
+            return self.items(av)
+        elif op == "BRANCH":
+            results = [self.items(sub) for sub in av[1]]
+            first = EMPTY
+            for _, f in results:
+                first = union(first, f)
+            return any(n for n, _ in results), first
+        elif op in ("ASSERT", "ASSERT_NOT"):
+            # Lookarounds consume nothing but may define groups used later.
+            self.items(av[1])
+            return True, EMPTY
+        elif op == "AT":
+            return True, EMPTY
+        elif op == "GROUPREF":
+            return self.groups.get(av, UNKNOWN)
+        else:
+            return UNKNOWN
+
+    def charset(self, items):
+        chars = set()
+        for op, av in items:
+            op = str(op)
+            if op == "LITERAL":
+                chars.add(self.char(av))
+            elif op == "RANGE" and av[1] - av[0] < MAX_FIRST_SET:
+                chars.update(self.char(c) for c in range(av[0], av[1] + 1))
+            else:
+                return None
+            if len(chars) > MAX_FIRST_SET:
+                return None
+        return frozenset(chars)
+
+
+# What a regex (or part of one) does to the text around it: it consumes
+# lo to hi characters, may or may not fail, reads up to ahead characters
+# past its end when it succeeds, reach past its start when it fails, and
+# behind before its start. kind says how backtracking treats it: "fixed"
+# parts always consume the same amount, "atomic" ones are never
+# backtracked into, "repeat" is a greedy repeat of the single characters
+# in chars, and anything else is "variable". None means unbounded.
+Extent = namedtuple("Extent", "lo hi fails ahead reach behind kind chars")
+
+UNKNOWN_EXTENT = Extent(0, None, True, None, None, None, "variable", None)
+
+
+def add(a, b):
+    return None if a is None or b is None else a + b
+
+
+def most(*values):
+    return None if None in values else max(values)
+
+
+def reads(e):
+    "How far past its start e can read."
+    return most(add(e.hi, e.ahead), e.reach)
+
+
+def disjoint(chars, first):
+    "Whether none of the characters described by chars, a (negated, set) pair, can start something with the given FIRST set."
+    if chars is None or first is None:
+        return False
+    negated, s = chars
+    return first <= s if negated else not (s & first)
+
+
+@functools.lru_cache(maxsize=None)
+def regex_extent(pattern):
+    """
+    (behind, ahead, reach) for a regex pattern: how many characters
+    before the start a match attempt can read, how many past the end of
+    a successful match, and how many past the start of a failed one.
+    Incremental reparsing uses these to tell which results an edit can
+    change. ahead and reach are None when they can't be bounded.
+    """
+    try:
+        flags = re.compile(pattern).flags
+        char = int if isinstance(pattern, bytes) else chr
+        e = RegexExtent(char, flags & re.MULTILINE, flags & re.IGNORECASE).sequence(sre_parse.parse(pattern))
+        return e.behind, e.ahead, e.reach
+    except (re.error, TypeError, ValueError):
+        return None, None, None
+
+
+class RegexExtent:
+    """
+    Computes Extents bottom up. Anything bounded is easy: a regex can't
+    read further than its longest match plus lookahead. Unbounded
+    sequences are only bounded when they can't backtrack: every greedy
+    repeat must stop at a character that what follows can't start with,
+    so the repeat only ever reads one character past its run.
+    """
+
+    def __init__(self, char, multiline, ignorecase):
+        self.char = char
+        self.multiline = multiline
+        self.ignorecase = ignorecase
+
+    def flatten(self, items):
+        "Items with plain groups spliced in, since they match the same."
+        flat = []
+        for op, av in items:
+            op = str(op)
+            if op == "SUBPATTERN" and not av[1] and not av[2]:
+                flat.extend(self.flatten(av[3]))
+            else:
+                flat.append((op, av))
+        return flat
+
+    def sequence(self, items):
+        items = self.flatten(items)
+        parts = []
+        i = 0
+        while i < len(items):
+            op, av = items[i]
+            if op == "ASSERT" and av[0] > 0 and len(av[1]) == 1 and str(av[1][0][0]) == "SUBPATTERN" and items[i + 1 : i + 2] == [("GROUPREF", av[1][0][1][0])]:
+                # (?=(?P<g>...))(?P=g), which LiteralFusion uses to make part of a regex atomic.
+                parts.append((self.sequence(av[1][0][1][3])._replace(kind="atomic"), i))
+                i += 2
+            else:
+                parts.append((self.item(op, av), i))
+                i += 1
+        if len(parts) == 1:
+            return parts[0][0]
+
+        extents = [e for e, _ in parts]
+        lo = sum(e.lo for e in extents)
+        hi = 0
+        offset, read, reach = 0, 0, 0
+        for e in extents:
+            if e.fails:
+                reach = most(reach, read, add(offset, e.reach))
+            read = most(read, add(offset, reads(e)))
+            offset = add(offset, e.hi)
+            hi = add(hi, e.hi)
+        ahead = read - lo if read is not None else self.unbounded_ahead(parts, items)
+        behind = most(0, *(e.behind for e in extents))
+        return Extent(lo, hi, any(e.fails for e in extents), ahead, reach, behind, "fixed" if hi == lo else "variable", None)
+
+    def unbounded_ahead(self, parts, items):
+        ahead = 0
+        for k, (e, _) in enumerate(parts):
+            rest = parts[k + 1 :]
+            if rest and e.kind == "repeat":
+                if not disjoint(e.chars, RegexAnalysis(self.char).items(items[rest[0][1] :])[1]):
+                    return None
+            elif rest and e.kind == "variable":
+                return None
+            if e.ahead is None:
+                return None
+            ahead = max(ahead, e.ahead - sum(r.lo for r, _ in rest))
+        return ahead
+
+    def item(self, op, av):
+        if op in ("LITERAL", "NOT_LITERAL", "IN", "ANY", "CATEGORY"):
+            return Extent(1, 1, True, 0, 1, 0, "fixed", self.chars(op, av))
+        elif op in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT"):
+            return self.repeat(op, *av)
+        elif op == "SUBPATTERN":
+            _, add_flags, _, sub = av
+            saved = self.multiline, self.ignorecase
+            self.multiline = self.multiline or add_flags & re.MULTILINE
+            self.ignorecase = self.ignorecase or add_flags & re.IGNORECASE
+            e = self.sequence(sub)
+            self.multiline, self.ignorecase = saved
+            return e
+        elif op == "ATOMIC_GROUP":
+            return self.sequence(av)._replace(kind="atomic")
+        elif op == "BRANCH":
+            alternatives = [self.sequence(sub) for sub in av[1]]
+            lo = min(e.lo for e in alternatives)
+            hi = most(*(e.hi for e in alternatives))
+            # An alternative that succeeds may come after others that failed, having read reach past the start.
+            ahead = most(*(e.ahead for e in alternatives), *(add(e.reach, -lo) for e in alternatives))
+            reach = most(*(e.reach for e in alternatives))
+            behind = most(*(e.behind for e in alternatives))
+            return Extent(lo, hi, all(e.fails for e in alternatives), ahead, reach, behind, "fixed" if hi == lo else "variable", None)
+        elif op in ("ASSERT", "ASSERT_NOT"):
+            direction, sub = av
+            e = self.sequence(sub)
+            if direction > 0:
+                return Extent(0, 0, True, reads(e), reads(e), e.behind, "fixed", None)
+            else:
+                return Extent(0, 0, True, 0, 0, add(e.hi, e.behind), "fixed", None)
+        elif op == "AT":
+            at = str(av)
+            behind = 1 if at in ("AT_BOUNDARY", "AT_NON_BOUNDARY") or (at == "AT_BEGINNING" and self.multiline) else 0
+            # $ looks at up to two characters, for a newline right before the end.
+            ahead = {"AT_END": 2, "AT_END_STRING": 1, "AT_BOUNDARY": 1, "AT_NON_BOUNDARY": 1}.get(at, 0)
+            return Extent(0, 0, True, ahead, ahead, behind, "fixed", None)
+        elif op == "GROUPREF":
+            return UNKNOWN_EXTENT._replace(behind=0)
+        else:
+            return UNKNOWN_EXTENT
+
+    def repeat(self, op, low, high, sub):
+        high = None if high == sre_parse.MAXREPEAT else high
+        inner = self.sequence(sub)
+        single = inner.lo == inner.hi == 1 and inner.ahead == 0 and inner.reach == 1 and inner.behind == 0
+        if single and op == "MIN_REPEAT" and low != high:
+            # Lazy: stops after low characters unless what follows needs more.
+            return Extent(low, high, low > 0, 0, low, 0, "variable", None)
+        elif single:
+            kind = "fixed" if low == high else "atomic" if op == "POSSESSIVE_REPEAT" else "repeat"
+            return Extent(low, high, low > 0, 0 if low == high else 1, low, 0, kind, inner.chars)
+
+        lo = low * inner.lo
+        hi = None if high is None or inner.hi is None else high * inner.hi
+        reach = add((low - 1) * inner.hi, reads(inner)) if low > 0 and inner.hi is not None else (0 if low == 0 else None)
+        if hi is None:
+            return Extent(lo, None, low > 0 and inner.fails, None, reach, inner.behind, "atomic" if op == "POSSESSIVE_REPEAT" else "variable", None)
+        read = add((high - 1) * inner.hi, reads(inner)) if high > 0 else 0
+        ahead = None if read is None else read - lo
+        kind = "fixed" if lo == hi else "atomic" if op == "POSSESSIVE_REPEAT" else "variable"
+        return Extent(lo, hi, low > 0 and inner.fails, ahead, reach, inner.behind, kind, None)
+
+    def chars(self, op, av):
+        "The characters a single character item matches as a (negated, set) pair, or None if unknown."
+        if self.ignorecase or op == "CATEGORY":
+            return None
+        elif op == "LITERAL":
+            return False, frozenset([self.char(av)])
+        elif op == "NOT_LITERAL":
+            return True, frozenset([self.char(av)])
+        elif op == "ANY":
+            return True, EMPTY
+        negated = bool(av) and str(av[0][0]) == "NEGATE"
+        chars = RegexAnalysis(self.char).charset(av[1:] if negated else av)
+        if chars is None:
+            return (True, EMPTY) if negated else None
+        return negated, chars
+
+
+class Analysis:
+    """
+    Nullability and FIRST sets for every matcher in a grammar. A matcher
+    can only succeed at a position if it is nullable or the next
+    character is in its FIRST set. Rules are solved together by
+    iterating to a fixed point.
+    """
+
+    def __init__(self, grammar):
+        self.rules = getattr(grammar, "rules", grammar)
+        self.solved = {name: (False, EMPTY) for name in self.rules}
+        changed = True
+        while changed:
+            changed = False
+            for name, m in self.rules.items():
+                result = self.compute(m)
+                if result != self.solved[name]:
+                    self.solved[name] = result
+                    changed = True
+
+    def nullable(self, m):
+        return self.compute(m)[0]
+
+    def first(self, m):
+        return self.compute(m)[1]
+
+    def compute(self, m):
+        if isinstance(m, StringMatcher):
+            return (False, frozenset(m.expr[:1])) if m.expr else (True, EMPTY)
+        elif isinstance(m, RegexMatcher):
+            return regex_first(m.expr)
+        elif isinstance(m, RuleMatcher):
+            return self.solved.get(m.expr, UNKNOWN)
+        elif isinstance(m, SequenceMatcher):
+            return sequence(self.compute(e) for e in m.expr)
+        elif isinstance(m, ChoiceMatcher):
+            results = [self.compute(c) for c in m.expr]
+            first = EMPTY
+            for _, f in results:
+                first = union(first, f)
+            return any(n for n, _ in results), first
+        elif isinstance(m, (StarMatcher, OptionalMatcher)):
+            return True, self.first(m.expr)
+        elif isinstance(m, (PlusMatcher, NothingMatcher, CaptureMatcher, MemoMatcher)):
+            return self.compute(m.expr)
+        elif isinstance(m, Builder):
+            return self.compute(m.preceeding)
+        elif isinstance(m, TokenMatcher):
+            return self.compute(m.m)
+        elif isinstance(m, (AndMatcher, NotMatcher, ImplicitMatcher, EofMatcher, CutMatcher)):
+            return True, EMPTY
+        else:
+            return UNKNOWN
@@ -0,0 +1,131 @@
+"Parse many independent inputs in a pool of worker processes."
+
+import importlib
+import itertools
+import os
+import pickle
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+
+from parseltongue import BytesInput
+from parseltongue import TextInput
+from parseltongue import parse
+from peg import grammar as load_grammar
+
+
+class GrammarSource:
+    """
+    Where to rebuild a grammar from in each worker, for grammars whose
+    bindings can't be pickled (closures, lambdas). bindings names the
+    dict of rule functions as module:attribute, like codegen's command
+    line; the module must be importable in the workers. cache is passed
+    on to peg.grammar.
+    """
+
+    def __init__(self, file, bindings=None, optimize=True, binary=False, cache=None):
+        self.file = file
+        self.bindings = bindings
+        self.optimize = optimize
+        self.binary = binary
+        self.cache = cache
+
+    def load(self):
+        g = load_grammar(self.file, self.optimize, self.binary, self.cache)
+        return g if self.bindings is None else g.bindings(resolve(self.bindings))
+
+
+def resolve(name):
+    "The object named by a module:attribute string."
+    module, attribute = name.split(":")
+    found = importlib.import_module(module)
+    for part in attribute.split("."):
+        found = getattr(found, part)
+    return found
+
+
+def load(grammar):
+    "The grammar a parse_many grammar argument stands for."
+    if isinstance(grammar, GrammarSource):
+        return grammar.load()
+    elif isinstance(grammar, str):
+        return resolve(grammar)
+    else:
+        return grammar
+
+
+def parse_one(grammar, rule, text):
+    "Parse str or bytes, returning (ok, end position, result) since the next input isn't worth sending back."
+    ok, next, r = parse(grammar, rule, BytesInput(text) if isinstance(text, (bytes, bytearray, memoryview)) else TextInput(text))
+    return ok, next.position(), r
+
+
+# The grammar of a worker process, loaded once when it starts.
+worker_grammar = None
+
+
+def start_worker(grammar):
+    global worker_grammar
+    worker_grammar = load(grammar)
+
+
+def parse_chunk(rule, texts):
+    return [parse_one(worker_grammar, rule, text) for text in texts]
+
+
+def parse_many(grammar, rule, inputs, workers=None, chunk_size=64, ordered=True):
+    """
+    Parse each of inputs (str, or bytes for binary grammars) with rule,
+    yielding (ok, end position, result) in the order of inputs, or
+    (index, (ok, end position, result)) as chunks complete if not
+    ordered. grammar is a picklable grammar, a GrammarSource or a
+    module:attribute string naming a grammar, and is loaded once per
+    worker. Inputs are read chunk_size at a time, with two chunks per
+    worker in flight, so they may be a generator over a large corpus.
+    workers=0 parses in this process.
+    """
+    if not isinstance(grammar, (GrammarSource, str)):
+        try:
+            pickle.dumps(grammar)
+        except (pickle.PicklingError, AttributeError, TypeError) as e:
+            raise ValueError("Grammar can't be sent to worker processes ({}); pass a GrammarSource or module:attribute instead".format(e)) from None
+    return run(grammar, rule, inputs, workers, chunk_size, ordered)
+
+
+def run(grammar, rule, inputs, workers, chunk_size, ordered):
+    it = iter(inputs)
+    chunks = iter(lambda: list(itertools.islice(it, chunk_size)), [])
+    if workers == 0:
+        g = load(grammar)
+        parsed = (parse_one(g, rule, text) for chunk in chunks for text in chunk)
+        yield from parsed if ordered else enumerate(parsed)
+        return
+
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(workers, initializer=start_worker, initargs=(grammar,)) as pool:
+        pending = deque()
+        try:
+            start = 0
+            for chunk in chunks:
+                pending.append((start, pool.submit(parse_chunk, rule, chunk)))
+                start += len(chunk)
+                if len(pending) >= 2 * workers:
+                    yield from finished(pending, ordered)
+            while pending:
+                yield from finished(pending, ordered)
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+def finished(pending, ordered):
+    "Results of the oldest chunk, or with their indices of whichever chunks are done first."
+    if ordered:
+        return pending.popleft()[1].result()
+    done, _ = wait([future for _, future in pending], return_when=FIRST_COMPLETED)
+    results = []
+    for start, future in [p for p in pending if p[1] in done]:
+        pending.remove((start, future))
+        results.extend(enumerate(future.result(), start))
+    return results
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+"""
+Parse throughput, latency and peak memory of the bundled grammars over
+generated inputs of increasing size and nesting depth. Results are
+written as JSON and can be compared against a stored baseline:
+
+    bench/bench.py --output results.json --baseline bench/baseline.json
+
+exits with status 1 if any case got slower or bigger than the tolerance
+allows, or started failing.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+from parseltongue import TextInput
+from parseltongue import parse
+from peg import g as bootstrap
+from peg import grammar
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def example(name):
+    "Load examples/name.py without putting examples/ on the path, where math.py would shadow the math module."
+    spec = importlib.util.spec_from_file_location("example_" + name, os.path.join(ROOT, "examples", name + ".py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+#
+# Input generators: (size) -> text and (depth) -> text.
+#
+
+
+def query_document(size):
+    definitions = [
+        'query Q{0}($id: ID) {{ hero(id: $id, n: {0}, f: 1.5e3, list: [1, 2, "s"]) @include(if: true) {{ name friends {{ name ...F{0} }} }} }}',
+        "fragment F{0} on Human {{ name homePlanet ... on Droid {{ primaryFunction }} }}",
+        '{{ search(text: "{0}", first: {0}) {{ __typename ... on Starship {{ name length }} }} }}',
+    ]
+    return "\n".join(definitions[i % 3].format(i) for i in range(size))
+
+
+def query_nested(depth):
+    return "{" + " a {" * depth + " b" + " }" * depth + " }"
+
+
+def math_sum(size):
+    return " + ".join("{} * {}".format(i, i + 1) for i in range(size))
+
+
+def math_nested(depth):
+    return "(" * depth + "1 + 2" + ")" * depth
+
+
+def grammar_source(size):
+    rules = ["start := rule0+"]
+    for i in range(size):
+        rules.append("rule{} := 'kw{}' /[a-z]+/ rule{}? ('x' | 'y' | `tok`)* !'z' ~','".format(i, i, i + 1))
+    rules.append("rule{} := 'end'".format(size))
+    return "\n".join(rules) + "\n"
+
+
+def grammar_nested(depth):
+    return "start := " + "(" * depth + "'a' | 'b'" + ")" * depth + "\n"
+
+
+def inputs(sized, sizes, nested, depths):
+    texts = {"size-{}".format(n): sized(n) for n in sizes}
+    texts.update({"depth-{}".format(n): nested(n) for n in depths})
+    return texts
+
+
+def cases():
+    """
+    (name, grammar, rule, {input name: text}). Sizes and depths stop
+    short of the recursion limit, and of exponential time in the case of
+    the bootstrap grammar's parentheses, which has no memo.
+    """
+    math_py = example("math").p
+    query_g = grammar(os.path.join(ROOT, "grammars", "query.g"))
+    math_g = grammar(os.path.join(ROOT, "grammars", "math.g"))
+    return [
+        ("query.g", query_g, "Document", inputs(query_document, [1, 10, 100, 1000], query_nested, [1, 4, 16, 48])),
+        ("math.g", math_g, "expression", inputs(math_sum, [1, 10, 100], math_nested, [1, 4, 16, 48])),
+        ("math.py", math_py, "expression", inputs(math_sum, [1, 10, 100], math_nested, [1, 4, 16, 48])),
+        ("bootstrap", bootstrap, "grammar", inputs(grammar_source, [1, 10, 100, 1000], grammar_nested, [1, 2, 3])),
+    ]
+
+
+#
+# Measurement
+#
+
+
+def measure(g, rule, text, min_time, min_runs):
+    "Time parses of text until min_time has passed and min_runs were made, then measure peak memory with one traced parse."
+    times = []
+    started = time.perf_counter()
+    try:
+        while len(times) < min_runs or time.perf_counter() - started < min_time:
+            t = time.perf_counter()
+            ok, next, _ = parse(g, rule, TextInput(text))
+            times.append(time.perf_counter() - t)
+        tracemalloc.start()
+        parse(g, rule, TextInput(text))
+        _, peak = tracemalloc.get_traced_memory()
+    except RecursionError:
+        return {"chars": len(text), "error": "RecursionError"}
+    finally:
+        tracemalloc.stop()
+
+    times.sort()
+    return {
+        "chars": len(text),
+        "ok": ok and next.position() == len(text),
+        "runs": len(times),
+        "chars_per_sec": len(text) / statistics.median(times),
+        "p50_ms": percentile(times, 50) * 1e3,
+        "p90_ms": percentile(times, 90) * 1e3,
+        "p99_ms": percentile(times, 99) * 1e3,
+        "peak_kb": peak / 1024,
+    }
+
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def run(min_time, min_runs, only=None):
+    results = {}
+    for name, g, rule, texts in cases():
+        if only is not None and name not in only:
+            continue
+        for label, text in texts.items():
+            key = "{}/{}".format(name, label)
+            results[key] = r = measure(g, rule, text, min_time, min_runs)
+            if "error" in r:
+                print("{:<24} {:>9} chars  {}".format(key, r["chars"], r["error"]), file=sys.stderr)
+            else:
+                print(
+                    "{:<24} {:>9} chars {:>12.0f} chars/s  p50 {:>9.3f} ms  p99 {:>9.3f} ms  peak {:>9.1f} KB".format(
+                        key, r["chars"], r["chars_per_sec"], r["p50_ms"], r["p99_ms"], r["peak_kb"]
+                    ),
+                    file=sys.stderr,
+                )
+    return {"python": platform.python_version(), "machine": platform.machine(), "results": results}
+
+
+def compare(baseline, current, tolerance):
+    "Lines describing regressions of current against baseline."
+    regressions = []
+    for key, old in baseline["results"].items():
+        new = current["results"].get(key)
+        if new is None:
+            continue
+        if "error" in new and "error" not in old:
+            regressions.append("{}: now fails with {}".format(key, new["error"]))
+        elif "error" in new or "error" in old:
+            continue
+        elif old["ok"] and not new["ok"]:
+            regressions.append("{}: no longer parses".format(key))
+        elif new["chars_per_sec"] < old["chars_per_sec"] * (1 - tolerance):
+            regressions.append("{}: {:.0f} chars/s, baseline {:.0f}".format(key, new["chars_per_sec"], old["chars_per_sec"]))
+        elif new["peak_kb"] > old["peak_kb"] * (1 + tolerance):
+            regressions.append("{}: peak {:.1f} KB, baseline {:.1f}".format(key, new["peak_kb"], old["peak_kb"]))
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare against results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slowdown or memory growth (default 0.25)")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds to spend timing each input (default 0.2)")
+    parser.add_argument("--min-runs", type=int, default=5, help="parses to time at least (default 5)")
+    parser.add_argument("--only", nargs="*", help="grammars to run: query.g math.g math.py bootstrap")
+    args = parser.parse_args()
+
+    current = run(args.min_time, args.min_runs, args.only)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+            f.write("\n")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), current, args.tolerance)
+        for line in regressions:
+            print("REGRESSION {}".format(line))
+        print("{} regressions against {}".format(len(regressions), args.baseline))
+        sys.exit(1 if regressions else 0)
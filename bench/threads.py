@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+"""
+Parse throughput of one grammar shared by a pool of threads, for each
+thread count up to --threads. On a free-threaded build of CPython
+(python3.13t and later, run with the GIL off) throughput should grow
+with the number of threads; with the GIL it stays about flat, and the
+difference from one thread is what the pool costs:
+
+    bench/threads.py --threads 8 --output threads.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import sysconfig
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bench import ROOT
+from bench import math_sum
+from bench import query_document
+from parseltongue import TextInput
+from parseltongue import parse
+from peg import grammar
+
+
+def cases():
+    "(name, grammar, rule, text) of each grammar to parse from threads."
+    return [
+        ("query.g", grammar(os.path.join(ROOT, "grammars", "query.g")), "Document", query_document(20)),
+        ("math.g", grammar(os.path.join(ROOT, "grammars", "math.g")), "expression", math_sum(50)),
+    ]
+
+
+def throughput(g, rule, text, threads, parses):
+    "Characters per second parsed by threads threads doing parses parses each, and whether every parse matched all of text."
+
+    def work(_):
+        done = True
+        for _ in range(parses):
+            ok, next, _ = parse(g, rule, TextInput(text))
+            done = done and ok and next.position() == len(text)
+        return done
+
+    with ThreadPoolExecutor(threads) as pool:
+        # Start the threads before timing.
+        list(pool.map(lambda _: None, range(threads)))
+        started = time.perf_counter()
+        ok = all(pool.map(work, range(threads)))
+        elapsed = time.perf_counter() - started
+    return len(text) * parses * threads / elapsed, ok
+
+
+def gil_enabled():
+    is_enabled = getattr(sys, "_is_gil_enabled", None)
+    return True if is_enabled is None else is_enabled()
+
+
+def run(max_threads, parses):
+    counts = [1]
+    while counts[-1] * 2 <= max_threads:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != max_threads:
+        counts.append(max_threads)
+
+    results = {}
+    for name, g, rule, text in cases():
+        single = None
+        for n in counts:
+            key = "{}/threads-{}".format(name, n)
+            rate, ok = throughput(g, rule, text, n, parses)
+            single = single or rate
+            results[key] = {"threads": n, "ok": ok, "chars_per_sec": rate, "speedup": rate / single}
+            print("{:<20} {:>12.0f} chars/s  {:>5.2f}x{}".format(key, rate, rate / single, "" if ok else "  FAILED"), file=sys.stderr)
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "free_threaded": bool(sysconfig.get_config_var("Py_GIL_DISABLED")),
+        "gil": gil_enabled(),
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--threads", type=int, default=os.cpu_count(), help="most threads to run (default: the number of CPUs)")
+    parser.add_argument("--parses", type=int, default=20, help="parses per thread (default 20)")
+    args = parser.parse_args()
+
+    current = run(args.threads, args.parses)
+    print("Python {}, {} CPUs, GIL {}".format(current["python"], current["cpus"], "enabled" if current["gil"] else "disabled"), file=sys.stderr)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+            f.write("\n")
+    if not all(r["ok"] for r in current["results"].values()):
+        sys.exit(1)
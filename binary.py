@@ -0,0 +1,216 @@
+"Rewrite text grammars to match UTF-8 encoded bytes, for BytesInput and MmapInput."
+
+import re
+
+from parseltongue import ImplicitMatcher
+from parseltongue import RegexMatcher
+from parseltongue import StringMatcher
+from parseltongue import Visitor
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+MAX_CODE_POINT = 0x10FFFF
+
+# Code point ranges encoded with 1, 2, 3 and 4 bytes.
+LENGTHS = [(0, 0x7F), (0x80, 0x7FF), (0x800, 0xFFFF), (0x10000, MAX_CODE_POINT)]
+
+# The bytes regex meaning of the character categories, which is ASCII only.
+CATEGORIES = {
+    "CATEGORY_DIGIT": [(0x30, 0x39)],
+    "CATEGORY_SPACE": [(0x09, 0x0D), (0x20, 0x20)],
+    "CATEGORY_WORD": [(0x30, 0x39), (0x41, 0x5A), (0x5F, 0x5F), (0x61, 0x7A)],
+}
+
+ESCAPES = {
+    "CATEGORY_DIGIT": r"\d",
+    "CATEGORY_NOT_DIGIT": r"\D",
+    "CATEGORY_SPACE": r"\s",
+    "CATEGORY_NOT_SPACE": r"\S",
+    "CATEGORY_WORD": r"\w",
+    "CATEGORY_NOT_WORD": r"\W",
+    "AT_BEGINNING": "^",
+    "AT_BEGINNING_STRING": r"\A",
+    "AT_END": "$",
+    "AT_END_STRING": r"\Z",
+    "AT_BOUNDARY": r"\b",
+    "AT_NON_BOUNDARY": r"\B",
+}
+
+FLAGS = [(re.IGNORECASE, "i"), (re.MULTILINE, "m"), (re.DOTALL, "s")]
+
+
+def encode(c):
+    return chr(c).encode("utf-8", "surrogatepass")
+
+
+def byte(b):
+    return "\\x{:02x}".format(b)
+
+
+def normalize(ranges):
+    "Sorted, merged list of (lo, hi) code point ranges."
+    merged = []
+    for lo, hi in sorted(ranges):
+        if merged and lo <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(hi, merged[-1][1]))
+        else:
+            merged.append((lo, hi))
+    return merged
+
+
+def complement(ranges):
+    result = []
+    next = 0
+    for lo, hi in normalize(ranges):
+        if lo > next:
+            result.append((next, lo - 1))
+        next = hi + 1
+    if next <= MAX_CODE_POINT:
+        result.append((next, MAX_CODE_POINT))
+    return result
+
+
+def utf8_sequences(lo, hi):
+    """
+    Split the code points lo to hi into runs whose UTF-8 encodings are
+    matched by a sequence of byte ranges, one range per byte.
+    """
+    for a, b in LENGTHS:
+        if lo <= b and hi >= a:
+            yield from split(max(lo, a), min(hi, b))
+
+
+def split(lo, hi):
+    n = len(encode(lo))
+    for i in range(1, n):
+        m = (1 << (6 * i)) - 1
+        if lo & ~m != hi & ~m:
+            if lo & m != 0:
+                yield from split(lo, lo | m)
+                yield from split((lo | m) + 1, hi)
+                return
+            if hi & m != m:
+                yield from split(lo, (hi & ~m) - 1)
+                yield from split(hi & ~m, hi)
+                return
+    yield list(zip(encode(lo), encode(hi)))
+
+
+class Translator:
+    "Turn a parsed str regex into the source of a bytes regex matching the UTF-8 encoding of the same strings."
+
+    def __init__(self, names, dotall):
+        self.names = names
+        self.dotall = dotall
+
+    def items(self, items):
+        return "".join(self.item(str(op), av) for op, av in items)
+
+    def group(self, items):
+        return "(?:{})".format(self.items(items))
+
+    def item(self, op, av):
+        if op == "LITERAL":
+            return re.escape(chr(av)) if chr(av).isascii() and chr(av).isprintable() else "".join(byte(b) for b in encode(av))
+        elif op == "NOT_LITERAL":
+            return self.ranges(complement([(av, av)]))
+        elif op == "ANY":
+            return self.ranges([(0, MAX_CODE_POINT)] if self.dotall else complement([(0x0A, 0x0A)]))
+        elif op == "IN":
+            return self.charset(av)
+        elif op in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT"):
+            low, high, sub = av
+            count = "{{{},{}}}".format(low, "" if high == sre_parse.MAXREPEAT else high)
+            suffix = {"MAX_REPEAT": "", "MIN_REPEAT": "?", "POSSESSIVE_REPEAT": "+"}[op]
+            return self.group(sub) + count + suffix
+        elif op == "SUBPATTERN":
+            group, add_flags, del_flags, sub = av
+            dotall = self.dotall
+            self.dotall = (dotall or add_flags & re.DOTALL) and not del_flags & re.DOTALL
+            if group is None:
+                on = "".join(f for bit, f in FLAGS if add_flags & bit)
+                off = "".join(f for bit, f in FLAGS if del_flags & bit)
+                result = "(?{}{}:{})".format(on, "-" + off if off else "", self.items(sub))
+            elif group in self.names:
+                result = "(?P<{}>{})".format(self.names[group], self.items(sub))
+            else:
+                result = "({})".format(self.items(sub))
+            self.dotall = dotall
+            return result
+        elif op == "ATOMIC_GROUP":
+            return "(?>{})".format(self.items(av))
+        elif op == "BRANCH":
+            return "(?:{})".format("|".join(self.items(sub) for sub in av[1]))
+        elif op in ("ASSERT", "ASSERT_NOT"):
+            direction, sub = av
+            kind = ("=" if op == "ASSERT" else "!") if direction > 0 else ("<=" if op == "ASSERT" else "<!")
+            return "(?{}{})".format(kind, self.items(sub))
+        elif op == "GROUPREF":
+            return "(?:\\{})".format(av)
+        elif op == "GROUPREF_EXISTS":
+            group, yes, no = av
+            return "(?({}){}{})".format(group, self.items(yes), "|" + self.items(no) if no else "")
+        elif op in ("AT", "CATEGORY"):
+            return ESCAPES[str(av)]
+        else:
+            raise ValueError("Can't translate {} to a bytes regex".format(op))
+
+    def charset(self, items):
+        negate = False
+        ranges = []
+        for op, av in items:
+            op = str(op)
+            if op == "NEGATE":
+                negate = True
+            elif op == "LITERAL":
+                ranges.append((av, av))
+            elif op == "RANGE":
+                ranges.append(av)
+            elif op == "CATEGORY":
+                name = str(av)
+                positive = name.replace("NOT_", "")
+                ranges.extend(CATEGORIES[positive] if name == positive else complement(CATEGORIES[positive]))
+            else:
+                raise ValueError("Can't translate {} in a character class to a bytes regex".format(op))
+        return self.ranges(complement(ranges) if negate else normalize(ranges))
+
+    def ranges(self, ranges):
+        "A regex matching one code point in ranges: a byte class for the ASCII ones, byte sequences for the rest."
+        ascii = [(lo, min(hi, 0x7F)) for lo, hi in ranges if lo < 0x80]
+        alternatives = ["[{}]".format("".join(byte(lo) if lo == hi else "{}-{}".format(byte(lo), byte(hi)) for lo, hi in ascii))] if ascii else []
+        for lo, hi in ranges:
+            if hi >= 0x80:
+                alternatives.extend("".join(self.span(a, b) for a, b in s) for s in utf8_sequences(max(lo, 0x80), hi))
+        if not alternatives:
+            return "(?!)"
+        return alternatives[0] if len(alternatives) == 1 else "(?:{})".format("|".join(alternatives))
+
+    def span(self, lo, hi):
+        return byte(lo) if lo == hi else "[{}-{}]".format(byte(lo), byte(hi))
+
+
+def utf8_pattern(pattern):
+    "A bytes regex matching exactly the UTF-8 encodings of the strings pattern matches, except that \\d, \\s and \\w only match ASCII."
+    parsed = sre_parse.parse(pattern)
+    state = getattr(parsed, "state", None) or parsed.pattern
+    names = {group: name for name, group in state.groupdict.items()}
+    flags = "".join(f for bit, f in FLAGS if state.flags & bit)
+    source = Translator(names, bool(state.flags & re.DOTALL)).items(parsed)
+    return ("(?{}){}".format(flags, source) if flags else source).encode("ascii")
+
+
+class BytesRewriter(Visitor):
+    "Rewrite literals, regexes and implicit values into bytes, so the grammar matches UTF-8 encoded BytesInput."
+
+    def visit_string_matcher(self, m):
+        return StringMatcher(m.expr.encode("utf-8"))
+
+    def visit_regex_matcher(self, m):
+        return RegexMatcher(utf8_pattern(m.expr))
+
+    def visit_implicit_matcher(self, m):
+        # Implicit values stand in for text that wasn't there, like implicit(0) in query.g.
+        return ImplicitMatcher(m.value.encode("utf-8")) if isinstance(m.value, str) else m
@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+
+"Compile a grammar into a standalone Python module with one function per rule."
+
+import importlib
+import re
+import sys
+
+from parseltongue import AndMatcher
+from parseltongue import Builder
+from parseltongue import CaptureMatcher
+from parseltongue import CharMatcher
+from parseltongue import ChoiceMatcher
+from parseltongue import Compose
+from parseltongue import Constant
+from parseltongue import CutMatcher
+from parseltongue import Defer
+from parseltongue import Deferred
+from parseltongue import DispatchChoiceMatcher
+from parseltongue import EofMatcher
+from parseltongue import ImplicitMatcher
+from parseltongue import Index
+from parseltongue import Join
+from parseltongue import MemoMatcher
+from parseltongue import Nothing
+from parseltongue import NothingMatcher
+from parseltongue import NotMatcher
+from parseltongue import OptionalMatcher
+from parseltongue import PlusMatcher
+from parseltongue import RegexMatcher
+from parseltongue import RegexSequenceMatcher
+from parseltongue import RuleMatcher
+from parseltongue import SequenceMatcher
+from parseltongue import StarMatcher
+from parseltongue import StringMatcher
+from parseltongue import TokenMatcher
+from parseltongue import expectations
+
+# Python refuses more than 20 statically nested loops in one function, so
+# deeper expressions are moved out into helper functions.
+MAX_LOOP_DEPTH = 8
+
+HEADER = """#
+# Generated by codegen.py from a parseltongue grammar. Do not edit.
+#
+
+import re
+import sys
+"""
+
+IMPORTS = """
+from parseltongue import Action
+from parseltongue import Context
+from parseltongue import FAIL
+from parseltongue import Join
+from parseltongue import Nothing
+from parseltongue import ParseError
+from parseltongue import cut_error
+from parseltongue import force
+from parseltongue import text as _text
+"""
+
+FOOTER = """
+
+def _missing(name):
+    raise KeyError(name)
+
+
+def _forget(ctx, pos):
+    for key in [key for key in ctx.memo if key[1] < pos]:
+        del ctx.memo[key]
+
+
+def parse(init, input):
+    ctx = Context(grammar, input.text)
+    end, r = rules[init](ctx, input.pos)
+    return input.ok(input.next(end), force(r) if deferred else r) if end >= 0 else (False, input, ctx.error(init, input.pos))
+"""
+
+
+def rules_of(grammar):
+    return getattr(grammar, "rules", grammar)
+
+
+def reference(obj):
+    "Find an import path for obj, returning (module, attribute path) or None."
+    module = getattr(obj, "__module__", None) or getattr(getattr(obj, "__objclass__", None), "__module__", None)
+    qualname = getattr(obj, "__qualname__", None)
+    if module is None or qualname is None or "<" in qualname or module == "__main__":
+        return None
+    try:
+        found = importlib.import_module(module)
+        for part in qualname.split("."):
+            found = getattr(found, part)
+    except (ImportError, AttributeError):
+        return None
+    return (module, qualname) if found is obj else None
+
+
+def literal_value(value):
+    return value is None or type(value) in (bool, int, float, str, bytes)
+
+
+class Generator:
+    def __init__(self, grammar, bindings=None, inject=False):
+        self.rules = rules_of(grammar)
+        self.deferred = type(self.rules) is Deferred
+        self.inject = inject
+        self.names = {name: self.function_name(i, name) for i, name in enumerate(self.rules)}
+        self.counter = 0
+        self.constants = []
+        self.imports = set()
+        self.known = {}
+        self.helpers = []
+        if bindings is not None:
+            module, attribute = bindings.split(":")
+            self.imports.add(module)
+            for rule, fn in getattr(importlib.import_module(module), attribute).items():
+                self.known[id(fn)] = "{}.{}[{!r}]".format(module, attribute, rule)
+
+    def function_name(self, i, name):
+        return "rule_{}".format(name) if name.isidentifier() else "rule_{}".format(i)
+
+    def fresh(self, prefix):
+        self.counter += 1
+        return "{}{}".format(prefix, self.counter)
+
+    def constant(self, obj, prefix="_c"):
+        "Return an expression naming obj in the generated module."
+        if obj is Nothing:
+            return "Nothing"
+        if literal_value(obj):
+            return repr(obj)
+        if id(obj) in self.known:
+            return self.known[id(obj)]
+        name = self.fresh(prefix)
+        if self.inject:
+            self.constants.append((name, obj, None))
+        elif isinstance(obj, (re.Pattern, frozenset)):
+            self.constants.append((name, obj, "re.compile({!r})".format(obj.pattern) if isinstance(obj, re.Pattern) else "frozenset({!r})".format(sorted(obj))))
+        elif type(obj) is Join:
+            self.constants.append((name, obj, "Join({})".format("" if obj.fn is None else self.constant(obj.fn, "_f"))))
+        elif (ref := reference(obj)) is not None:
+            module, qualname = ref
+            self.imports.add(module)
+            self.constants.append((name, obj, "{}.{}".format(module, qualname)))
+        else:
+            raise ValueError("Can't reference {!r} from generated code; use a module-level function or load() instead".format(obj))
+        return name
+
+    def source(self):
+        functions = [self.rule_function(name) for name in self.rules]
+        out = [HEADER]
+        out.extend("import {}\n".format(m) for m in sorted(self.imports))
+        out.append(IMPORTS)
+        out.append("\ngrammar = None\ndeferred = {}\n".format(self.deferred))
+        if self.constants:
+            out.extend("{} = {}\n".format(name, expr) for name, _, expr in self.constants if expr is not None)
+        for f in self.helpers + functions:
+            out.append("\n\n")
+            out.append("\n".join(f))
+            out.append("\n")
+        out.append("\n\nrules = {\n")
+        out.extend("    {!r}: {},\n".format(name, self.names[name]) for name in self.rules)
+        out.append("}\n")
+        out.append(FOOTER)
+        return "".join(out)
+
+    def rule_function(self, name):
+        # Like RuleMatcher.match_at, note the rule around the farthest failure and cut errors on the way out.
+        body = ["farthest = ctx.farthest", "try:"]
+        body.extend("    " + line for line in self.expr(self.rules[name], "pos", "end", "r", 0))
+        body.append("except ParseError as e:")
+        body.append("    e.rules.insert(0, {!r})".format(name))
+        body.append("    raise")
+        body.append("if ctx.farthest > farthest:")
+        body.append("    ctx.rules.append({!r})".format(name))
+        return self.function(self.names[name], body)
+
+    def function(self, fname, body):
+        lines = ["def {}(ctx, pos):".format(fname), "    text = ctx.text", "    n = len(text)"]
+        lines.extend("    " + line for line in body)
+        lines.append("    return (end, r) if end >= 0 else FAIL")
+        return lines
+
+    def fail(self, pos, m):
+        "Lines noting that m failed at pos, like Context.fail in the matchers' match_at."
+        return ["if {} >= ctx.farthest:".format(pos), "    ctx.fail({}, {!r})".format(pos, tuple(expectations(m)))]
+
+    def quiet(self, lines):
+        "lines with nothing that fails in them noted, like whitespace and lookaheads in match_at."
+        f = self.fresh("f")
+        return ["{} = ctx.farthest".format(f), "ctx.farthest = sys.maxsize"] + lines + ["ctx.farthest = {}".format(f)], f
+
+    def expr(self, m, pos, end, r, depth):
+        "Lines that match m at pos, leaving the end position (-1 on failure) in end and the result in r."
+        if depth > MAX_LOOP_DEPTH and not isinstance(m, (StringMatcher, CharMatcher, RegexMatcher, RuleMatcher)):
+            helper = self.fresh("_h")
+            self.helpers.append(self.function(helper, self.expr(m, "pos", "end", "r", 0)))
+            return ["{}, {} = {}(ctx, {})".format(end, r, helper, pos)]
+
+        if isinstance(m, StringMatcher):
+            return [
+                "if text[{0}:{0} + {1}] == {2!r}:".format(pos, len(m.expr), m.expr),
+                "    {} = {} + {}".format(end, pos, len(m.expr)),
+                "    {} = {!r}".format(r, m.expr),
+                "else:",
+                *("    " + line for line in self.fail(pos, m)),
+                "    {} = -1".format(end),
+            ]
+        elif isinstance(m, CharMatcher):
+            fn = self.constant(m.expr, "_f")
+            return [
+                "if {0} < n and {1}(text[{0}]):".format(pos, fn),
+                "    {} = text[{}]".format(r, pos),
+                "    {} = {} + 1".format(end, pos),
+                "else:",
+                *("    " + line for line in self.fail(pos, m)),
+                "    {} = -1".format(end),
+            ]
+        elif isinstance(m, RegexSequenceMatcher):
+            regex = self.constant(m.re, "_re")
+            found = self.fresh("m")
+            values = ["{}.group({})".format(found, v) if type(v) is int else repr(v) for v in m.values]
+            return [
+                "{} = {}.match(text, {})".format(found, regex, pos),
+                "if {} is not None:".format(found),
+                "    {} = {}.end()".format(end, found),
+                "    {} = {}".format(r, "[{}]".format(", ".join(values)) if len(values) > 1 else values[0]),
+                "else:",
+                *("    " + line for line in self.fail(pos, m)),
+                "    {} = -1".format(end),
+            ]
+        elif isinstance(m, RegexMatcher):
+            regex = self.constant(m.re, "_re")
+            found = self.fresh("m")
+            return [
+                "{} = {}.match(text, {})".format(found, regex, pos),
+                "if {} is not None:".format(found),
+                "    {} = {}.end()".format(end, found),
+                "    {} = {}.group(0)".format(r, found),
+                "else:",
+                *("    " + line for line in self.fail(pos, m)),
+                "    {} = -1".format(end),
+            ]
+        elif isinstance(m, RuleMatcher):
+            if m.expr in self.names:
+                return ["{}, {} = {}(ctx, {})".format(end, r, self.names[m.expr], pos)]
+            else:
+                return ["_missing({!r})".format(m.expr)]
+        elif isinstance(m, Builder):
+            inner = self.fresh("r")
+            lines = self.expr(m.preceeding, pos, end, inner, depth)
+            lines.append("if {} >= 0:".format(end))
+            lines.append("    {} = {}".format(r, self.apply(m.fn, inner)))
+            return lines
+        elif isinstance(m, SequenceMatcher):
+            return self.sequence(m, pos, end, r, depth)
+        elif isinstance(m, DispatchChoiceMatcher):
+            return self.dispatch(m, pos, end, r, depth)
+        elif isinstance(m, ChoiceMatcher):
+            lines = ["while True:"]
+            for c in m.expr:
+                lines.extend("    " + line for line in self.expr(c, pos, end, r, depth + 1))
+                lines.append("    if {} >= 0:".format(end))
+                lines.append("        break")
+            lines.append("    break")
+            return lines
+        elif isinstance(m, (StarMatcher, PlusMatcher)):
+            p, e, x, results = self.fresh("p"), self.fresh("e"), self.fresh("r"), self.fresh("results")
+            lines = ["{} = []".format(results), "{} = {}".format(p, pos), "while True:"]
+            lines.extend("    " + line for line in self.expr(m.expr, p, e, x, depth + 1))
+            lines.append("    if {} < 0:".format(e))
+            lines.append("        break")
+            if isinstance(m, StarMatcher):
+                lines.append("    assert {} > {}".format(e, p))
+            lines.append("    {}.append({})".format(results, x))
+            lines.append("    {} = {}".format(p, e))
+            if isinstance(m, StarMatcher):
+                lines.append("{} = {}".format(end, p))
+            else:
+                lines.append("{} = {} if {} else -1".format(end, p, results))
+            lines.append("{} = {}".format(r, results))
+            return lines
+        elif isinstance(m, OptionalMatcher):
+            lines = self.expr(m.expr, pos, end, r, depth)
+            lines.append("if {} < 0:".format(end))
+            lines.append("    {} = {}".format(end, pos))
+            lines.append("    {} = None".format(r))
+            return lines
+        elif isinstance(m, (AndMatcher, NotMatcher)):
+            e, x = self.fresh("e"), self.fresh("r")
+            lines, f = self.quiet(self.expr(m.expr, pos, e, x, depth))
+            test = ">=" if isinstance(m, AndMatcher) else "<"
+            lines.append("if {} {} 0:".format(e, test))
+            lines.append("    {} = {}".format(end, pos))
+            lines.append("else:")
+            lines.append("    {} = -1".format(end))
+            lines.append("    if {} >= {}:".format(pos, f))
+            lines.append("        ctx.fail({}, {!r})".format(pos, tuple(expectations(m))))
+            lines.append("{} = Nothing".format(r))
+            return lines
+        elif isinstance(m, NothingMatcher):
+            x = self.fresh("r")
+            lines = self.expr(m.expr, pos, end, x, depth)
+            lines.append("{} = Nothing".format(r))
+            return lines
+        elif isinstance(m, CaptureMatcher):
+            e, x = self.fresh("e"), self.fresh("r")
+            lines = self.expr(m.expr, pos, e, x, depth)
+            lines.append("if {} >= 0:".format(e))
+            lines.append("    {} = text[{}:{}]".format(r, pos, e))
+            lines.append("    if type({}) is memoryview:".format(r))
+            lines.append("        {} = bytes({})".format(r, r))
+            lines.append("{} = {}".format(end, e))
+            return lines
+        elif isinstance(m, ImplicitMatcher):
+            return ["{} = {}".format(end, pos), "{} = {}".format(r, self.constant(m.value))]
+        elif isinstance(m, EofMatcher):
+            lines = ["if {} >= n:".format(pos), "    {} = {}".format(end, pos), "else:", "    {} = -1".format(end)]
+            lines.extend("    " + line for line in self.fail(pos, m))
+            lines.append("{} = None".format(r))
+            return lines
+        elif isinstance(m, CutMatcher):
+            return ["if ctx.memo:", "    _forget(ctx, {})".format(pos), "{} = {}".format(end, pos), "{} = Nothing".format(r)]
+        elif isinstance(m, TokenMatcher):
+            return self.token(m, pos, end, r, depth)
+        elif isinstance(m, MemoMatcher):
+            # Outcomes are kept in ctx.memo like MemoMatcher.match_at's, by a number for this matcher.
+            key, found = "({}, {})".format(self.fresh(""), pos), self.fresh("found")
+            lines = ["{} = ctx.memo.get({})".format(found, key), "if {} is None:".format(found)]
+            lines.extend("    " + line for line in self.expr(m.expr, pos, end, r, depth))
+            lines.append("    ctx.memo[{}] = ({}, {}) if {} >= 0 else FAIL".format(key, end, r, end))
+            lines.append("else:")
+            lines.append("    {}, {} = {}".format(end, r, found))
+            return lines
+        elif self.inject:
+            return ["{}, {} = {}.match_at(ctx, {})".format(end, r, self.constant(m, "_m"), pos)]
+        else:
+            raise TypeError("Don't know how to generate code for {}".format(m))
+
+    def sequence(self, m, pos, end, r, depth):
+        p, results = self.fresh("p"), self.fresh("results")
+        lines = ["while True:", "    {} = {}".format(p, pos), "    {} = []".format(results)]
+        committed = False
+        for e in m.expr:
+            x = self.fresh("r")
+            if isinstance(e, CutMatcher):
+                committed = True
+                lines.append("    if ctx.memo:")
+                lines.append("        _forget(ctx, {})".format(p))
+                continue
+            elif committed:
+                next = self.fresh("e")
+                lines.extend("    " + line for line in self.expr(e, p, next, x, depth + 1))
+                lines.append("    if {} < 0:".format(next))
+                lines.append("        raise cut_error(text, {}, {!r})".format(p, expectations(e)))
+                lines.append("    {} = {}".format(p, next))
+            elif isinstance(e, (StringMatcher, RegexMatcher, RuleMatcher)):
+                # These only assign the end position once they are done with the start.
+                lines.extend("    " + line for line in self.expr(e, p, p, x, depth + 1))
+                lines.append("    if {} < 0:".format(p))
+                lines.append("        break")
+            else:
+                next = self.fresh("e")
+                lines.extend("    " + line for line in self.expr(e, p, next, x, depth + 1))
+                lines.append("    if {} < 0:".format(next))
+                lines.append("        {} = -1".format(p))
+                lines.append("        break")
+                lines.append("    {} = {}".format(p, next))
+            if not isinstance(e, (NothingMatcher, AndMatcher, NotMatcher)):
+                lines.append("    if {} != Nothing:".format(x))
+                lines.append("        {}.append({})".format(results, x))
+        lines.append("    {} = {} if len({}) > 1 else {}[0]".format(r, results, results, results))
+        lines.append("    break")
+        lines.append("{} = {}".format(end, p))
+        return lines
+
+    def dispatch(self, m, pos, end, r, depth):
+        groups = {}
+        for c, indices in m.table.items():
+            groups.setdefault(tuple(indices), set()).add(c)
+
+        def alternatives(indices):
+            lines = [] if indices else self.fail(pos, m)
+            for i in indices:
+                lines.extend(self.expr(m.expr[i], pos, end, r, depth + 1))
+                lines.append("if {} >= 0:".format(end))
+                lines.append("    break")
+            lines.append("{} = -1".format(end))
+            lines.append("break")
+            return lines
+
+        c = self.fresh("c")
+        lines = ["while True:", "    {} = text[{}] if {} < n else None".format(c, pos, pos)]
+        for indices, chars in groups.items():
+            lines.append("    if {} in {}:".format(c, self.constant(frozenset(chars), "_cs")))
+            lines.extend("        " + line for line in alternatives(indices))
+        lines.extend("    " + line for line in alternatives(m.default))
+        return lines
+
+    def token(self, m, pos, end, r, depth):
+        "Like TokenMatcher.match_at: the whitespace around the matcher is skipped without noting what failed in it."
+        p, e, x, s = self.fresh("p"), self.fresh("e"), self.fresh("r"), self.fresh("r")
+        lines, _ = self.quiet(self.expr(m.space, pos, p, s, depth))
+        lines.extend(self.expr(m.matcher, p, e, x, depth))
+        after, _ = self.quiet(self.expr(m.space, e, end, s, depth + 1))
+        lines.append("if {} >= 0:".format(e))
+        lines.extend("    " + line for line in after)
+        # Sequences leave Nothing out, so the value is what the whitespace after the token matched.
+        lines.append("    {} = {} if {} is Nothing else {}".format(r, s, x, x))
+        lines.append("else:")
+        lines.append("    {} = -1".format(end))
+        return lines
+
+    def apply(self, fn, r):
+        if type(fn) is Index:
+            return "{}[{}]".format(r, fn.i)
+        elif type(fn) is Constant:
+            return self.constant(fn.value)
+        elif type(fn) is Join:
+            joined = "_text({})".format(r)
+            return joined if fn.fn is None else "{}({})".format(self.constant(fn.fn, "_f"), joined)
+        elif type(fn) is Compose:
+            return self.apply(fn.then, self.apply(fn.first, r))
+        elif type(fn) is Defer:
+            return "Action({}, {})".format(self.constant(fn.fn, "_f"), r)
+        else:
+            return "{}({})".format(self.constant(fn, "_f"), r)
+
+
+def generate(grammar, bindings=None):
+    "Python source for a module equivalent to grammar. bindings names the module:attribute the grammar's bindings came from."
+    return Generator(grammar, bindings).source()
+
+
+def load(grammar, name="generated_parser"):
+    "Compile grammar and load the generated code in process, so any function or value in the grammar can be referenced."
+    generator = Generator(grammar, inject=True)
+    source = generator.source()
+    module = type(sys)(name)
+    module.__dict__.update({name: obj for name, obj, _ in generator.constants})
+    exec(compile(source, "<{}>".format(name), "exec"), module.__dict__)
+    module.grammar = grammar
+    return module
+
+
+if __name__ == "__main__":
+
+    from peg import grammar
+
+    if len(sys.argv) < 2:
+        print("usage: {} grammar.g [module:bindings]".format(sys.argv[0]), file=sys.stderr)
+        sys.exit(1)
+
+    g = grammar(sys.argv[1])
+    bindings = sys.argv[2] if len(sys.argv) > 2 else None
+    if bindings is not None:
+        module, attribute = bindings.split(":")
+        g = g.bindings(getattr(importlib.import_module(module), attribute))
+    print(generate(g, bindings), end="")
@@ -0,0 +1,234 @@
+"""
+Concrete syntax trees: parse into a tree of rule matches kept as columns
+of integers that refer to spans of the original text, instead of nested
+lists of results and copied strings.
+"""
+
+from array import array
+
+from parseltongue import FAIL
+from parseltongue import BytesInput
+from parseltongue import Context
+from parseltongue import Matcher
+from parseltongue import MmapInput
+from parseltongue import TextInput
+from parseltongue import Visitor
+
+
+class Tree:
+    """
+    Nodes in preorder as parallel columns: the rule (an index into
+    names), start and end positions, and the number of descendants, so
+    that node i's subtree is nodes i to i + sizes[i] and its first
+    child, if any, is i + 1.
+    """
+
+    def __init__(self, text, names):
+        self.text = text
+        self.names = names
+        self.rules = array("i")
+        self.starts = array("q")
+        self.ends = array("q")
+        self.sizes = array("i")
+
+    def __len__(self):
+        return len(self.starts)
+
+    def open(self, rule, pos):
+        self.rules.append(rule)
+        self.starts.append(pos)
+        self.ends.append(pos)
+        self.sizes.append(0)
+
+    def close(self, i, end):
+        self.ends[i] = end
+        self.sizes[i] = len(self.starts) - i - 1
+
+    def truncate(self, n):
+        del self.rules[n:]
+        del self.starts[n:]
+        del self.ends[n:]
+        del self.sizes[n:]
+
+    def node(self, i):
+        return Node(self, i)
+
+    @property
+    def root(self):
+        return Node(self, 0)
+
+
+class Node:
+    "A view of node index of tree."
+
+    __slots__ = ("tree", "index")
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    def __eq__(self, other):
+        return type(other) is Node and self.tree is other.tree and self.index == other.index
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+    def __repr__(self):
+        return "Node({}, {}, {})".format(self.rule, self.start, self.end)
+
+    @property
+    def rule(self):
+        return self.tree.names[self.tree.rules[self.index]]
+
+    @property
+    def start(self):
+        return self.tree.starts[self.index]
+
+    @property
+    def end(self):
+        return self.tree.ends[self.index]
+
+    @property
+    def text(self):
+        return self.tree.text[self.start : self.end]
+
+    @property
+    def children(self):
+        tree, sizes = self.tree, self.tree.sizes
+        i = self.index + 1
+        last = self.index + sizes[self.index]
+        children = []
+        while i <= last:
+            children.append(Node(tree, i))
+            i += sizes[i] + 1
+        return children
+
+    def result(self, grammar):
+        """
+        The result of the rule at this node in the usual list and
+        Builder form, by matching it against the node's span again.
+        """
+        end, r = grammar[self.rule].match_at(Context(grammar, self.tree.text), self.start)
+        assert end == self.end
+        return r
+
+
+#
+# Matchers recording nodes
+#
+
+
+class TreeContext(Context):
+    def __init__(self, grammar, text, tree):
+        super().__init__(grammar, text)
+        self.tree = tree
+
+
+class NodeMatcher(Matcher):
+    "Matches the body of rule number rule, adding a node for it to the tree."
+
+    def __init__(self, rule, expr):
+        self.rule = rule
+        self.expr = expr
+
+    def match_at(self, ctx, pos):
+        tree = ctx.tree
+        i = len(tree)
+        tree.open(self.rule, pos)
+        end = self.expr.match_at(ctx, pos)[0]
+        if end < 0:
+            tree.truncate(i)
+            return FAIL
+        tree.close(i, end)
+        return end, None
+
+
+class Retract(Matcher):
+    """
+    Matches expr, dropping the nodes it added if it fails, or always if
+    not keep (for lookahead).
+    """
+
+    def __init__(self, expr, keep=True):
+        self.expr = expr
+        self.keep = keep
+
+    def match_at(self, ctx, pos):
+        tree = ctx.tree
+        n = len(tree)
+        result = self.expr.match_at(ctx, pos)
+        if result[0] < 0 or not self.keep:
+            tree.truncate(n)
+        return result
+
+    def accept(self, visitor):
+        return Retract(self.expr.accept(visitor), self.keep)
+
+
+class References(Visitor):
+    def __init__(self):
+        self.found = False
+
+    def visit_rule_matcher(self, m):
+        self.found = True
+        return m
+
+
+def refers(m):
+    "Whether m matches any rule, and so might add nodes."
+    references = References()
+    m.accept(references)
+    return references.found
+
+
+class Spans(Visitor):
+    # Builder functions aren't applied, and whatever can fail after rules
+    # in it matched drops their nodes: alternatives abandoned part way
+    # through leave nothing behind.
+
+    def visit_builder(self, m):
+        return m.preceeding
+
+    def visit_sequence_matcher(self, m):
+        return Retract(m) if refers(m) else m
+
+    def visit_token_matcher(self, m):
+        return Retract(m) if refers(m) else m
+
+    def visit_and_matcher(self, m):
+        return Retract(m, keep=False) if refers(m) else m
+
+    def visit_not_matcher(self, m):
+        return Retract(m, keep=False) if refers(m) else m
+
+    def visit_memo_matcher(self, m):
+        # A remembered outcome wouldn't add the rule's nodes again.
+        return m.expr
+
+
+class Parser:
+    """
+    Parses into a Tree with the rules of grammar. Only the rules named in
+    nodes, by default all of them, get nodes; the others are matched as
+    part of the rule using them, which keeps lexical rules like
+    whitespace from making a node per character.
+    """
+
+    def __init__(self, grammar, nodes=None):
+        rules = getattr(grammar, "rules", grammar)
+        self.names = list(rules)
+        spans = Spans()
+        self.rules = {}
+        for i, name in enumerate(self.names):
+            body = rules[name].accept(spans)
+            self.rules[name] = body if nodes is not None and name not in nodes else NodeMatcher(i, body)
+
+    def parse(self, init, input):
+        "Match rule init against a TextInput, BytesInput or MmapInput, returning (ok, next input, root node)."
+        if type(input) not in (TextInput, BytesInput, MmapInput):
+            raise ValueError("Trees are built from a TextInput, BytesInput or MmapInput, not {}".format(type(input).__name__))
+        if type(self.rules[init]) is not NodeMatcher:
+            raise ValueError("Rule {} has no nodes, so it can't be the root".format(init))
+        tree = Tree(input.text, self.names)
+        end = self.rules[init].match_at(TreeContext(self.rules, input.text, tree), input.pos)[0]
+        return input.ok(input.next(end), tree.root) if end >= 0 else input.fail()
@@ -44,10 +44,6 @@ baz: [String]
 quux(blah: Int = 123): Int!
 }"""
 
-    import parseltongue
-
-    parseltongue.verbose = False
-
     input = TextInput(text1)
 
     import json
@@ -2,6 +2,7 @@
 
 from parseltongue import Nothing
 from parseltongue import TextInput
+from parseltongue import capture
 from parseltongue import choice
 from parseltongue import literal
 from parseltongue import match
@@ -37,7 +38,7 @@ p = {
     "parenthesized": punc(tok("(")).then("expression").then(punc(tok(")"))),
     "factor": choice("parenthesized", "number"),
     "term": binary("factor", "*", "term"),
-    "number": star(str.isdigit).text(int),
+    "number": capture(star(str.isdigit)).returning(int),
 }
 
 if __name__ == "__main__":
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+from optimize import link
 from parseltongue import TextInput
 from parseltongue import parse
 from peg import grammar
@@ -183,29 +184,22 @@ x = {
 }
 
 
-g = grammar("grammars/query.g").bindings(x)
+g = link(grammar("grammars/query.g", cache=True).bindings(x))
 
 
 if __name__ == "__main__":
 
-    import parseltongue
-
-    parseltongue.verbose = False
-
     verbose = False
 
     allOkay = True
 
     def check(rule, text):
-        parseltongue.verbose = False
         ok, _, r = parse(g, rule, TextInput(text))
         if ok:
             if verbose:
                 print("ok: {} parsed {} => {}".format(rule, repr(text), r))
         else:
-            print("FAIL: {} did not parse {}".format(rule, repr(text)))
-            parseltongue.verbose = True
-            parse(g, rule, TextInput(text))
+            print("FAIL: {} did not parse {}: {}".format(rule, repr(text), r))
 
     def doc(text):
         check("Document", text)
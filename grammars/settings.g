@@ -0,0 +1,11 @@
+# Settings, one to a line. Once a name and '=' have matched, the cut
+# commits the parse to the setting: a bad value raises ParseError where
+# it is instead of ending the settings there, and PackratInput and
+# StreamInput forget everything before it.
+
+settings := setting+
+setting  := name '=' ^ value u+000A
+value    := number | string
+name     := /[a-z_]+/
+number   := /[0-9]+/
+string   := '"' /[^"\n]*/ '"'
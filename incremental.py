@@ -0,0 +1,139 @@
+"Incremental reparsing: keep rule results across edits, redoing only those whose examined text changed."
+
+from analysis import regex_extent
+from parseltongue import RuleMatcher
+from parseltongue import TextInput
+from parseltongue import parse
+
+
+class State:
+    """
+    Text and memo shared by the inputs of an incremental parse. The memo
+    has a column per position holding, for each rule tried there,
+    (ok, length, result, behind, ahead, edits): lengths relative to the
+    column so entries move with it when text is inserted or deleted
+    before them, the span of text the rule examined, and how many edits
+    it was last checked against. low and high track the span examined by
+    the rule currently being matched.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.columns = [None] * (len(text) + 1)
+        self.edits = []
+        self.low = 0
+        self.high = 0
+
+    def examine(self, low, high):
+        if low < self.low:
+            self.low = low
+        if high > self.high:
+            self.high = high
+
+    def edit(self, offset, deleted, inserted):
+        self.text = self.text[:offset] + inserted + self.text[offset + deleted :]
+        self.columns[offset : offset + deleted] = [None] * len(inserted)
+        self.edits.append((offset, deleted, len(inserted)))
+
+    def valid(self, pos, entry):
+        "Whether no edit since entry was last checked touched the text it examined. Entries are checked lazily, newest edit first."
+        low, high = pos - entry[3], pos + entry[4]
+        for offset, deleted, inserted in reversed(self.edits[entry[5] :]):
+            end = offset + inserted
+            if (low < end and high > offset) if inserted else (low < offset < high):
+                return False
+            if low >= end:
+                low -= inserted - deleted
+                high -= inserted - deleted
+        return True
+
+
+class IncrementalInput(TextInput):
+    "TextInput memoizing rules by position like PackratInput, recording what text each one examined."
+
+    def __init__(self, state, position=0):
+        super().__init__(state.text, position)
+        self.state = state
+
+    def next(self, newpos):
+        return IncrementalInput(self.state, newpos)
+
+    def match(self, matcher, grammar):
+        if not isinstance(matcher, RuleMatcher):
+            return matcher.match(grammar, self)
+
+        s = self.state
+        pos = self.pos
+        column = s.columns[pos]
+        entry = None if column is None else column.get(matcher.expr)
+        if entry is not None and (entry[5] == len(s.edits) or s.valid(pos, entry)):
+            if entry[5] != len(s.edits):
+                column[matcher.expr] = entry = entry[:5] + (len(s.edits),)
+            ok, length, r, behind, ahead, _ = entry
+            s.examine(pos - behind, pos + ahead)
+            return (True, self.next(pos + length), r) if ok else self.fail()
+
+        low, high = s.low, s.high
+        s.low = s.high = pos
+        ok, next, r = matcher.match(grammar, self)
+        if column is None:
+            column = s.columns[pos] = {}
+        column[matcher.expr] = (ok, next.pos - pos if ok else 0, r, pos - s.low, s.high - pos, len(s.edits))
+        s.examine(low, high)
+        return ok, next, r
+
+    # Reading one past the end of the text means looking at the end of
+    # input, which appending text changes.
+
+    def match_eof(self):
+        self.state.examine(self.pos, self.pos + 1)
+        return super().match_eof()
+
+    def match_string(self, s):
+        self.state.examine(self.pos, self.pos + len(s))
+        return super().match_string(s)
+
+    def match_char_predicate(self, predicate):
+        self.state.examine(self.pos, self.pos + 1)
+        return super().match_char_predicate(predicate)
+
+    def match_re(self, regex):
+        ok, next, r = super().match_re(regex)
+        behind, ahead, reach = regex_extent(regex.pattern)
+        low = 0 if behind is None else self.pos - behind
+        if ok:
+            high = len(self.text) + 1 if ahead is None else next.pos + ahead
+        else:
+            high = len(self.text) + 1 if reach is None else self.pos + reach
+        self.state.examine(low, high)
+        return ok, next, r
+
+
+class IncrementalParser:
+    """
+    Parses text with a grammar, then re-parses after each edit reusing
+    every rule result whose examined text the edits left alone. Work per
+    edit is proportional to the size of the edit and the depth of the
+    rules around it, plus a memo lookup per sibling of those rules.
+    Rules' results are shared between parses, so builder functions must
+    not mutate what they are given.
+    """
+
+    def __init__(self, grammar, init, text):
+        self.grammar = grammar
+        self.init = init
+        self.state = State(text)
+
+    @property
+    def text(self):
+        return self.state.text
+
+    def parse(self):
+        return parse(self.grammar, self.init, IncrementalInput(self.state))
+
+    def edit(self, offset, deleted, inserted):
+        "Replace deleted characters at offset with inserted, then parse again."
+        if not 0 <= offset <= offset + deleted <= len(self.state.text):
+            raise ValueError("Edit of {} characters at {} is outside the text".format(deleted, offset))
+        self.state.edit(offset, deleted, inserted)
+        return self.parse()
@@ -0,0 +1,190 @@
+"""
+Split text into tokens once, using the tokens a grammar declares with
+TOKENS: and WHITESPACE:, so that token matchers find their token by
+position instead of scanning whitespace and the token's text again on
+every attempt.
+
+Lexing scans every token a parse could ask for, which costs about as
+much as a plain parse or more: lexing and then parsing a text once is
+slower than parsing it, roughly twice as slow for grammars/query.g
+documents. Tokens pay for themselves when a parse backtracks over them
+a lot, or when one lexed text is parsed more than once.
+"""
+
+from array import array
+
+from analysis import Analysis
+from parseltongue import FAIL
+from parseltongue import AndMatcher
+from parseltongue import Builder
+from parseltongue import CaptureMatcher
+from parseltongue import ChoiceMatcher
+from parseltongue import Context
+from parseltongue import MemoMatcher
+from parseltongue import Nothing
+from parseltongue import NothingMatcher
+from parseltongue import NotMatcher
+from parseltongue import OptionalMatcher
+from parseltongue import PlusMatcher
+from parseltongue import SequenceMatcher
+from parseltongue import StarMatcher
+from parseltongue import TokenInput
+from parseltongue import TokenMatcher
+
+
+def token_matchers(m, found):
+    "Append the TokenMatchers in m to found, without rebuilding anything as a Visitor would."
+    if type(m) is TokenMatcher:
+        found.append(m)
+    elif isinstance(m, Builder):
+        token_matchers(m.preceeding, found)
+    elif isinstance(m, (SequenceMatcher, ChoiceMatcher)):
+        for e in m.expr:
+            token_matchers(e, found)
+    elif isinstance(m, (StarMatcher, PlusMatcher, OptionalMatcher, AndMatcher, NotMatcher, NothingMatcher, CaptureMatcher, MemoMatcher)):
+        token_matchers(m.expr, found)
+
+
+class Lexer:
+    """
+    The token kinds of a grammar: one for each distinct matcher wrapped
+    in a TokenMatcher, in the order of the grammar's TOKENS: line, which
+    settles ties between kinds that match the same text. All tokens must
+    ignore the same whitespace.
+    """
+
+    def __init__(self, grammar):
+        self.grammar = grammar
+        rules = getattr(grammar, "rules", grammar)
+        found = []
+        for rule in rules.values():
+            token_matchers(rule, found)
+        if not found:
+            raise ValueError("Grammar has no tokens")
+        if len({m.ignore for m in found}) > 1:
+            raise ValueError("Tokens ignore different whitespace")
+
+        declared = getattr(grammar, "tokens", None) or []
+        matchers = list(dict.fromkeys(m.matcher for m in found))
+        matchers.sort(key=lambda m: declared.index(m) if m in declared else len(declared))
+        self.ignore = StarMatcher(found[0].ignore)
+        # Each kind is matched by itself with the whitespace after it, as a TokenMatcher would.
+        self.tokens = [TokenMatcher(m, found[0].ignore) for m in matchers]
+        kind = {m: k for k, m in enumerate(matchers)}
+        self.kinds = {id(m): kind[m.matcher] for m in found}
+
+        analysis = Analysis(rules)
+        facts = [analysis.compute(m) for m in matchers]
+        self.any = [k for k, (nullable, first) in enumerate(facts) if nullable or first is None]
+        self.candidates = {}
+        for k, (_, first) in enumerate(facts):
+            for c in first or ():
+                self.candidates.setdefault(c, list(self.any))
+                self.candidates[c].append(k)
+        for kinds in self.candidates.values():
+            kinds.sort()
+
+    def lex(self, text):
+        "Tokens of text, up to the end or the first thing that isn't a token."
+        return Tokens(self, text)
+
+    def input(self, text, position=0):
+        return TokenInput(self.lex(text), position)
+
+
+class Tokens:
+    """
+    Text split into tokens as parallel columns: kind, start, end of the
+    token's own text, and after, the end of the whitespace following it.
+    values holds what each token's TokenMatcher returns. at maps both
+    the start of a token and the start of the whitespace before it to
+    the token's index, and others the kinds that matched there when
+    there was more than one, with their ends.
+
+    A token matcher at a position in at whose token is of its kind
+    succeeds with the lexed end and value, and fails if its kind didn't
+    match there at all. Others, like a different kind that also matched
+    or a token at a position the lexer didn't stop at, are matched
+    normally, once per position.
+    """
+
+    def __init__(self, lexer, text):
+        self.lexer = lexer
+        self.text = text
+        self.kinds = array("i")
+        self.starts = array("q")
+        self.ends = array("q")
+        self.afters = array("q")
+        self.values = []
+        self.at = {}
+        self.others = {}
+        self.memo = {}
+
+        rules = getattr(lexer.grammar, "rules", lexer.grammar)
+        ctx = Context(rules, text)
+        matchers = [t.matcher for t in lexer.tokens]
+        ignore = lexer.ignore
+        n = len(text)
+        pos = 0
+        while True:
+            start = ignore.skip_at(ctx, pos)
+            if start >= n:
+                break
+            candidates = lexer.candidates.get(text[start], lexer.any)
+            if len(candidates) == 1:
+                kind = candidates[0]
+                end, value = matchers[kind].match_at(ctx, start)
+            else:
+                # The longest match wins, and the first kind declared of
+                # equally long ones. Kinds are compared with the whitespace
+                # after them, since a token's rule may end in a token.
+                kind, end, longest, matched = -1, -1, -1, {}
+                for k in candidates:
+                    e = matchers[k].skip_at(ctx, start)
+                    if e >= 0:
+                        matched[k] = e
+                        if (after := ignore.skip_at(ctx, e)) > longest:
+                            kind, end, longest = k, e, after
+                if kind >= 0:
+                    value = matchers[kind].match_at(ctx, start)[1]
+                    if len(matched) > 1:
+                        self.others[len(self.kinds)] = matched
+            if end <= start:
+                break
+            if value is Nothing:
+                # Sequences leave Nothing out, so the TokenMatcher's value is something else.
+                after, value = lexer.tokens[kind].match_at(ctx, start)
+            else:
+                after = ignore.skip_at(ctx, end)
+            self.at[pos] = self.at[start] = len(self.kinds)
+            self.kinds.append(kind)
+            self.starts.append(start)
+            self.ends.append(end)
+            self.afters.append(after)
+            self.values.append(value)
+            pos = after
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def match(self, m, ctx, pos):
+        "Match TokenMatcher m at pos like m.match_at."
+        i = self.at.get(pos)
+        kind = self.lexer.kinds.get(id(m))
+        if i is not None and kind is not None:
+            if self.kinds[i] == kind:
+                return self.afters[i], self.values[i]
+            elif kind not in self.others.get(i, ()):
+                # Lexing tried every kind that could start here.
+                if self.starts[i] >= ctx.farthest:
+                    ctx.fail(self.starts[i], m)
+                return FAIL
+        key = (id(m), pos)
+        result = self.memo.get(key)
+        if result is None:
+            ctx.tokens = None
+            try:
+                result = self.memo[key] = m.match_at(ctx, pos)
+            finally:
+                ctx.tokens = self
+        return result
@@ -0,0 +1,237 @@
+"Grammar rewriting passes built on parseltongue's Visitor."
+
+import copy
+import re
+
+from analysis import Analysis
+from parseltongue import AndMatcher
+from parseltongue import Builder
+from parseltongue import CaptureMatcher
+from parseltongue import ChoiceMatcher
+from parseltongue import Compose
+from parseltongue import Constant
+from parseltongue import DispatchChoiceMatcher
+from parseltongue import LinkedRule
+from parseltongue import MemoMatcher
+from parseltongue import NothingMatcher
+from parseltongue import NotMatcher
+from parseltongue import OptionalMatcher
+from parseltongue import PlusMatcher
+from parseltongue import RegexMatcher
+from parseltongue import RegexSequenceMatcher
+from parseltongue import RuleMatcher
+from parseltongue import SequenceMatcher
+from parseltongue import StarMatcher
+from parseltongue import StringMatcher
+from parseltongue import TokenMatcher
+from parseltongue import Visitor
+
+# Regexes whose meaning depends on the text around the match can't be
+# moved into a bigger regex.
+CONTEXT_SENSITIVE = re.compile(r"\$|\\[AbBZ]|\(\?<?[=!]")
+
+# Rules with at most this many matchers are inlined where they're used,
+# unless they're recursive.
+INLINE_SIZE = 3
+
+
+def as_str(p):
+    "Patterns are assembled as str. Bytes ones (from binary grammars) go through latin-1, which maps each byte to the character with the same code."
+    return p.decode("latin-1") if isinstance(p, bytes) else p
+
+
+def atom_pattern(m):
+    "A regex matching exactly what m matches and returning the matched text, or None if there isn't one."
+    if type(m) is StringMatcher:
+        return re.escape(as_str(m.expr))
+    elif type(m) is RegexMatcher and m.re.groups == 0 and not CONTEXT_SENSITIVE.search(as_str(m.expr)):
+        return as_str(m.expr)
+    else:
+        return None
+
+
+def fused(make, pattern, binary, *args):
+    try:
+        return make(pattern.encode("latin-1") if binary else pattern, *args)
+    except re.error:
+        return None
+
+
+class LiteralFusion(Visitor):
+    """
+    Replace choices between literals and regexes with a single regex
+    alternation, and sequences of them with a RegexSequenceMatcher.
+    Python's regex alternation is ordered just like PEG choice. Inside
+    sequences each regex element is made atomic with a lookahead and
+    backreference so the combined regex can't backtrack into it.
+    Captures of either are just the regex.
+    """
+
+    def visit_choice_matcher(self, m):
+        patterns = [atom_pattern(c) for c in m.expr]
+        if None in patterns:
+            return m
+        elif all(type(c) is StringMatcher and len(c.expr) == 1 for c in m.expr):
+            pattern = "[{}]".format("".join(patterns))
+        else:
+            pattern = "|".join("(?:{})".format(p) for p in patterns)
+        return fused(RegexMatcher, pattern, isinstance(m.expr[0].expr, bytes)) or m
+
+    def visit_sequence_matcher(self, m):
+        pattern = []
+        values = []
+        groups = 0
+        for e in m.expr:
+            keep = type(e) is not NothingMatcher
+            atom = e if keep else e.expr
+            p = atom_pattern(atom)
+            if p is None:
+                return m
+            elif type(atom) is StringMatcher:
+                pattern.append(p)
+                if keep:
+                    values.append(atom.expr)
+            else:
+                groups += 1
+                pattern.append("(?=(?P<g{0}>{1}))(?P=g{0})".format(groups, p))
+                if keep:
+                    values.append(groups)
+
+        if len(m.expr) < 2 or not values:
+            return m
+        else:
+            return fused(RegexSequenceMatcher, "".join(pattern), isinstance(atom.expr, bytes), values) or m
+
+    def visit_capture_matcher(self, m):
+        # A regex's own value is the text it matched.
+        if type(m.expr) is RegexSequenceMatcher:
+            return RegexMatcher(m.expr.expr)
+        pattern = atom_pattern(m.expr)
+        return m if pattern is None else fused(RegexMatcher, pattern, isinstance(m.expr.expr, bytes)) or m
+
+
+class FirstSetDispatch(Visitor):
+    "Replace choices with DispatchChoiceMatchers indexed by the FIRST sets of their alternatives."
+
+    def __init__(self, analysis):
+        self.analysis = analysis
+
+    def visit_choice_matcher(self, m):
+        facts = [self.analysis.compute(c) for c in m.expr]
+        always = [i for i, (nullable, first) in enumerate(facts) if nullable or first is None]
+        if len(always) == len(m.expr):
+            return m
+
+        chars = set().union(*(first for _, first in facts if first is not None))
+        table = {c: [i for i, (nullable, first) in enumerate(facts) if nullable or first is None or c in first] for c in chars}
+        return DispatchChoiceMatcher(m.expr, table, always)
+
+
+def dispatch_choices(grammar):
+    "Rules of grammar with every choice indexed by FIRST set. The rules must not change afterwards in ways that change what they match."
+    visitor = FirstSetDispatch(Analysis(grammar))
+    return {name: rule.accept(visitor) for name, rule in getattr(grammar, "rules", grammar).items()}
+
+
+#
+# Linking
+#
+
+
+def children(m):
+    if isinstance(m, Builder):
+        return [m.preceeding]
+    elif isinstance(m, (SequenceMatcher, ChoiceMatcher)):
+        return m.expr
+    elif isinstance(m, TokenMatcher):
+        return [m.matcher, m.ignore]
+    elif isinstance(m, (StarMatcher, PlusMatcher, OptionalMatcher, AndMatcher, NotMatcher, NothingMatcher, CaptureMatcher, MemoMatcher)):
+        return [m.expr]
+    else:
+        return []
+
+
+def size(m):
+    "How many matchers make up m, not counting the rules it uses."
+    return 1 + sum(size(c) for c in children(m))
+
+
+def references(m, found):
+    "Add the names of the rules m uses to found."
+    if isinstance(m, RuleMatcher):
+        found.add(m.expr)
+    for c in children(m):
+        references(c, found)
+    return found
+
+
+def reachable(rules):
+    "The names of the rules each rule uses, directly or through others: a rule that can reach itself is recursive."
+    uses = {name: references(m, set()) for name, m in rules.items()}
+    reach = {}
+    for name in rules:
+        seen, todo = set(), [name]
+        while todo:
+            for used in uses.get(todo.pop(), ()):
+                if used not in seen:
+                    seen.add(used)
+                    todo.append(used)
+        reach[name] = seen
+    return reach
+
+
+class Linker(Visitor):
+    def __init__(self, rules, inline):
+        self.rules = rules
+        self.inline = inline
+        self.links = {}
+        self.inlined = {}
+
+    def visit_rule_matcher(self, m):
+        name = m.expr
+        if name not in self.rules:
+            return m
+        elif name in self.inline:
+            if name not in self.inlined:
+                self.inlined[name] = self.rules[name].accept(self)
+            return self.inlined[name]
+        elif name not in self.links:
+            self.links[name] = LinkedRule(name)
+        return self.links[name]
+
+    def visit_builder(self, m):
+        inner = m.preceeding
+        if type(inner) is not Builder:
+            return m
+        elif type(m.fn) is Constant:
+            return Builder(inner.preceeding, m.fn)
+        else:
+            return Builder(inner.preceeding, Compose(inner.fn, m.fn))
+
+
+def link(grammar, start=None):
+    """
+    A copy of grammar ready for many parses: rule references point at
+    their rules' matchers, small rules that aren't recursive are copied
+    into the rules using them, Builders of Builders are combined, and
+    if start is given only the rules it uses are kept. Passes over the
+    result unlink it again, so link last. Rules a grammar's plan (see
+    plan.py) names to inline are inlined too, if they aren't recursive.
+    """
+    rules = getattr(grammar, "rules", grammar)
+    reach = reachable(rules)
+    plan = getattr(grammar, "plan", None)
+    hot = set(plan.inline) if plan is not None else set()
+
+    keep = [name for name in rules if start is None or name == start or name in reach[start]]
+    inline = {name for name in keep if name not in reach[name] and (size(rules[name]) <= INLINE_SIZE or name in hot)}
+    linker = Linker(rules, inline)
+    linked = {name: rules[name].accept(linker) for name in keep}
+    for name, m in linker.links.items():
+        m.target = linked[name]
+
+    if hasattr(grammar, "rules"):
+        grammar = copy.copy(grammar)
+        grammar.rules = linked
+        return grammar
+    return type(grammar)(linked)
@@ -2,13 +2,46 @@
 # Simple PEG parser framework.
 #
 
+import functools
+import mmap
+import os
 import re
-
-verbose = False
-depth = 0
+import sys
+import time
+from collections import OrderedDict
+from collections import namedtuple
 
 Nothing = object()
 
+# Shared result of a failed match in the position-based engine.
+FAIL = (-1, None)
+
+
+class ParseError(Exception):
+    """
+    Why input doesn't parse: the position, what was expected there and
+    the rules being matched, outermost first. Raised when something
+    fails to match after a cut, so the parse can't succeed by
+    backtracking, and the result of a failed parse of plain text or
+    bytes, for the farthest position anything failed to match at.
+    """
+
+    def __init__(self, position, expected, rules=(), line=None, column=None):
+        expected = [expected] if isinstance(expected, str) else list(expected)
+        rules = list(rules)
+        # The same arguments in args, so that the error pickles.
+        super().__init__(position, expected, rules, line, column)
+        self.position = position
+        self.expected = expected
+        self.rules = rules
+        self.line = line
+        self.column = column
+
+    def __str__(self):
+        where = "line {}, column {}".format(self.line, self.column) if self.line is not None else str(self.position)
+        message = "Expected {} at {}".format(" or ".join(self.expected) or "something else", where)
+        return message + " in " + " > ".join(self.rules) if self.rules else message
+
 
 class Input:
     def ok(self, next, r):
@@ -17,9 +50,29 @@ class Input:
     def fail(self):
         return False, self, None
 
+    def hold(self):
+        "Called before trying something that may backtrack to this position; text from here must stay readable."
+        pass
+
+    def release(self):
+        "Undo one hold()."
+        pass
+
+    def commit(self):
+        """
+        Called at a cut: the sequence it's in won't backtrack before this
+        position, so nothing behind it needs keeping for that sequence.
+        Choices enclosing the sequence still may, so what they hold stays.
+        """
+        pass
+
     def match(self, matcher, grammar):
         raise Exception("abstract")
 
+    def match_as(self, outer, matcher, grammar):
+        "What match() does, for outer, an Input wrapping this one, which matcher then matches against."
+        return matcher.match(grammar, outer)
+
     def match_eof(self):
         raise Exception("abstract")
 
@@ -35,6 +88,10 @@ class Input:
     def position(self):
         raise Exception("abstract")
 
+    def text_to(self, end):
+        "The text from this position to end's, which must still be held."
+        raise Exception("abstract")
+
 
 class TextInput(Input):
     def __init__(self, text, position=0):
@@ -45,22 +102,7 @@ class TextInput(Input):
         return TextInput(self.text, newpos)
 
     def match(self, matcher, grammar):
-        global depth
-        indent = " " * depth
-        if verbose:
-            print("{}Matching {} at {}".format(indent, matcher, self.pos))
-        depth += 1
-        ok, next, r = matcher.match(grammar, self)
-        depth -= 1
-        if verbose:
-            if ok:
-                msg = "{}{} matched at {} up to {} returning {}"
-                start = self.pos
-                end = next.pos
-                print(msg.format(indent, matcher, start, end, r))
-            else:
-                print("{}{} failed at {}".format(indent, matcher, self.pos))
-        return ok, next, r
+        return matcher.match(grammar, self)
 
     def match_eof(self):
         return self.pos >= len(self.text), self, None
@@ -89,6 +131,501 @@ class TextInput(Input):
     def position(self):
         return self.pos
 
+    def text_to(self, end):
+        return self.text[self.pos : end.position()]
+
+
+class BytesInput(TextInput):
+    """
+    Input over bytes, a memoryview or an mmap.mmap, for grammars built
+    with peg.grammar(..., binary=True). Literals and regexes are bytes
+    and match without decoding anything; results stay bytes except what
+    .text() decodes as UTF-8. Characters are byte values, so character
+    predicates get ints.
+    """
+
+    def next(self, newpos):
+        return BytesInput(self.text, newpos)
+
+    def text_to(self, end):
+        return bytes(self.text[self.pos : end.position()])
+
+
+class MmapInput(BytesInput):
+    "BytesInput over a read-only memory map of an open binary file, which may be closed afterwards."
+
+    def __init__(self, file, position=0):
+        if os.fstat(file.fileno()).st_size > 0:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = b""
+        super().__init__(data, position)
+
+
+class TokenInput(TextInput):
+    """
+    TextInput over text a lexer.Lexer has already split into tokens.
+    Token matchers look up the token at their position, so backtracking
+    over tokens doesn't scan them or the whitespace between them again.
+    """
+
+    def __init__(self, tokens, position=0):
+        super().__init__(tokens.text, position)
+        self.tokens = tokens
+
+    def next(self, newpos):
+        return TokenInput(self.tokens, newpos)
+
+
+#
+# Streaming input
+#
+
+
+class StreamBuffer:
+    """
+    Text read so far from a file-like object. Matchers hold() the
+    positions they may backtrack to, and whenever another chunk is read
+    the text before the oldest held position (or the reader's own
+    position) is dropped, since nothing can return there any more.
+    """
+
+    def __init__(self, file, chunk_size=65536):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.text = ""
+        self.offset = 0
+        self.eof = False
+        self.live = {}
+
+    def end(self):
+        return self.offset + len(self.text)
+
+    def fill(self, reader, end):
+        "Read until the buffer reaches absolute position end or the stream runs out. Returns whether it got there."
+        if reader < self.offset:
+            raise ParseError(reader, ["text still in the stream buffer"])
+        while self.end() < end and not self.eof:
+            chunk = self.file.read(self.chunk_size)
+            if chunk:
+                self.discard(reader)
+                self.text += chunk
+            else:
+                self.eof = True
+        return self.end() >= end
+
+    def discard(self, reader):
+        oldest = min(min(self.live, default=reader), reader)
+        if oldest > self.offset:
+            self.text = self.text[oldest - self.offset :]
+            self.offset = oldest
+
+    def commit(self, position):
+        "Drop the text before position now rather than at the next read, unless it's held: choices enclosing a cut can still go back there."
+        self.discard(position)
+
+    def acquire(self, position):
+        self.live[position] = self.live.get(position, 0) + 1
+
+    def release(self, position):
+        if self.live[position] == 1:
+            del self.live[position]
+        else:
+            self.live[position] -= 1
+
+
+@functools.lru_cache(maxsize=None)
+def stream_extent(pattern):
+    "How far past the end of a match and past the start of a failed match the regex pattern can read, or None if that's unbounded."
+    # analysis imports this module.
+    from analysis import regex_extent
+
+    return regex_extent(pattern)[1:]
+
+
+class StreamInput(Input):
+    """
+    Input reading from a file-like object on demand. Memory is bounded by
+    how far the parser backtracks and looks ahead rather than by the size
+    of the stream. Regexes are matched against at least lookahead
+    characters of buffered text, and again with more whenever they could
+    have read past it, as far as analysis.regex_extent can tell. Regexes
+    whose extent it can't bound are retried with more text until the
+    stream ends, so the memory they need is bounded only by the stream.
+    """
+
+    def __init__(self, file, position=0, buffer=None, lookahead=None):
+        self.buffer = StreamBuffer(file) if buffer is None else buffer
+        self.pos = position
+        self.lookahead = self.buffer.chunk_size if lookahead is None else lookahead
+
+    def hold(self):
+        self.buffer.acquire(self.pos)
+
+    def release(self):
+        self.buffer.release(self.pos)
+
+    def commit(self):
+        self.buffer.commit(self.pos)
+
+    def next(self, newpos):
+        return StreamInput(None, newpos, self.buffer, self.lookahead)
+
+    def match(self, matcher, grammar):
+        return matcher.match(grammar, self)
+
+    def match_eof(self):
+        return not self.buffer.fill(self.pos, self.pos + 1), self, None
+
+    def match_string(self, s):
+        end = self.pos + len(s)
+        b = self.buffer
+        if b.fill(self.pos, end) and b.text[self.pos - b.offset : end - b.offset] == s:
+            return self.ok(self.next(end), s)
+        else:
+            return self.fail()
+
+    def match_char_predicate(self, predicate):
+        b = self.buffer
+        if b.fill(self.pos, self.pos + 1) and predicate(c := b.text[self.pos - b.offset]):
+            return self.ok(self.next(self.pos + 1), c)
+        else:
+            return self.fail()
+
+    def match_re(self, regex):
+        b = self.buffer
+        ahead, reach = stream_extent(regex.pattern)
+        want = self.pos + (self.lookahead if reach is None else max(reach, self.lookahead))
+        while True:
+            b.fill(self.pos, want)
+            m = regex.match(b.text, self.pos - b.offset)
+            if b.eof:
+                break
+            # The outcome only stands if the regex can't have read past the buffered text.
+            if m is None:
+                read = None if reach is None else self.pos + reach
+            else:
+                read = None if ahead is None else b.offset + m.end() + ahead
+            if read is not None and read <= b.end():
+                break
+            want = b.end() + max(self.lookahead, b.end() - self.pos)
+        if m is not None:
+            return self.ok(self.next(b.offset + m.end()), m.group(0))
+        else:
+            return self.fail()
+
+    def position(self):
+        return self.pos
+
+    def text_to(self, end):
+        b = self.buffer
+        return b.text[self.pos - b.offset : end.position() - b.offset]
+
+
+#
+# Tracing
+#
+
+# kind is "enter", "exit" or "fail"; rule is the innermost rule being
+# matched; end and result are only set on "exit"; time is from
+# time.perf_counter_ns().
+Event = namedtuple("Event", "kind rule matcher start end result time")
+
+
+class TracingInput(Input):
+    """
+    Input that reports every match to tracer, a callable taking an Event,
+    and otherwise leaves everything to the input it wraps. Anything else
+    asked of it, like the text, is the wrapped input's.
+    """
+
+    def __init__(self, input, tracer, rules=None):
+        self.input = input
+        self.tracer = tracer
+        self.rules = [] if rules is None else rules
+
+    def __getattr__(self, name):
+        return getattr(self.input, name)
+
+    def wrap(self, outcome):
+        ok, next, r = outcome
+        return ok, self if next is self.input else TracingInput(next, self.tracer, self.rules), r
+
+    def next(self, newpos):
+        return TracingInput(self.input.next(newpos), self.tracer, self.rules)
+
+    def hold(self):
+        self.input.hold()
+
+    def release(self):
+        self.input.release()
+
+    def commit(self):
+        self.input.commit()
+
+    def match(self, matcher, grammar):
+        rules = self.rules
+        is_rule = isinstance(matcher, RuleMatcher)
+        if is_rule:
+            rules.append(matcher.expr)
+        rule = rules[-1] if rules else None
+        pos = self.input.position()
+        self.tracer(Event("enter", rule, matcher, pos, None, None, time.perf_counter_ns()))
+        try:
+            ok, next, r = self.input.match_as(self, matcher, grammar)
+        finally:
+            if is_rule:
+                rules.pop()
+        if ok:
+            self.tracer(Event("exit", rule, matcher, pos, next.position(), r, time.perf_counter_ns()))
+        else:
+            self.tracer(Event("fail", rule, matcher, pos, None, None, time.perf_counter_ns()))
+        return ok, next, r
+
+    def match_eof(self):
+        return self.wrap(self.input.match_eof())
+
+    def match_string(self, s):
+        return self.wrap(self.input.match_string(s))
+
+    def match_char_predicate(self, predicate):
+        return self.wrap(self.input.match_char_predicate(predicate))
+
+    def match_re(self, regex):
+        return self.wrap(self.input.match_re(regex))
+
+    def position(self):
+        return self.input.position()
+
+    def text_to(self, end):
+        return self.input.text_to(end.input)
+
+
+class PrintTracer:
+    "Tracer that prints an indented trace of a parse to file, stdout by default."
+
+    def __init__(self, file=None):
+        self.file = file
+        self.depth = 0
+
+    def __call__(self, event):
+        if event.kind == "enter":
+            print("{}Matching {} at {}".format(" " * self.depth, event.matcher, event.start), file=self.file)
+            self.depth += 1
+        else:
+            self.depth -= 1
+            indent = " " * self.depth
+            if event.kind == "exit":
+                msg = "{}{} matched at {} up to {} returning {}"
+                print(msg.format(indent, event.matcher, event.start, event.end, event.result), file=self.file)
+            else:
+                print("{}{} failed at {}".format(indent, event.matcher, event.start), file=self.file)
+
+
+#
+# Packrat memoization
+#
+
+
+class Memo:
+    "Unbounded memo table mapping (rule, position) to (ok, end, result)."
+
+    def __init__(self):
+        self.table = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.table)
+
+    def __str__(self):
+        return "{}(size={}, hits={}, misses={}, evictions={})".format(self.__class__.__name__, len(self), self.hits, self.misses, self.evictions)
+
+    def get(self, key):
+        entry = self.table.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        self.table[key] = entry
+
+    def discard_before(self, position):
+        before = len(self.table)
+        self.table = {k: v for k, v in self.table.items() if k[1] >= position}
+        self.evictions += before - len(self.table)
+
+
+class LRUMemo(Memo):
+    "Memo table holding at most `size` entries, evicting the least recently used."
+
+    def __init__(self, size):
+        super().__init__()
+        self.size = size
+        self.table = OrderedDict()
+
+    def get(self, key):
+        entry = super().get(key)
+        if entry is not None:
+            self.table.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        self.table[key] = entry
+        if len(self.table) > self.size:
+            self.table.popitem(last=False)
+            self.evictions += 1
+
+    def discard_before(self, position):
+        before = len(self.table)
+        self.table = OrderedDict((k, v) for k, v in self.table.items() if k[1] >= position)
+        self.evictions += before - len(self.table)
+
+
+class WindowMemo(Memo):
+    "Memo table that drops entries more than `window` characters behind the farthest position memoized."
+
+    def __init__(self, window):
+        super().__init__()
+        self.window = window
+        self.frontier = 0
+        self.swept = 0
+
+    def put(self, key, entry):
+        self.table[key] = entry
+        position = key[1]
+        if position > self.frontier:
+            self.frontier = position
+            if self.frontier - self.swept > self.window:
+                self.discard_before(self.frontier - self.window)
+                self.swept = self.frontier
+
+
+class PackratInput(TextInput):
+    "TextInput that memoizes the outcome of every rule invocation by (rule, position)."
+
+    def __init__(self, text, position=0, memo=None):
+        super().__init__(text, position)
+        self.memo = Memo() if memo is None else memo
+
+    def next(self, newpos):
+        return PackratInput(self.text, newpos, self.memo)
+
+    def commit(self):
+        self.memo.discard_before(self.pos)
+
+    def match(self, matcher, grammar):
+        return self.match_as(self, matcher, grammar)
+
+    def match_as(self, outer, matcher, grammar):
+        if not isinstance(matcher, RuleMatcher):
+            return matcher.match(grammar, outer)
+
+        key = (matcher.expr, self.pos)
+        entry = self.memo.get(key)
+        if entry is None:
+            ok, next, r = matcher.match(grammar, outer)
+            self.memo.put(key, (ok, next.position(), r))
+            return ok, next, r
+        else:
+            ok, end, r = entry
+            return (ok, outer.next(end), r) if ok else outer.fail()
+
+
+class Context:
+    """
+    Per-parse state for the position-based engine: matchers get (ctx, pos)
+    and return (end, result) or FAIL. Matchers that fail without trying
+    anything else note it with fail() when pos is at least farthest, so a
+    failed parse can say where it got stuck.
+    """
+
+    def __init__(self, grammar, text, tokens=None):
+        self.grammar = grammar
+        self.text = text
+        self.tokens = tokens
+        self.farthest = -1
+        self.expected = []
+        # Rules that have returned since the farthest failure first
+        # happened at farthest and were being matched when it did,
+        # innermost first.
+        self.rules = []
+        # Outcomes of MemoMatchers by (id(matcher), position).
+        self.memo = {}
+
+    def fail(self, pos, matcher):
+        if pos > self.farthest:
+            self.farthest = pos
+            self.expected = [matcher]
+            self.rules = []
+        else:
+            self.expected.append(matcher)
+
+    def error(self, rule, pos):
+        "The ParseError of a parse of rule from pos that failed."
+        if self.farthest < pos:
+            return ParseError(pos, [], [rule], *location(self.text, pos))
+        expected = dict.fromkeys(e for m in self.expected for e in expectations(m))
+        return ParseError(self.farthest, expected, self.rules[::-1] or [rule], *location(self.text, self.farthest))
+
+
+def cut_error(text, pos, expected, rules=()):
+    """
+    The ParseError of what was expected at pos failing to match after a
+    cut. The rules being matched are added to it as it passes through
+    them, if they aren't given.
+    """
+    return ParseError(pos, expected, rules, *location(text, pos))
+
+
+def location(text, pos):
+    "Line and column of pos in text, both counted from 1, or None for both without the text."
+    if text is None:
+        return None, None
+    if isinstance(text, str):
+        newline = "\n"
+    else:
+        # Memoryviews and mmaps can't be searched like bytes.
+        text, newline = bytes(text[:pos]), b"\n"
+    return text.count(newline, 0, pos) + 1, pos - text.rfind(newline, 0, pos)
+
+
+def expectations(m):
+    "How failing matcher m reads in a ParseError: what it would have matched."
+    t = type(m)
+    if t is tuple:
+        # Generated code notes what it expected as a tuple of it.
+        return list(m)
+    elif t is StringMatcher:
+        return [repr(m.expr)]
+    elif t is RegexMatcher or t is RegexSequenceMatcher:
+        return ["/{}/".format(m.expr)]
+    elif t is CharMatcher:
+        return [getattr(m.expr, "__name__", repr(m.expr))]
+    elif t is EofMatcher:
+        return ["end of input"]
+    elif t is AndMatcher:
+        return expectations(m.expr)
+    elif t is NotMatcher:
+        return ["not " + " or ".join(expectations(m.expr))]
+    elif t is TokenMatcher:
+        return expectations(m.matcher)
+    elif t is MemoMatcher:
+        return expectations(m.expr)
+    elif isinstance(m, RuleMatcher):
+        return [m.expr]
+    elif t is DispatchChoiceMatcher or t is ChoiceMatcher:
+        return [e for c in m.expr for e in expectations(c)]
+    elif t is SequenceMatcher:
+        return expectations(m.expr[0])
+    elif t is Builder:
+        return expectations(m.preceeding)
+    else:
+        return [str(m)]
+
 
 class Visitor:
     def visit_builder(self, matcher):
@@ -106,12 +643,18 @@ class Visitor:
     def visit_regex_matcher(self, matcher):
         return matcher
 
+    def visit_regex_sequence_matcher(self, matcher):
+        return matcher
+
     def visit_sequence_matcher(self, matcher):
         return matcher
 
     def visit_choice_matcher(self, matcher):
         return matcher
 
+    def visit_dispatch_choice_matcher(self, matcher):
+        return matcher
+
     def visit_star_matcher(self, matcher):
         return matcher
 
@@ -136,14 +679,85 @@ class Visitor:
     def visit_eof_matcher(self, matcher):
         return matcher
 
+    def visit_cut_matcher(self, matcher):
+        return matcher
+
+    def visit_capture_matcher(self, matcher):
+        return matcher
+
+    def visit_memo_matcher(self, matcher):
+        return matcher
+
     def visit_token_matcher(self, matcher):
         return matcher
 
 
+#
+# Builder functions. These are plain classes rather than closures so that
+# other tools (code generation, pickling) can see what they do.
+#
+
+
+class Index:
+    def __init__(self, i):
+        self.i = i
+
+    def __call__(self, r):
+        return r[self.i]
+
+    def __repr__(self):
+        return "Index({})".format(self.i)
+
+
+class Constant:
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self, _):
+        return self.value
+
+    def __repr__(self):
+        return "Constant({!r})".format(self.value)
+
+
+class Join:
+    def __init__(self, fn=None):
+        self.fn = fn
+
+    def __call__(self, r):
+        s = text(r)
+        return s if self.fn is None else self.fn(s)
+
+    def __repr__(self):
+        return "Join({})".format("" if self.fn is None else getattr(self.fn, "__name__", self.fn))
+
+
+class Compose:
+    "Applies first, then then: the functions of a Builder of a Builder."
+
+    def __init__(self, first, then):
+        self.first = first
+        self.then = then
+
+    def __call__(self, r):
+        return self.then(self.first(r))
+
+    def __repr__(self):
+        return "Compose({!r}, {!r})".format(self.first, self.then)
+
+
 class Matcher:
     def match(self, grammar, input):
         pass
 
+    def match_at(self, ctx, pos):
+        ok, next, r = self.match(ctx.grammar, TextInput(ctx.text, pos))
+        return (next.position(), r) if ok else FAIL
+
+    def skip_at(self, ctx, pos):
+        "Like match_at, but only the end position (or -1) is wanted, so no result needs building."
+        return self.match_at(ctx, pos)[0]
+
     def then(self, expr):
         return SequenceMatcher([self, match(expr)])
 
@@ -151,16 +765,12 @@ class Matcher:
         if callable(x):
             return Builder(self, x)
         elif isinstance(x, int):
-            return Builder(self, lambda r: r[x])
+            return Builder(self, Index(x))
         else:
-            return Builder(self, lambda _: x)
+            return Builder(self, Constant(x))
 
     def text(self, fn=None):
-        def extract(r):
-            s = "".join(x for x in r if x is not None)
-            return s if fn is None else fn(s)
-
-        return Builder(self, extract)
+        return Builder(self, Join(fn))
 
     def accept(self, visitor):
         raise Exception("accept not implemented")
@@ -198,6 +808,13 @@ class Builder(Matcher):
         else:
             return input.fail()
 
+    def match_at(self, ctx, pos):
+        end, r = self.preceeding.match_at(ctx, pos)
+        return (end, self.fn(r)) if end >= 0 else FAIL
+
+    def skip_at(self, ctx, pos):
+        return self.preceeding.skip_at(ctx, pos)
+
     def accept(self, visitor):
         new_p = self.preceeding.accept(visitor)
         b = self if new_p == self.preceeding else Builder(new_p, self.fn)
@@ -205,15 +822,97 @@ class Builder(Matcher):
 
 
 class RuleMatcher(SingleExprMatcher):
+    """
+    Reference to rule expr of the grammar. Rules note themselves in
+    ctx.rules when the farthest failure so far happened while they were
+    being matched, and in the rules of the ParseError of a failed cut
+    passing through them, so that errors can say where they happened.
+    """
+
     def match(self, grammar, input):
-        return input.match(grammar[self.expr], grammar)
+        try:
+            return input.match(grammar[self.expr], grammar)
+        except ParseError as e:
+            e.rules.insert(0, self.expr)
+            raise
+
+    def match_at(self, ctx, pos):
+        farthest = ctx.farthest
+        try:
+            result = ctx.grammar[self.expr].match_at(ctx, pos)
+        except ParseError as e:
+            e.rules.insert(0, self.expr)
+            raise
+        if ctx.farthest > farthest:
+            ctx.rules.append(self.expr)
+        return result
+
+    def skip_at(self, ctx, pos):
+        farthest = ctx.farthest
+        try:
+            end = ctx.grammar[self.expr].skip_at(ctx, pos)
+        except ParseError as e:
+            e.rules.insert(0, self.expr)
+            raise
+        if ctx.farthest > farthest:
+            ctx.rules.append(self.expr)
+        return end
 
     def accept(self, visitor):
         return visitor.visit_rule_matcher(self)
 
 
+class LinkedRule(RuleMatcher):
+    """
+    Reference to rule expr bound to its matcher by optimize.link, so it
+    isn't looked up by name every time. Visiting it gives a plain
+    RuleMatcher: rules rewritten by a pass need linking again.
+    """
+
+    def __init__(self, expr, target=None):
+        super().__init__(expr)
+        self.target = target
+
+    def __str__(self):
+        return "RuleMatcher({})".format(self.expr)
+
+    def match(self, grammar, input):
+        try:
+            return input.match(self.target, grammar)
+        except ParseError as e:
+            e.rules.insert(0, self.expr)
+            raise
+
+    def match_at(self, ctx, pos):
+        farthest = ctx.farthest
+        try:
+            result = self.target.match_at(ctx, pos)
+        except ParseError as e:
+            e.rules.insert(0, self.expr)
+            raise
+        if ctx.farthest > farthest:
+            ctx.rules.append(self.expr)
+        return result
+
+    def skip_at(self, ctx, pos):
+        farthest = ctx.farthest
+        try:
+            end = self.target.skip_at(ctx, pos)
+        except ParseError as e:
+            e.rules.insert(0, self.expr)
+            raise
+        if ctx.farthest > farthest:
+            ctx.rules.append(self.expr)
+        return end
+
+    def accept(self, visitor):
+        return visitor.visit_rule_matcher(RuleMatcher(self.expr))
+
+
 class StringMatcher(SingleExprMatcher):
     def _expr_str(self):
+        if type(self.expr) is bytes:
+            return repr(self.expr)
         escaped = self.expr.replace("\r", "\\r")
         escaped = escaped.replace("\n", "\\n")
         escaped = escaped.replace("\t", "\\t")
@@ -222,6 +921,23 @@ class StringMatcher(SingleExprMatcher):
     def match(self, grammar, input):
         return input.match_string(self.expr)
 
+    def match_at(self, ctx, pos):
+        s = self.expr
+        end = pos + len(s)
+        if ctx.text[pos:end] == s:
+            return end, s
+        if pos >= ctx.farthest:
+            ctx.fail(pos, self)
+        return FAIL
+
+    def skip_at(self, ctx, pos):
+        end = pos + len(self.expr)
+        if ctx.text[pos:end] == self.expr:
+            return end
+        if pos >= ctx.farthest:
+            ctx.fail(pos, self)
+        return -1
+
     def accept(self, visitor):
         return visitor.visit_string_matcher(self)
 
@@ -230,6 +946,22 @@ class CharMatcher(SingleExprMatcher):
     def match(self, grammar, input):
         return input.match_char_predicate(self.expr)
 
+    def match_at(self, ctx, pos):
+        text = ctx.text
+        if pos < len(text) and self.expr(text[pos]):
+            return pos + 1, text[pos]
+        if pos >= ctx.farthest:
+            ctx.fail(pos, self)
+        return FAIL
+
+    def skip_at(self, ctx, pos):
+        text = ctx.text
+        if pos < len(text) and self.expr(text[pos]):
+            return pos + 1
+        if pos >= ctx.farthest:
+            ctx.fail(pos, self)
+        return -1
+
     def accept(self, visitor):
         return visitor.visit_char_matcher(self)
 
@@ -242,11 +974,62 @@ class RegexMatcher(SingleExprMatcher):
     def match(self, grammar, input):
         return input.match_re(self.re)
 
+    def match_at(self, ctx, pos):
+        if (m := self.re.match(ctx.text, pos)) is not None:
+            return m.end(), m.group(0)
+        if pos >= ctx.farthest:
+            ctx.fail(pos, self)
+        return FAIL
+
+    def skip_at(self, ctx, pos):
+        if (m := self.re.match(ctx.text, pos)) is not None:
+            return m.end()
+        if pos >= ctx.farthest:
+            ctx.fail(pos, self)
+        return -1
+
     def accept(self, visitor):
         return visitor.visit_regex_matcher(self)
 
 
+class RegexSequenceMatcher(RegexMatcher):
+    "A sequence of literals and regexes matched by one regex. Values are literal strings or the numbers of the groups holding each element's text."
+
+    def __init__(self, pattern, values):
+        super().__init__(pattern)
+        self.values = values
+
+    def __eq__(self, other):
+        return type(self) == type(other) and self.expr == other.expr and self.values == other.values
+
+    def __hash__(self):
+        return hash((type(self), self.expr, tuple(self.values)))
+
+    def _result(self, m):
+        r = [m.group(v) if type(v) is int else v for v in self.values]
+        return r if len(r) > 1 else r[0]
+
+    def match(self, grammar, input):
+        ok, next, s = input.match_re(self.re)
+        return input.ok(next, self._result(self.re.match(s))) if ok else input.fail()
+
+    def match_at(self, ctx, pos):
+        if (m := self.re.match(ctx.text, pos)) is not None:
+            return m.end(), self._result(m)
+        if pos >= ctx.farthest:
+            ctx.fail(pos, self)
+        return FAIL
+
+    def accept(self, visitor):
+        return visitor.visit_regex_sequence_matcher(self)
+
+
 class SequenceMatcher(SingleExprMatcher):
+    def __init__(self, expr):
+        super().__init__(expr)
+        # Index of the first cut; elements after it failing is an error.
+        self.cut = next((i for i, e in enumerate(expr) if type(e) is CutMatcher), None)
+
     def _expr_str(self):
         return ", ".join(str(e) for e in self.expr)
 
@@ -256,15 +1039,52 @@ class SequenceMatcher(SingleExprMatcher):
     def match(self, grammar, input):
         results = []
         new_input = input
-        for e in self.expr:
+        for i, e in enumerate(self.expr):
             ok, new_input, r = new_input.match(e, grammar)
             if ok:
                 if r != Nothing:
                     results.append(r)
+            elif self.cut is not None and i > self.cut:
+                raise cut_error(getattr(input, "text", None), new_input.position(), expectations(e))
             else:
                 return input.fail()
         return input.ok(new_input, results if len(results) > 1 else results[0])
 
+    def match_at(self, ctx, pos):
+        if self.cut is not None:
+            return self.match_cut_at(ctx, pos)
+        results = []
+        for e in self.expr:
+            pos, r = e.match_at(ctx, pos)
+            if pos < 0:
+                return FAIL
+            if r != Nothing:
+                results.append(r)
+        return pos, results if len(results) > 1 else results[0]
+
+    def match_cut_at(self, ctx, pos):
+        results = []
+        for i, e in enumerate(self.expr):
+            end, r = e.match_at(ctx, pos)
+            if end < 0:
+                if i > self.cut:
+                    raise cut_error(ctx.text, pos, expectations(e))
+                return FAIL
+            pos = end
+            if r != Nothing:
+                results.append(r)
+        return pos, results if len(results) > 1 else results[0]
+
+    def skip_at(self, ctx, pos):
+        for i, e in enumerate(self.expr):
+            end = e.skip_at(ctx, pos)
+            if end < 0:
+                if self.cut is not None and i > self.cut:
+                    raise cut_error(ctx.text, pos, expectations(e))
+                return -1
+            pos = end
+        return pos
+
     def accept(self, visitor):
         m = SequenceMatcher([e.accept(visitor) for e in self.expr])
         return visitor.visit_sequence_matcher(m)
@@ -275,22 +1095,83 @@ class ChoiceMatcher(SingleExprMatcher):
         return ", ".join(str(c) for c in self.expr)
 
     def match(self, grammar, input):
+        input.hold()
         for c in self.expr:
             ok, next, result = input.match(c, grammar)
             if ok:
+                input.release()
                 return input.ok(next, result)
+        input.release()
         return input.fail()
 
+    def match_at(self, ctx, pos):
+        for c in self.expr:
+            result = c.match_at(ctx, pos)
+            if result[0] >= 0:
+                return result
+        return FAIL
+
+    def skip_at(self, ctx, pos):
+        for c in self.expr:
+            end = c.skip_at(ctx, pos)
+            if end >= 0:
+                return end
+        return -1
+
     def accept(self, visitor):
         m = ChoiceMatcher([c.accept(visitor) for c in self.expr])
         return visitor.visit_choice_matcher(m)
 
 
+class DispatchChoiceMatcher(ChoiceMatcher):
+    """
+    Ordered choice that only tries the alternatives that can start with
+    the next character. table maps characters to the indices of those
+    alternatives; default lists the ones to try for any other character
+    and at the end of input.
+    """
+
+    def __init__(self, expr, table, default):
+        super().__init__(expr)
+        self.table = table
+        self.default = default
+        self.candidates = {c: [expr[i] for i in indices] for c, indices in table.items()}
+        self.fallback = [expr[i] for i in default]
+
+    def match_at(self, ctx, pos):
+        text = ctx.text
+        alternatives = self.candidates.get(text[pos], self.fallback) if pos < len(text) else self.fallback
+        for c in alternatives:
+            result = c.match_at(ctx, pos)
+            if result[0] >= 0:
+                return result
+        if not alternatives and pos >= ctx.farthest:
+            ctx.fail(pos, self)
+        return FAIL
+
+    def skip_at(self, ctx, pos):
+        text = ctx.text
+        alternatives = self.candidates.get(text[pos], self.fallback) if pos < len(text) else self.fallback
+        for c in alternatives:
+            end = c.skip_at(ctx, pos)
+            if end >= 0:
+                return end
+        if not alternatives and pos >= ctx.farthest:
+            ctx.fail(pos, self)
+        return -1
+
+    def accept(self, visitor):
+        m = DispatchChoiceMatcher([c.accept(visitor) for c in self.expr], self.table, self.default)
+        return visitor.visit_dispatch_choice_matcher(m)
+
+
 class StarMatcher(SingleExprMatcher):
     def match(self, grammar, input):
         results = []
         while True:
+            input.hold()
             ok, next, r = input.match(self.expr, grammar)
+            input.release()
             assert next.position() > input.position() if ok else True
             if ok:
                 results.append(r)
@@ -300,6 +1181,24 @@ class StarMatcher(SingleExprMatcher):
                 break
         return input.ok(input, results)
 
+    def match_at(self, ctx, pos):
+        results = []
+        expr = self.expr
+        while True:
+            end, r = expr.match_at(ctx, pos)
+            if end < 0:
+                return pos, results
+            assert end > pos
+            results.append(r)
+            pos = end
+
+    def skip_at(self, ctx, pos):
+        expr = self.expr
+        while (end := expr.skip_at(ctx, pos)) >= 0:
+            assert end > pos
+            pos = end
+        return pos
+
     def accept(self, visitor):
         new_expr = self.expr.accept(visitor)
         m = self if new_expr == self.expr else StarMatcher(new_expr)
@@ -311,7 +1210,9 @@ class PlusMatcher(SingleExprMatcher):
         results = []
         new_input = input
         while True:
+            new_input.hold()
             ok, next, r = new_input.match(self.expr, grammar)
+            new_input.release()
             if ok:
                 results.append(r)
                 new_input = next
@@ -323,6 +1224,24 @@ class PlusMatcher(SingleExprMatcher):
         else:
             return input.fail()
 
+    def match_at(self, ctx, pos):
+        results = []
+        expr = self.expr
+        while True:
+            end, r = expr.match_at(ctx, pos)
+            if end < 0:
+                return (pos, results) if results else FAIL
+            results.append(r)
+            pos = end
+
+    def skip_at(self, ctx, pos):
+        expr = self.expr
+        if (pos := expr.skip_at(ctx, pos)) < 0:
+            return -1
+        while (end := expr.skip_at(ctx, pos)) >= 0:
+            pos = end
+        return pos
+
     def accept(self, visitor):
         new_expr = self.expr.accept(visitor)
         m = self if new_expr == self.expr else PlusMatcher(new_expr)
@@ -331,12 +1250,22 @@ class PlusMatcher(SingleExprMatcher):
 
 class OptionalMatcher(SingleExprMatcher):
     def match(self, grammar, input):
+        input.hold()
         ok, next, r = input.match(self.expr, grammar)
+        input.release()
         if ok:
             return input.ok(next, r)
         else:
             return input.ok(input, None)
 
+    def match_at(self, ctx, pos):
+        result = self.expr.match_at(ctx, pos)
+        return result if result[0] >= 0 else (pos, None)
+
+    def skip_at(self, ctx, pos):
+        end = self.expr.skip_at(ctx, pos)
+        return end if end >= 0 else pos
+
     def accept(self, visitor):
         new_expr = self.expr.accept(visitor)
         m = self if new_expr == self.expr else OptionalMatcher(new_expr)
@@ -345,12 +1274,26 @@ class OptionalMatcher(SingleExprMatcher):
 
 class AndMatcher(SingleExprMatcher):
     def match(self, grammar, input):
+        input.hold()
         ok, _, _ = input.match(self.expr, grammar)
+        input.release()
         if ok:
             return input.ok(input, Nothing)
         else:
             return input.fail()
 
+    def match_at(self, ctx, pos):
+        # What fails inside a lookahead is only expected as part of it.
+        farthest = ctx.farthest
+        ctx.farthest = sys.maxsize
+        end = self.expr.skip_at(ctx, pos)
+        ctx.farthest = farthest
+        if end >= 0:
+            return pos, Nothing
+        if pos >= farthest:
+            ctx.fail(pos, self)
+        return FAIL
+
     def accept(self, visitor):
         new_expr = self.expr.accept(visitor)
         m = self if new_expr == self.expr else AndMatcher(new_expr)
@@ -359,12 +1302,25 @@ class AndMatcher(SingleExprMatcher):
 
 class NotMatcher(SingleExprMatcher):
     def match(self, grammar, input):
+        input.hold()
         ok, _, _ = input.match(self.expr, grammar)
+        input.release()
         if not ok:
             return input.ok(input, Nothing)
         else:
             return input.fail()
 
+    def match_at(self, ctx, pos):
+        farthest = ctx.farthest
+        ctx.farthest = sys.maxsize
+        end = self.expr.skip_at(ctx, pos)
+        ctx.farthest = farthest
+        if end < 0:
+            return pos, Nothing
+        if pos >= farthest:
+            ctx.fail(pos, self)
+        return FAIL
+
     def accept(self, visitor):
         new_expr = self.expr.accept(visitor)
         m = self if new_expr == self.expr else NotMatcher(new_expr)
@@ -379,6 +1335,13 @@ class NothingMatcher(SingleExprMatcher):
         else:
             return input.fail()
 
+    def match_at(self, ctx, pos):
+        end = self.expr.skip_at(ctx, pos)
+        return (end, Nothing) if end >= 0 else FAIL
+
+    def skip_at(self, ctx, pos):
+        return self.expr.skip_at(ctx, pos)
+
     def accept(self, visitor):
         new_expr = self.expr.accept(visitor)
         m = self if new_expr == self.expr else NothingMatcher(new_expr)
@@ -392,6 +1355,9 @@ class ImplicitMatcher(Matcher):
     def match(self, grammar, input):
         return input.ok(input, self.value)
 
+    def match_at(self, ctx, pos):
+        return pos, self.value
+
     def accept(self, visitor):
         return visitor.visit_implicit_matcher(self)
 
@@ -412,15 +1378,55 @@ class EofMatcher(Matcher):
     def match(self, grammar, input):
         return input.match_eof()
 
+    def match_at(self, ctx, pos):
+        if pos >= len(ctx.text):
+            return pos, None
+        if pos >= ctx.farthest:
+            ctx.fail(pos, self)
+        return FAIL
+
     def accept(self, visitor):
         return visitor.visit_eof_matcher(self)
 
 
+class CutMatcher(Matcher):
+    """
+    Matches nothing, committing its sequence to what it has matched so
+    far. Anything after the cut in the same sequence failing to match
+    raises ParseError instead of backtracking, and inputs and memo tables
+    may forget what they kept for returning to positions before it,
+    except what choices enclosing the sequence hold to go back to.
+    """
+
+    def __eq__(self, other):
+        return type(self) == type(other)
+
+    def __hash__(self):
+        return hash(type(self))
+
+    def __str__(self):
+        return "CutMatcher()"
+
+    def match(self, grammar, input):
+        input.commit()
+        return input.ok(input, Nothing)
+
+    def match_at(self, ctx, pos):
+        # MemoMatcher outcomes before the cut can't be looked up again.
+        for key in [key for key in ctx.memo if key[1] < pos]:
+            del ctx.memo[key]
+        return pos, Nothing
+
+    def accept(self, visitor):
+        return visitor.visit_cut_matcher(self)
+
+
 class TokenMatcher(Matcher):
     def __init__(self, matcher, ignore):
         self.matcher = matcher
         self.ignore = ignore
-        self.m = star(ignore).then(matcher).then(star(ignore)).returning(1)
+        self.space = star(ignore)
+        self.m = self.space.then(matcher).then(self.space).returning(1)
 
     def __eq__(self, other):
         return type(self) == type(other) and self.matcher == other.matcher and self.ignore == other.ignore
@@ -436,12 +1442,372 @@ class TokenMatcher(Matcher):
     def match(self, grammar, input):
         return input.match(self.m, grammar)
 
+    def match_at(self, ctx, pos):
+        if ctx.tokens is not None:
+            return ctx.tokens.match(self, ctx, pos)
+        end, r = self.matcher.match_at(ctx, skip_space(self.space, ctx, pos))
+        if end < 0:
+            return FAIL
+        if r is Nothing:
+            # Sequences leave Nothing out, so m's value is what the whitespace after the token matched.
+            farthest = ctx.farthest
+            ctx.farthest = sys.maxsize
+            result = self.space.match_at(ctx, end)
+            ctx.farthest = farthest
+            return result
+        return skip_space(self.space, ctx, end), r
+
+    def skip_at(self, ctx, pos):
+        if ctx.tokens is not None:
+            return ctx.tokens.match(self, ctx, pos)[0]
+        end = self.matcher.skip_at(ctx, skip_space(self.space, ctx, pos))
+        return skip_space(self.space, ctx, end) if end >= 0 else -1
+
     def accept(self, visitor):
         new_m = self.matcher.accept(visitor)
         new_i = self.ignore.accept(visitor)
         return visitor.visit_token_matcher(TokenMatcher(new_m, new_i))
 
 
+class CaptureMatcher(SingleExprMatcher):
+    """
+    The text matched by expr, sliced from the input rather than joined
+    from expr's results, which are never built.
+    """
+
+    def match(self, grammar, input):
+        input.hold()
+        ok, next, _ = input.match(self.expr, grammar)
+        r = input.text_to(next) if ok else None
+        input.release()
+        return input.ok(next, r) if ok else input.fail()
+
+    def match_at(self, ctx, pos):
+        end = self.expr.skip_at(ctx, pos)
+        if end < 0:
+            return FAIL
+        r = ctx.text[pos:end]
+        # Slices of a memoryview are views into it; the result is bytes like any other.
+        return end, bytes(r) if type(r) is memoryview else r
+
+    def skip_at(self, ctx, pos):
+        return self.expr.skip_at(ctx, pos)
+
+    def accept(self, visitor):
+        new_expr = self.expr.accept(visitor)
+        m = self if new_expr == self.expr else CaptureMatcher(new_expr)
+        return visitor.visit_capture_matcher(m)
+
+
+class MemoMatcher(SingleExprMatcher):
+    """
+    Rule body expr whose outcome at each position is kept for the rest
+    of the parse, so matching it there again is a lookup: packrat
+    parsing for just the rules worth it. Only the position-based engines
+    memoize; parses of Inputs leave that to PackratInput.
+    """
+
+    def match(self, grammar, input):
+        return self.expr.match(grammar, input)
+
+    def match_at(self, ctx, pos):
+        key = (id(self), pos)
+        result = ctx.memo.get(key)
+        if result is None:
+            result = ctx.memo[key] = self.expr.match_at(ctx, pos)
+        return result
+
+    def skip_at(self, ctx, pos):
+        result = ctx.memo.get((id(self), pos))
+        return self.expr.skip_at(ctx, pos) if result is None else result[0]
+
+    def accept(self, visitor):
+        new_expr = self.expr.accept(visitor)
+        m = self if new_expr == self.expr else MemoMatcher(new_expr)
+        return visitor.visit_memo_matcher(m)
+
+
+def skip_space(space, ctx, pos):
+    "Match whitespace like space.skip_at, without noting what failed: there could always have been more of it."
+    farthest = ctx.farthest
+    ctx.farthest = sys.maxsize
+    end = space.skip_at(ctx, pos)
+    ctx.farthest = farthest
+    return end
+
+
+#
+# Deferred actions
+#
+
+# Value of an Action that hasn't been applied yet.
+Pending = object()
+
+
+class Action:
+    "A Builder function and the result it will be applied to once the parse has succeeded."
+
+    __slots__ = ("fn", "r", "value")
+
+    def __init__(self, fn, r):
+        self.fn = fn
+        self.r = r
+        self.value = Pending
+
+    def __repr__(self):
+        return "Action({!r}, {!r})".format(self.fn, self.r)
+
+
+class Defer:
+    "Builder function recording fn and its argument as an Action instead of calling it."
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __call__(self, r):
+        return Action(self.fn, r)
+
+    def __repr__(self):
+        return "Defer({!r})".format(self.fn)
+
+
+class Deferred(dict):
+    "Rules whose Builder functions are deferred; parse() applies them to the result of a successful parse."
+
+
+class Deferral(Visitor):
+    # Constant ignores the result, which may not have been built yet. Index
+    # can't be applied early since the result may be an Action.
+    def visit_builder(self, m):
+        if type(m.fn) in (Constant, Defer):
+            return m
+        return Builder(m.preceeding, Defer(m.fn))
+
+
+def defer(grammar):
+    """
+    The rules of grammar with their Builder functions applied only once
+    a parse succeeds, so that alternatives which are matched and then
+    abandoned don't build anything. Results are the same as grammar's
+    as long as its functions have no side effects.
+    """
+    deferral = Deferral()
+    return Deferred({name: rule.accept(deferral) for name, rule in getattr(grammar, "rules", grammar).items()})
+
+
+def force(r):
+    """
+    r with every Action in it replaced by its value, innermost first.
+    Lists of results are updated in place, and each Action is applied
+    once even if memoization shared it between several places.
+    """
+    if type(r) is Action:
+        holder = [r]
+        force(holder)
+        return holder[0]
+    if type(r) is not list:
+        return r
+
+    # Frames are (items, index to look at next, Action whose argument
+    # items holds, list and index its value goes to).
+    stack = [[r, 0, None, None, 0]]
+    while stack:
+        frame = stack[-1]
+        items, i = frame[0], frame[1]
+        if i == len(items):
+            stack.pop()
+            action = frame[2]
+            if action is not None:
+                action.value = action.fn(items[0])
+                action.r = None
+                frame[3][frame[4]] = action.value
+            continue
+        frame[1] = i + 1
+        x = items[i]
+        if type(x) is Action:
+            if x.value is Pending:
+                stack.append([[x.r], 0, x, items, i])
+            else:
+                items[i] = x.value
+        elif type(x) is list:
+            stack.append([x, 0, None, None, 0])
+    return r
+
+
+#
+# Explicit-stack engine
+#
+
+
+def match_stack(matcher, ctx, pos):
+    """
+    Match like matcher.match_at(ctx, pos), keeping the matchers in
+    progress on a list instead of the Python call stack so that nesting
+    is only limited by memory. Each frame is the matcher, the position
+    it resumes from, the index of the element or alternative being
+    tried, and the results or alternatives. Matcher types other than
+    the ones here are matched with their own match_at.
+    """
+    grammar = ctx.grammar
+    text = ctx.text
+    stack = []
+    m = matcher
+    while True:
+        # Descend into m until something gives a result.
+        while True:
+            t = type(m)
+            if t is StringMatcher:
+                e = m.expr
+                end, r = (pos + len(e), e) if text[pos : pos + len(e)] == e else FAIL
+                if end < 0 and pos >= ctx.farthest:
+                    ctx.fail(pos, m)
+                break
+            elif t is RegexMatcher:
+                found = m.re.match(text, pos)
+                end, r = (found.end(), found.group(0)) if found is not None else FAIL
+                if end < 0 and pos >= ctx.farthest:
+                    ctx.fail(pos, m)
+                break
+            elif t is RuleMatcher:
+                # Rules get frames of their own only to say which are being matched when something fails.
+                stack.append([m, ctx.farthest])
+                m = grammar[m.expr]
+            elif t is LinkedRule:
+                stack.append([m, ctx.farthest])
+                m = m.target
+            elif t is TokenMatcher:
+                if ctx.tokens is not None:
+                    end, r = ctx.tokens.match(m, ctx, pos)
+                    break
+                stack.append([m, pos])
+                pos = skip_space(m.space, ctx, pos)
+                m = m.matcher
+            elif t is SequenceMatcher:
+                stack.append([m, pos, 0, []])
+                m = m.expr[0]
+            elif t is ChoiceMatcher or t is DispatchChoiceMatcher:
+                if t is ChoiceMatcher:
+                    alternatives = m.expr
+                else:
+                    alternatives = m.candidates.get(text[pos], m.fallback) if pos < len(text) else m.fallback
+                if not alternatives:
+                    end, r = FAIL
+                    if pos >= ctx.farthest:
+                        ctx.fail(pos, m)
+                    break
+                stack.append([m, pos, 0, alternatives])
+                m = alternatives[0]
+            elif t is StarMatcher or t is PlusMatcher:
+                stack.append([m, pos, 0, []])
+                m = m.expr
+            elif t is Builder:
+                stack.append([m, pos])
+                m = m.preceeding
+            elif t is OptionalMatcher or t is NothingMatcher or t is CaptureMatcher:
+                stack.append([m, pos])
+                m = m.expr
+            elif t is AndMatcher or t is NotMatcher:
+                # Failures inside the lookahead aren't noted, as in AndMatcher.match_at.
+                stack.append([m, pos, ctx.farthest])
+                ctx.farthest = sys.maxsize
+                m = m.expr
+            elif t is MemoMatcher:
+                result = ctx.memo.get((id(m), pos))
+                if result is not None:
+                    end, r = result
+                    break
+                stack.append([m, pos])
+                m = m.expr
+            else:
+                end, r = m.match_at(ctx, pos)
+                break
+
+        # Hand the result up until a frame has something else to try.
+        while stack:
+            frame = stack[-1]
+            f = frame[0]
+            t = type(f)
+            if t is SequenceMatcher:
+                i = frame[2]
+                if end < 0:
+                    if f.cut is not None and i > f.cut:
+                        rules = [g[0].expr for g in stack if type(g[0]) is RuleMatcher or type(g[0]) is LinkedRule]
+                        raise cut_error(text, frame[1], expectations(f.expr[i]), rules)
+                    stack.pop()
+                    continue
+                results = frame[3]
+                if r != Nothing:
+                    results.append(r)
+                if i + 1 < len(f.expr):
+                    frame[1] = pos = end
+                    frame[2] = i + 1
+                    m = f.expr[i + 1]
+                    break
+                stack.pop()
+                r = results if len(results) > 1 else results[0]
+            elif t is ChoiceMatcher or t is DispatchChoiceMatcher:
+                if end < 0 and frame[2] + 1 < len(frame[3]):
+                    frame[2] += 1
+                    pos = frame[1]
+                    m = frame[3][frame[2]]
+                    break
+                stack.pop()
+            elif t is StarMatcher or t is PlusMatcher:
+                if end < 0:
+                    stack.pop()
+                    end, r = FAIL if t is PlusMatcher and not frame[3] else (frame[1], frame[3])
+                    continue
+                if t is StarMatcher:
+                    assert end > frame[1]
+                frame[3].append(r)
+                frame[1] = pos = end
+                m = f.expr
+                break
+            elif t is Builder:
+                stack.pop()
+                if end >= 0:
+                    r = f.fn(r)
+            elif t is OptionalMatcher:
+                stack.pop()
+                if end < 0:
+                    end, r = frame[1], None
+            elif t is TokenMatcher:
+                stack.pop()
+                if end >= 0:
+                    if r is Nothing:
+                        farthest = ctx.farthest
+                        ctx.farthest = sys.maxsize
+                        end, r = f.space.match_at(ctx, end)
+                        ctx.farthest = farthest
+                    else:
+                        end = skip_space(f.space, ctx, end)
+            elif t is AndMatcher or t is NotMatcher:
+                stack.pop()
+                ctx.farthest = frame[2]
+                end, r = (frame[1], Nothing) if (end >= 0) == (t is AndMatcher) else FAIL
+                if end < 0 and frame[1] >= ctx.farthest:
+                    ctx.fail(frame[1], f)
+            elif t is MemoMatcher:
+                stack.pop()
+                ctx.memo[(id(f), frame[1])] = (end, r)
+            elif t is RuleMatcher or t is LinkedRule:
+                stack.pop()
+                if ctx.farthest > frame[1]:
+                    ctx.rules.append(f.expr)
+            elif t is CaptureMatcher:
+                stack.pop()
+                if end >= 0:
+                    r = text[frame[1] : end]
+                    if type(r) is memoryview:
+                        r = bytes(r)
+            else:
+                stack.pop()
+                if end >= 0:
+                    r = Nothing
+        else:
+            return end, r
+
+
 #
 # API
 #
@@ -496,12 +1862,156 @@ def regex(pattern):
     return RegexMatcher(pattern)
 
 
-def text(r):
-    return "".join(x for x in r if x is not None)
+def cut():
+    return CutMatcher()
+
 
+def capture(expr):
+    return CaptureMatcher(match(expr))
 
-def parse(grammar, init, input):
-    return input.match(grammar[init], grammar)
+
+def text(r):
+    try:
+        return "".join(x for x in r if x is not None)
+    except TypeError:
+        # Results from BytesInput: bytes, or ints from character predicates.
+        data = bytearray()
+        for x in r:
+            if type(x) is int:
+                data.append(x)
+            elif type(x) is str:
+                data += x.encode()
+            elif x is not None:
+                data += x
+        return data.decode()
+
+
+def parse(grammar, init, input, tracer=None, engine="recursive"):
+    """
+    Match rule init of grammar against input, returning (ok, next input,
+    result). The result of a failed parse of a TextInput, BytesInput,
+    MmapInput or TokenInput is a ParseError for the farthest position
+    anything failed to match at, with the rules being matched when it
+    first did; other inputs give None. tracer, if given, is
+    called with an Event for every match, which only the recursive
+    engine can do, through the input. engine "stack" matches plain
+    text or bytes input without recursing in Python, for deeply nested
+    input. Rules from defer() get their Builder functions applied here,
+    after the parse.
+
+    Everything a parse changes is in its input and Context, never the
+    grammar or this module, so parses in different threads can share a
+    grammar and each have their own tracer.
+    """
+    ok, next, r = run(grammar, init, input, tracer, engine)
+    if ok and type(grammar) is Deferred:
+        r = force(r)
+    return ok, next, r
+
+
+def run(grammar, init, input, tracer, engine):
+    if tracer is not None:
+        if engine == "stack":
+            raise ValueError("The stack engine can't trace a parse; use the recursive engine with a tracer")
+        input = TracingInput(input, tracer)
+
+    if engine == "stack":
+        if type(input) not in (TextInput, BytesInput, MmapInput, TokenInput):
+            raise ValueError("The stack engine needs a TextInput, BytesInput, MmapInput or TokenInput, not {}".format(type(input).__name__))
+        ctx = Context(grammar, input.text, getattr(input, "tokens", None))
+        end, r = match_stack(RuleMatcher(init), ctx, input.pos)
+        return input.ok(input.next(end), r) if end >= 0 else (False, input, ctx.error(init, input.pos))
+    elif engine != "recursive":
+        raise ValueError("Unknown engine {!r}".format(engine))
+
+    if type(input) in (TextInput, BytesInput, MmapInput, TokenInput):
+        # Plain text and bytes input take the position-based path, which allocates no Input objects.
+        ctx = Context(grammar, input.text, getattr(input, "tokens", None))
+        end, r = RuleMatcher(init).match_at(ctx, input.pos)
+        return input.ok(input.next(end), r) if end >= 0 else (False, input, ctx.error(init, input.pos))
+    else:
+        return input.match(RuleMatcher(init), grammar)
+
+
+def diagnose(grammar, init, input):
+    """
+    The ParseError of rule init of grammar failing to match input, for
+    engines that don't keep track of what failed where: the rule is
+    matched again by the interpreter to find out.
+    """
+    ctx = Context(grammar, input.text, getattr(input, "tokens", None))
+    try:
+        RuleMatcher(init).skip_at(ctx, input.pos)
+    except RecursionError:
+        pass
+    return ctx.error(init, input.pos)
+
+
+def repetition(grammar, init):
+    "The StarMatcher or PlusMatcher that is rule init's body, for parsing it one element at a time."
+    m = grammar[init]
+    while isinstance(m, RuleMatcher):
+        m = m.target if type(m) is LinkedRule else grammar[m.expr]
+    if type(m) is not StarMatcher and type(m) is not PlusMatcher:
+        raise ValueError("Rule {} isn't a repetition: {}".format(init, m))
+    return m
+
+
+def unfinished(m, input):
+    "The ParseError of a parse of repetition m that stopped at input, not at the end."
+    return ParseError(input.position(), expectations(m.expr) + ["end of input"])
+
+
+def parse_iter(grammar, init, input, engine="recursive"):
+    """
+    Match rule init of grammar, whose body must be a star or plus, like
+    parse(), but yield the result of each element of the repetition as
+    soon as it has matched instead of returning the list of them all.
+    The repetition must reach the end of input, and a plus must match
+    once; otherwise ParseError is raised after the elements that did
+    match. A StreamInput only keeps the text of the element being
+    matched.
+    """
+    m = repetition(grammar, init)
+    deferred = type(grammar) is Deferred
+    if type(input) in (TextInput, BytesInput, MmapInput, TokenInput):
+        if engine not in ("recursive", "stack"):
+            raise ValueError("Unknown engine {!r}".format(engine))
+        ctx = Context(grammar, input.text, getattr(input, "tokens", None))
+        pos = input.pos
+        count = 0
+        while True:
+            end, r = m.expr.match_at(ctx, pos) if engine == "recursive" else match_stack(m.expr, ctx, pos)
+            if end < 0:
+                break
+            assert end > pos
+            count += 1
+            yield force(r) if deferred else r
+            pos = end
+        if pos < len(ctx.text) or count == 0 and type(m) is PlusMatcher:
+            # The elements were matched without going through rule init.
+            if ctx.rules:
+                ctx.rules.append(init)
+            error = ctx.error(init, input.pos)
+            raise error if error.position >= pos else unfinished(m, input.next(pos))
+        return
+    elif engine != "recursive":
+        raise ValueError("The stack engine needs a TextInput, BytesInput, MmapInput or TokenInput, not {}".format(type(input).__name__))
+
+    count = 0
+    while True:
+        input.hold()
+        ok, next, r = input.match(m.expr, grammar)
+        input.release()
+        if not ok:
+            break
+        count += 1
+        # Nothing goes back before an element once it's been handed out.
+        next.commit()
+        yield force(r) if deferred else r
+        input = next
+    if not input.match_eof()[0] or count == 0 and type(m) is PlusMatcher:
+        raise unfinished(m, input)
 
 
 eof = EofMatcher()
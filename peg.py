@@ -2,8 +2,19 @@
 
 "Bootstrap grammar that can parse a text-based grammar language."
 
+import functools
+import hashlib
+import os
+import pickle
+import sys
+
+from binary import BytesRewriter
+from optimize import LiteralFusion
+from optimize import dispatch_choices
 from parseltongue import AndMatcher
+from parseltongue import CaptureMatcher
 from parseltongue import ChoiceMatcher
+from parseltongue import CutMatcher
 from parseltongue import ImplicitMatcher
 from parseltongue import NothingMatcher
 from parseltongue import NotMatcher
@@ -17,6 +28,7 @@ from parseltongue import StringMatcher
 from parseltongue import TextInput
 from parseltongue import TokenMatcher
 from parseltongue import Visitor
+from parseltongue import capture
 from parseltongue import choice
 from parseltongue import eof
 from parseltongue import ignoring
@@ -26,8 +38,9 @@ from parseltongue import not_looking_at
 from parseltongue import parse
 from parseltongue import plus
 from parseltongue import star
-from parseltongue import text
 from parseltongue import token
+from plan import load_plan
+from plan import plan_path
 
 
 def namechar(c):
@@ -64,14 +77,16 @@ g = {
     "TOKENS": tok("TOKENS: ").then(plus(not_looking_at("eol").then(choice("literal", "rule")).then(ignoring(star("ws"))))).then("eol").returning(lambda r: ("TOKENS", r[1])),
     "WHITESPACE": tok("WHITESPACE: ").then("expression").then("eol").returning(lambda r: ("WHITESPACE", r[1])),
     "production": star("ignored").then("name").then(tok(":=")).then("expression").then("eol").then(star("ignored")).returning(lambda r: (r[1], r[3])),
-    "name": plus(namechar).text(),
+    "name": capture(plus(namechar)),
     "expression": choice("choice", "sequence"),
     "choice": match("sequence").then(plus(ignoring(tok("|")).then("sequence"))).returning(make_choice),
-    "sequence": star(choice("star", "plus", "optional", "and", "not", "nothing", "implicit", "base_expression").then(star("ws")).returning(0)).returning(make_sequence),
+    "sequence": star(choice("star", "plus", "optional", "and", "not", "nothing", "capture", "cut", "implicit", "base_expression").then(star("ws")).returning(0)).returning(
+        make_sequence
+    ),
     "base_expression": choice("regex", "unicode", "rule", "parenthesized", "literal", "token"),
     "parenthesized": ignoring(tok("(")).then("expression").then(ignoring(tok(")"))),
-    "regex": ignoring(literal("/")).then(plus(not_looking_at(literal("/")).then(any_char)).text(RegexMatcher)).then(ignoring(literal("/"))),
-    "unicode": match(star("ws")).then(literal("u+").then(plus(hex)).returning(lambda r: StringMatcher(chr(int(text(r[1]), 16))))).then(star("ws")).returning(1),
+    "regex": ignoring(literal("/")).then(capture(plus(not_looking_at(literal("/")).then(any_char))).returning(RegexMatcher)).then(ignoring(literal("/"))),
+    "unicode": match(star("ws")).then(literal("u+").then(capture(plus(hex))).returning(lambda r: StringMatcher(chr(int(r[1], 16))))).then(star("ws")).returning(1),
     "rule": match("name").returning(RuleMatcher),
     "star": match("base_expression").then(tok("*")).returning(lambda r: StarMatcher(r[0])),
     "plus": match("base_expression").then(tok("+")).returning(lambda r: PlusMatcher(r[0])),
@@ -79,13 +94,15 @@ g = {
     "and": tok("&").then("base_expression").returning(lambda r: AndMatcher(r[1])),
     "not": tok("!").then("base_expression").returning(lambda r: NotMatcher(r[1])),
     "nothing": tok("~").then("base_expression").returning(lambda r: NothingMatcher(r[1])),
-    "literal": ignoring(literal("'")).then(star(not_looking_at(literal("'")).then(any_char)).text(StringMatcher)).then(ignoring(literal("'"))),
-    "token": ignoring(literal("`")).then(plus(not_looking_at(literal("`")).then(notspace)).text()).then(ignoring(literal("`"))),
+    "capture": tok("$").then(choice("star", "plus", "optional", "base_expression")).returning(lambda r: CaptureMatcher(r[1])),
+    "cut": tok("^").returning(lambda r: CutMatcher()),
+    "literal": ignoring(literal("'")).then(capture(star(not_looking_at(literal("'")).then(any_char))).returning(StringMatcher)).then(ignoring(literal("'"))),
+    "token": ignoring(literal("`")).then(capture(plus(not_looking_at(literal("`")).then(notspace))).returning(StringMatcher)).then(ignoring(literal("`"))),
     "ws": choice(literal(" "), literal("\t")),
     "eol": star("ws").then(literal("\n")),
     "comment": star("ws").then(literal("#")).then(star(not_looking_at("eol").then(any_char))).then("eol"),
     "ignored": choice("eol", "comment"),
-    "implicit": ignoring(literal("implicit(")).then(star(not_looking_at(literal(")")).then(any_char))).then(ignoring(literal(")"))).text(ImplicitMatcher),
+    "implicit": ignoring(literal("implicit(")).then(capture(star(not_looking_at(literal(")")).then(any_char)))).then(ignoring(literal(")"))).returning(ImplicitMatcher),
 }
 
 
@@ -102,8 +119,12 @@ class TokenRewriter(Visitor):
 
 
 class Grammar:
-    def __init__(self, rules):
+    "Rules by name, the tokens declared with TOKENS:, for lexer.Lexer, and the plan.Plan it was compiled with, if any."
+
+    def __init__(self, rules, tokens=None, plan=None):
         self.rules = rules
+        self.tokens = tokens
+        self.plan = plan
 
     def __getitem__(self, key):
         return self.rules[key]
@@ -122,32 +143,113 @@ class Grammar:
         parseltongue.parse(self.rules, expression, input)
 
 
-def grammar(file):
+def grammar(file, optimize=True, binary=False, cache=None, plan=None):
+    """
+    Load the grammar in file. cache is a directory (or True for
+    CACHE_DIR) keeping compiled grammars keyed by the file's contents,
+    the options and the parseltongue source, so that loading it again
+    skips parsing it. plan is a plan.Plan to compile in, the path of one
+    saved as JSON, or True for the one saved next to file.
+    """
     with open(file) as f:
-        input = TextInput(f.read())
-        ok, input, r = parse(g, "grammar", input)
-
-        if ok:
-            variables = dict(r["vars"])
+        source = f.read()
+    if plan is True:
+        plan = plan_path(file)
+    if isinstance(plan, str):
+        plan = load_plan(plan)
+
+    if cache:
+        path = cache_path(CACHE_DIR if cache is True else cache, source, optimize, binary, plan)
+        try:
+            with open(path, "rb") as f:
+                return pickle.load(f)
+        except Exception:
+            # Missing, or unreadable by this code: compile it (again).
+            pass
+
+    compiled = compile_grammar(source, file, optimize, binary, plan)
+    if cache:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = "{}.{}.tmp".format(path, os.getpid())
+        with open(temporary, "wb") as f:
+            pickle.dump(compiled, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, path)
+    return compiled
+
+
+def compile_grammar(source, file, optimize, binary, plan=None):
+    ok, input, r = parse(g, "grammar", TextInput(source))
+
+    if ok:
+        variables = dict(r["vars"])
+        rules = dict(r["rules"])
+        tokens = variables.get("TOKENS")
+
+        if "TOKENS" in variables and "WHITESPACE" in variables:
+            visitor = TokenRewriter(variables["TOKENS"], variables["WHITESPACE"])
+            rules = {name: rule.accept(visitor) for name, rule in r["rules"]}
+        else:
             rules = dict(r["rules"])
 
-            if "TOKENS" in variables and "WHITESPACE" in variables:
-                visitor = TokenRewriter(variables["TOKENS"], variables["WHITESPACE"])
-                rules = {name: rule.accept(visitor) for name, rule in r["rules"]}
-            else:
-                rules = dict(r["rules"])
-            return Grammar(rules)
-        else:
-            raise Exception("Can't parse {}".format(file))
+        if binary:
+            rewriter = BytesRewriter()
+            rules = {name: rule.accept(rewriter) for name, rule in rules.items()}
+            tokens = tokens and [t.accept(rewriter) for t in tokens]
 
+        if optimize:
+            fusion = LiteralFusion()
+            rules = {name: rule.accept(fusion) for name, rule in rules.items()}
+        # Plans are made from profiles of optimized grammars, so they go between fusing and dispatching.
+        if plan is not None:
+            rules = plan.apply(rules)
+        if optimize:
+            rules = dispatch_choices(rules)
 
-if __name__ == "__main__":
+        return Grammar(rules, tokens, plan)
+    else:
+        raise Exception("Can't parse {}".format(file))
+
+
+#
+# Compiled grammar cache
+#
 
-    import sys
+CACHE_DIR = os.environ.get("PARSELTONGUE_CACHE") or os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "parseltongue")
 
-    import parseltongue
+# Modules whose code decides what a compiled grammar looks like.
+COMPILER_MODULES = ["parseltongue", "peg", "optimize", "analysis", "binary", "plan"]
+
+
+@functools.lru_cache(maxsize=None)
+def compiler_version():
+    "Hash of the source of COMPILER_MODULES, standing in for a version number so that changing them invalidates the cache."
+    digest = hashlib.sha256()
+    for name in COMPILER_MODULES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name + ".py"), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def cache_path(directory, source, optimize, binary, plan=None):
+    digest = hashlib.sha256()
+    digest.update("{}\0{}\0{}\0{}\0{}\0".format(compiler_version(), sys.version_info[:2], optimize, binary, plan and plan.key()).encode())
+    digest.update(source.encode())
+    return os.path.join(directory, digest.hexdigest() + ".pickle")
+
+
+if __name__ == "__main__":
 
-    parseltongue.verbose = False
+    if len(sys.argv) > 1 and sys.argv[1] == "--precompile":
+        # Fill the cache at build time: peg.py --precompile [--binary] grammar.g...
+        # Loaded through the peg module so the cached Grammar isn't __main__.Grammar.
+        import peg
+
+        binary = "--binary" in sys.argv[2:]
+        for file in sys.argv[2:]:
+            if file != "--binary":
+                peg.grammar(file, binary=binary, cache=True)
+                print("{} -> {}".format(file, peg.CACHE_DIR))
+        sys.exit(0)
 
     r = grammar(sys.argv[1]) if len(sys.argv) > 1 else g
     for a, b in r.rules.items():
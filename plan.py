@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+"""
+Profile-guided optimization: what a Profiler saw while parsing
+representative inputs decides which rules to memoize, which rules
+optimize.link inlines, and in what order choices try alternatives that
+can't both match. The Plan is saved as JSON next to the grammar, where
+it can be read and edited, and peg.grammar(file, plan=True) compiles it
+in:
+
+    plan.py grammars/query.g Document examples/*.graphql
+"""
+
+import json
+import os
+
+from analysis import Analysis
+from lexer import token_matchers
+from optimize import reachable
+from optimize import size
+from parseltongue import Builder
+from parseltongue import ChoiceMatcher
+from parseltongue import MemoMatcher
+from parseltongue import TextInput
+from parseltongue import Visitor
+from parseltongue import parse
+from profiler import Profiler
+
+# A memo lookup costs about as much as trying this many matchers, so a
+# rule is memoized when the matchers its repeated calls try add up to
+# more than that for every call. Profiles count every alternative of a
+# choice tried, even ones the FIRST set index would skip, so this errs
+# high.
+MEMO_COST = 10
+
+# Rules getting at least this share of all rule calls are inlined if
+# they have at most HOT_INLINE_SIZE matchers and aren't recursive.
+HOT_SHARE = 0.05
+HOT_INLINE_SIZE = 12
+
+
+class Plan:
+    """
+    Rules to memoize, rules for optimize.link to inline, and orders
+    mapping rules whose body is a choice to the indices of its
+    alternatives in the order to try them. why notes what was seen of
+    each rule that the choices were made from.
+    """
+
+    def __init__(self, memoize=(), inline=(), orders=None, why=None):
+        self.memoize = sorted(memoize)
+        self.inline = sorted(inline)
+        self.orders = dict(orders or {})
+        self.why = dict(why or {})
+
+    def __eq__(self, other):
+        return type(self) == type(other) and self.key() == other.key()
+
+    def __str__(self):
+        lines = ["memoize {}  ({})".format(name, self.why.get(name, "")) for name in self.memoize]
+        lines += ["inline {}  ({})".format(name, self.why.get(name, "")) for name in self.inline]
+        lines += ["order {}: {}  ({})".format(name, ", ".join(map(str, order)), self.why.get(name, "")) for name, order in sorted(self.orders.items())]
+        return "\n".join(lines) or "nothing to change"
+
+    def key(self):
+        "What the plan does, without why, as text for the compiled grammar cache."
+        return json.dumps([self.memoize, self.inline, sorted(self.orders.items())])
+
+    def to_json(self):
+        return {"memoize": self.memoize, "inline": self.inline, "orders": self.orders, "why": self.why}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data.get("memoize", ()), data.get("inline", ()), data.get("orders"), data.get("why"))
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_json(), f, indent=2, sort_keys=True)
+            f.write("\n")
+
+    def apply(self, rules):
+        """
+        Rules with this plan's orders and memoization, before they are
+        indexed by FIRST set, which keeps the new orders. Orders that
+        could change what a choice matches are refused with ValueError.
+        """
+        facts = alternative_facts(rules)
+        rules = dict(rules)
+        for name, order in self.orders.items():
+            if name not in rules:
+                raise ValueError("Plan orders rule {}, which the grammar doesn't have".format(name))
+            c = body_choice(rules[name])
+            if c is None or sorted(order) != list(range(len(c.expr))):
+                raise ValueError("Plan order {} doesn't fit rule {}".format(order, name))
+            known = facts(c)
+            for i, a in enumerate(order):
+                for b in order[i + 1 :]:
+                    if b < a and overlap(known[a], known[b]):
+                        raise ValueError("Alternatives {} and {} of rule {} might both match, so their order matters".format(b, a, name))
+            rules[name] = replace_choice(rules[name], ChoiceMatcher([c.expr[i] for i in order]))
+        for name in self.memoize:
+            if name not in rules:
+                raise ValueError("Plan memoizes rule {}, which the grammar doesn't have".format(name))
+            rules[name] = MemoMatcher(rules[name])
+        return rules
+
+
+def plan_path(file):
+    "Where the plan for the grammar in file is kept."
+    return os.path.splitext(file)[0] + ".plan.json"
+
+
+def load_plan(path):
+    with open(path) as f:
+        return Plan.from_json(json.load(f))
+
+
+def body_choice(m):
+    "The choice that is the body of a rule, under any Builders and memoization, or None."
+    while isinstance(m, (Builder, MemoMatcher)):
+        m = m.preceeding if isinstance(m, Builder) else m.expr
+    return m if isinstance(m, ChoiceMatcher) else None
+
+
+def replace_choice(m, choice):
+    if isinstance(m, Builder):
+        return Builder(replace_choice(m.preceeding, choice), m.fn)
+    elif isinstance(m, MemoMatcher):
+        return MemoMatcher(replace_choice(m.expr, choice))
+    return choice
+
+
+class Unspaced(Visitor):
+    "Tokens as just their matchers, for FIRST sets of what follows their whitespace."
+
+    def visit_token_matcher(self, m):
+        return m.matcher
+
+
+def alternative_facts(rules):
+    """
+    A function giving the FIRST set of each alternative of a choice in
+    rules, or None for alternatives that might match wherever another
+    one does. First sets are of what follows the whitespace tokens skip:
+    every token skips the same whitespace, as far as it goes, so
+    alternatives that start with tokens look at the same character after
+    it. Alternatives that could start with whitespace themselves are
+    left alone.
+    """
+    rules = getattr(rules, "rules", rules)
+    found = []
+    for m in rules.values():
+        token_matchers(m, found)
+    analysis = Analysis(rules)
+    spaces = frozenset()
+    for t in found:
+        first = analysis.first(t.ignore)
+        spaces = None if spaces is None or first is None else spaces | first
+
+    unspaced = Unspaced()
+    stripped = Analysis({name: m.accept(unspaced) for name, m in rules.items()})
+
+    def facts(choice):
+        known = []
+        for a in choice.expr:
+            nullable, first = stripped.compute(a.accept(unspaced))
+            known.append(None if nullable or first is None or spaces is None or first & spaces else first)
+        return known
+
+    return facts
+
+
+def overlap(a, b):
+    "Whether alternatives with FIRST sets a and b (None for unknown) might both match at the same position."
+    return a is None or b is None or bool(a & b)
+
+
+def ordered(known, hits):
+    """
+    Indices of alternatives with the given FIRST sets, most hits first,
+    except that alternatives which might both match keep their order.
+    """
+    order = []
+    left = list(range(len(known)))
+    while left:
+        ready = [i for i in left if not any(j < i and overlap(known[i], known[j]) for j in left)]
+        best = max(ready, key=lambda i: (hits[i], -i))
+        order.append(best)
+        left.remove(best)
+    return order
+
+
+def choose(grammar, profilers):
+    """
+    The Plan for grammar from Profilers that each saw it parse one
+    input. Rules whose calls often start where an earlier call of theirs
+    did, and that try enough matchers each time, are memoized: the
+    position-based engines then match them once per position. Rules that
+    get many of the calls and are small enough are inlined by
+    optimize.link. Choices try alternatives in order of how often they
+    matched, as far as analysis shows they can't both match, which
+    matters where choices aren't indexed by FIRST set: without
+    optimizing, and in parses of Inputs.
+    """
+    rules = getattr(grammar, "rules", grammar)
+    reach = reachable(rules)
+    # Calls, distinct positions and matchers tried of each rule, over all inputs.
+    seen = {}
+    for profiler in profilers:
+        for name, s in profiler.rules.items():
+            calls, positions, tried = seen.get(name, (0, 0, 0))
+            seen[name] = (calls + s.calls, positions + len(s.positions), tried + s.tried)
+    everything = sum(calls for calls, _, _ in seen.values())
+
+    memoize, inline, orders, why = [], [], {}, {}
+    for name, (calls, positions, tried) in seen.items():
+        if name not in rules or not calls:
+            continue
+        why[name] = "{} calls at {} positions, {:.1f} matchers tried per call".format(calls, positions, tried / calls)
+        if (calls - positions) * tried / calls > MEMO_COST * calls:
+            memoize.append(name)
+        elif calls >= HOT_SHARE * everything and name not in reach[name] and size(rules[name]) <= HOT_INLINE_SIZE:
+            inline.append(name)
+
+    facts = alternative_facts(rules)
+    for name, m in rules.items():
+        c = body_choice(m)
+        if c is None:
+            continue
+        hits = [sum(p.matchers[id(a)].successes for p in profilers if id(a) in p.matchers) for a in c.expr]
+        order = ordered(facts(c), hits)
+        if order != sorted(order):
+            orders[name] = order
+            matched = "alternatives matched {} times".format(", ".join(str(hits[i]) for i in order))
+            why[name] = "{}; {}".format(why[name], matched) if name in why else matched
+    return Plan(memoize, inline, orders, why)
+
+
+def record(grammar, init, texts):
+    "A Profiler for each of texts, having seen rule init of grammar parse it."
+    profilers = []
+    for text in texts:
+        profilers.append(Profiler())
+        parse(grammar, init, TextInput(text), tracer=profilers[-1])
+    return profilers
+
+
+def plan(grammar, init, texts):
+    "The Plan for grammar from parsing each of texts with rule init."
+    return choose(grammar, record(grammar, init, texts))
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    from peg import grammar
+
+    parser = argparse.ArgumentParser(description="Choose and save the plan for a grammar from parses of representative inputs.")
+    parser.add_argument("grammar", help="grammar file, whose plan is written next to it")
+    parser.add_argument("rule", help="rule to parse the inputs with")
+    parser.add_argument("inputs", nargs="+", help="representative input files")
+    parser.add_argument("--output", help="write the plan here instead")
+    args = parser.parse_args()
+
+    texts = []
+    for file in args.inputs:
+        with open(file) as f:
+            texts.append(f.read())
+    chosen = plan(grammar(args.grammar), args.rule, texts)
+    chosen.save(args.output or plan_path(args.grammar))
+    print(chosen)
@@ -0,0 +1,125 @@
+"Per-rule and per-matcher profiling of parses, built on the tracer interface."
+
+from parseltongue import RuleMatcher
+from parseltongue import parse
+
+
+class Stats:
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.successes = 0
+        self.failures = 0
+        self.total_ns = 0
+        self.self_ns = 0
+        self.consumed = 0
+        # Matchers tried by its outermost calls, counting themselves: a measure of work that, unlike time, doesn't vary between runs.
+        self.tried = 0
+        self.positions = set()
+        self.active = 0
+
+    def reparse_ratio(self):
+        "Attempts per distinct starting position; 1.0 means no position was tried twice."
+        return self.calls / len(self.positions) if self.positions else 0.0
+
+
+class Profiler:
+    """
+    Tracer that aggregates events into Stats per rule name and per
+    matcher. A matcher's self time excludes the matchers it calls; a
+    rule's self time excludes the other rules it calls. Times include
+    the tracing overhead, so compare them with each other rather than
+    with untraced parses.
+    """
+
+    def __init__(self):
+        self.rules = {}
+        self.matchers = {}
+        self.stack = []
+        self.rule_stack = []
+        self.entered = 0
+
+    def __call__(self, event):
+        m = event.matcher
+        is_rule = isinstance(m, RuleMatcher)
+        if event.kind == "enter":
+            self.entered += 1
+            self.stack.append(self.enter(self.matchers, id(m), m, event))
+            if is_rule:
+                self.rule_stack.append(self.enter(self.rules, m.expr, m.expr, event))
+        else:
+            self.exit(self.stack, event)
+            if is_rule:
+                self.exit(self.rule_stack, event)
+
+    def exit(self, stack, event):
+        stats, started, children, entered = stack.pop()
+        elapsed = event.time - started
+        stats.active -= 1
+        if stats.active == 0:
+            stats.total_ns += elapsed
+            stats.tried += self.entered - entered
+        stats.self_ns += elapsed - children[0]
+        if event.kind == "exit":
+            stats.successes += 1
+            stats.consumed += event.end - event.start
+        else:
+            stats.failures += 1
+        if stack:
+            stack[-1][2][0] += elapsed
+
+    def enter(self, table, key, name, event):
+        if key not in table:
+            table[key] = Stats(name)
+        stats = table[key]
+        stats.calls += 1
+        stats.active += 1
+        stats.positions.add(event.start)
+        return stats, event.time, [0], self.entered - 1
+
+    def report(self, kind="rules", sort="self", limit=None, width=60):
+        "Table of the rules (or matchers) sorted by self or total time, calls, or reparse ratio."
+        table = self.rules if kind == "rules" else self.matchers
+        keys = {
+            "self": lambda s: s.self_ns,
+            "total": lambda s: s.total_ns,
+            "calls": lambda s: s.calls,
+            "reparse": lambda s: s.reparse_ratio(),
+        }
+        rows = sorted(table.values(), key=keys[sort], reverse=True)[:limit]
+        header = "{:<{w}} {:>9} {:>9} {:>9} {:>10} {:>10} {:>9} {:>8} {:>9}".format(
+            "name", "calls", "ok", "fail", "self ms", "total ms", "positions", "reparse", "consumed", w=width
+        )
+        lines = [header, "-" * len(header)]
+        for s in rows:
+            name = str(s.name)
+            name = name if len(name) <= width else name[: width - 3] + "..."
+            lines.append(
+                "{:<{w}} {:>9} {:>9} {:>9} {:>10.3f} {:>10.3f} {:>9} {:>8.2f} {:>9}".format(
+                    name, s.calls, s.successes, s.failures, s.self_ns / 1e6, s.total_ns / 1e6, len(s.positions), s.reparse_ratio(), s.consumed, w=width
+                )
+            )
+        return "\n".join(lines)
+
+
+def profile(grammar, init, input):
+    "Parse like parseltongue.parse, returning the usual (ok, next, result) and the Profiler."
+    profiler = Profiler()
+    return parse(grammar, init, input, tracer=profiler), profiler
+
+
+if __name__ == "__main__":
+
+    import sys
+
+    from parseltongue import TextInput
+    from peg import grammar
+
+    if len(sys.argv) < 4:
+        print("usage: {} grammar.g rule file".format(sys.argv[0]), file=sys.stderr)
+        sys.exit(1)
+
+    with open(sys.argv[3]) as f:
+        (ok, _, _), profiler = profile(grammar(sys.argv[1]), sys.argv[2], TextInput(f.read()))
+    print("Parse {}".format("succeeded" if ok else "failed"))
+    print(profiler.report())
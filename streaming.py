@@ -0,0 +1,88 @@
+"""
+Parse what an asyncio stream delivers, yielding the elements of a
+top-level repetition as they arrive, like parseltongue.parse_iter does
+with a StreamInput.
+"""
+
+import codecs
+from collections import deque
+
+from parseltongue import Deferred
+from parseltongue import PlusMatcher
+from parseltongue import StreamBuffer
+from parseltongue import StreamInput
+from parseltongue import force
+from parseltongue import repetition
+from parseltongue import unfinished
+
+
+class Starved(Exception):
+    "The parse needs text that hasn't been received yet."
+
+
+class Feed:
+    "File-like object giving a StreamBuffer the text received so far, and raising Starved when there is none."
+
+    def __init__(self):
+        self.chunks = deque()
+        self.eof = False
+
+    def read(self, size):
+        if self.chunks:
+            return self.chunks.popleft()
+        if self.eof:
+            return ""
+        raise Starved()
+
+
+async def parse_aiter(grammar, init, reader, encoding="utf-8", chunk_size=65536, lookahead=None):
+    """
+    Match rule init of grammar, whose body must be a star or plus,
+    against what an asyncio.StreamReader reads, yielding the result of
+    each element of the repetition as parse_iter does. Bytes read are
+    decoded with encoding, or kept as bytes for binary grammars if it is
+    None. An element that needs text that hasn't arrived yet is matched
+    again from its start once as much again has been read, so the
+    results are those of parsing the whole stream at once.
+    """
+    m = repetition(grammar, init)
+    deferred = type(grammar) is Deferred
+    decoder = codecs.getincrementaldecoder(encoding)() if encoding is not None else None
+    feed = Feed()
+    buffer = StreamBuffer(feed, chunk_size)
+    if decoder is None:
+        buffer.text = b""
+    input = StreamInput(None, 0, buffer, lookahead)
+    count = 0
+    while True:
+        try:
+            # The element's text has to stay buffered in case it's matched again.
+            buffer.acquire(input.pos)
+            ok, next, r = input.match(m.expr, grammar)
+            done = ok or input.match_eof()[0]
+        except Starved:
+            # What the abandoned attempt held doesn't matter any more.
+            buffer.live.clear()
+            # Reading at least as much again as the element has buffered
+            # before matching it again keeps the attempts, together, within
+            # a constant factor of matching it once.
+            wanted = max(chunk_size, buffer.end() - input.pos)
+            while wanted > 0:
+                data = await reader.read(chunk_size)
+                chunk = decoder.decode(data, final=not data) if decoder is not None else data
+                if chunk:
+                    feed.chunks.append(chunk)
+                    wanted -= len(chunk)
+                if not data:
+                    feed.eof = True
+                    break
+            continue
+        buffer.release(input.pos)
+        if not ok:
+            break
+        count += 1
+        next.commit()
+        yield force(r) if deferred else r
+        input = next
+    if not done or count == 0 and type(m) is PlusMatcher:
+        raise unfinished(m, input)
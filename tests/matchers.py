@@ -1,8 +1,112 @@
 #!/usr/bin/env python3
 
+import asyncio
+import glob
+import io
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import codegen
+import cst
+import vm
+from batch import parse_many
+from binary import BytesRewriter
+from incremental import IncrementalParser
+from lexer import Lexer
+from optimize import LiteralFusion
+from optimize import dispatch_choices
+from optimize import link
+from parseltongue import BytesInput
+from parseltongue import Context
+from parseltongue import LRUMemo
+from parseltongue import Memo
+from parseltongue import MemoMatcher
+from parseltongue import MmapInput
+from parseltongue import PackratInput
+from parseltongue import ParseError
 from parseltongue import RegexMatcher
+from parseltongue import RuleMatcher
+from parseltongue import StreamBuffer
+from parseltongue import StreamInput
 from parseltongue import TextInput
+from parseltongue import WindowMemo
+from parseltongue import capture
+from parseltongue import choice
+from parseltongue import cut
+from parseltongue import defer
+from parseltongue import ignoring
+from parseltongue import literal
+from parseltongue import match
+from parseltongue import match_stack
+from parseltongue import optional
 from parseltongue import parse
+from parseltongue import parse_iter
+from parseltongue import plus
+from parseltongue import regex
+from parseltongue import star
+from parseltongue import token
+from peg import compile_grammar
+from peg import grammar
+from plan import Plan
+from plan import load_plan
+from plan import plan
+from plan import plan_path
+from profiler import profile
+from streaming import parse_aiter
+from tracing import RingBuffer
+from tracing import collapsed_stacks
+from tracing import json_lines
+
+arithmetic = {
+    "expression": match("term").then(optional(token(literal("+"), str.isspace).then("expression"))),
+    "term": match("factor").then(optional(token(literal("*"), str.isspace).then("term"))),
+    "factor": choice(token(literal("("), str.isspace).then("expression").then(token(literal(")"), str.isspace)), "number"),
+    "number": regex("[0-9]+"),
+}
+
+literals = {
+    "keyword": choice(literal("query"), literal("mutation"), regex("[a-z]+")),
+    "punctuation": choice(literal("("), literal(")"), literal("...")),
+    "prefix": choice(literal("a"), literal("ab")).then(literal("c")),
+    "greedy": regex("a*").then(literal("a")),
+    "escape": ignoring(literal("\\u")).then(regex("[0-9a-f]{4}")).then(literal("!")),
+}
+
+committed = {
+    "items": match("item").then(optional("items")),
+    "item": choice(literal("(").then(cut()).then(regex("[a-z]*")).then(literal(")")), regex("[a-z]+")),
+}
+
+captured = {
+    "words": match("word").then(star(ignoring(literal(",")).then("word"))),
+    "word": capture(plus(choice(regex("[a-z]"), literal("-")).then(optional("digits")))),
+    "digits": regex("[0-9]+").returning(len),
+}
+
+
+class Built:
+    "Builder function counting its calls."
+
+    calls = 0
+
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, r):
+        Built.calls += 1
+        return (self.name, r)
+
+
+built = {name: rule.returning(Built(name)) for name, rule in arithmetic.items()}
+
+backtracking = {
+    "values": plus("value"),
+    "value": choice(literal("true"), regex("[a-z]+"), regex("[0-9]+"), literal(",")),
+    "pairs": plus(choice(match("pair").then(literal(";")), match("pair").then(literal(".")))),
+    "pair": match("values").then(literal("=")).then("values"),
+}
 
 
 def test_matcher(matcher, should_match, should_not_match):
@@ -15,6 +119,417 @@ def test_matcher(matcher, should_match, should_not_match):
         print("{} should not parse ... {}".format(x, "ok" if not ok else "FAIL"))
 
 
+unicode = {
+    "words": match("word").then(star(ignoring(literal(",")).then("word"))),
+    "word": regex("[^\\s,]+").text(),
+    "string": ignoring(literal('"')).then(star(choice(literal("\\u00e9"), regex('[^"\\\\]'))).text()).then(ignoring(literal('"'))),
+    "any": regex("(?s).{3}").text(),
+}
+
+
+def outcome(ok, next, r):
+    "What parses by different means agree on: only some of them return a ParseError when they fail."
+    return ok, next.position(), r if ok else None
+
+
+def test_same(name, grammar, rule, texts, make_input, parser=parse):
+    for x in texts:
+        expected = parse(grammar, rule, TextInput(x))
+        same = outcome(*parser(grammar, rule, make_input(x))) == outcome(*expected)
+        print("{} parses {} ... {}".format(name, x, "ok" if same else "FAIL"))
+
+
+def test_binary(grammar, rule, texts):
+    rewriter = BytesRewriter()
+    binary = {name: m.accept(rewriter) for name, m in grammar.items()}
+    for x in texts:
+        ok, next, r = parse(grammar, rule, TextInput(x))
+        expected = (ok, len(x[: next.position()].encode()), r if ok else None)
+        print("binary parses {} ... {}".format(x, "ok" if outcome(*parse(binary, rule, BytesInput(x.encode()))) == expected else "FAIL"))
+
+
+def raised(parser, grammar, rule, input):
+    "The args of the ParseError parsing input raises, or None."
+    try:
+        parser(grammar, rule, input)
+        return None
+    except ParseError as e:
+        return e.args
+
+
+def test_cut(name, grammar, rule, texts, make_input, parser=parse):
+    """
+    texts are pairs of text and the position of the ParseError it should
+    raise, or None. Every engine should raise the same error, except that
+    inputs without the text, like StreamInput, can't give its line and
+    column.
+    """
+    for text, position in texts:
+        error = raised(parser, grammar, rule, make_input(text))
+        expected = raised(parse, grammar, rule, TextInput(text))
+        if error is not None and error[3] is None:
+            expected = expected[:3] + (None, None)
+        same = error is None if position is None else error == expected and error[0] == position
+        print("{} cuts {} ... {}".format(name, repr(text), "ok" if same else "FAIL {}".format(error)))
+
+
+def test_error(name, grammar, rule, text, make_input, error, parser=parse):
+    "error is the position, line, column, expected alternatives and innermost rule of the ParseError a parse of text should give."
+    ok, _, r = parser(grammar, rule, make_input(text))
+    same = not ok and (r.position, r.line, r.column, r.expected, r.rules[-1]) == error and r.args == (r.position, r.expected, r.rules, r.line, r.column)
+    print("{} reports {} ... {}".format(name, repr(text), "ok" if same else "FAIL {}".format(r)))
+
+
+def test_iter(name, grammar, rule, texts, make_input, iterate=parse_iter):
+    "Iterating over the elements of a parse matches parsing all at once, including raising ParseError where the whole parse fails or stops early."
+    for x in texts:
+        ok, next, r = parse(grammar, rule, TextInput(x))
+        expected = r if ok and next.position() == len(x) else ParseError
+        try:
+            elements = list(iterate(grammar, rule, make_input(x)))
+        except ParseError:
+            elements = ParseError
+        print("{} iterates {} ... {}".format(name, repr(x), "ok" if elements == expected else "FAIL {}".format(elements)))
+
+
+def test_threads(name, grammar, rule, texts, make_input, threads=4, rounds=20):
+    "Parses of texts sharing grammar from several threads, each with its own tracer, give the same results and traces as one at a time."
+
+    def traced(x):
+        tracer = RingBuffer(size=None)
+        return outcome(*parse(grammar, rule, make_input(x), tracer=tracer)), [(e.kind, e.rule, e.start, e.end) for e in tracer]
+
+    def untraced(x):
+        return outcome(*parse(grammar, rule, make_input(x)))
+
+    for f in [traced, untraced]:
+        expected = [f(x) for x in texts] * rounds
+        with ThreadPoolExecutor(threads) as pool:
+            same = list(pool.map(f, texts * rounds)) == expected
+        print("{} parses {} from {} threads ... {}".format(name, f.__name__, threads, "ok" if same else "FAIL"))
+
+
+def read_async(grammar, rule, text, chunk_size=3):
+    async def elements():
+        reader = asyncio.StreamReader()
+        for i in range(0, len(text), 5):
+            reader.feed_data(text[i : i + 5])
+        reader.feed_eof()
+        return [r async for r in parse_aiter(grammar, rule, reader, chunk_size=chunk_size, lookahead=chunk_size)]
+
+    return asyncio.run(elements())
+
+
+def test_tree(grammar, rule, texts):
+    parser = cst.Parser(grammar)
+    for x in texts:
+        ok, next, root = parser.parse(rule, TextInput(x))
+        expected = parse(grammar, rule, TextInput(x))
+        same = (ok, next.position()) == (expected[0], expected[1].position())
+        if ok:
+            nodes = [root]
+            for node in nodes:
+                nodes.extend(node.children)
+            same = same and len(nodes) == len(root.tree) and root.text == x[: next.position()] and root.result(grammar) == expected[2]
+        print("tree of {} ... {}".format(x, "ok" if same else "FAIL"))
+
+
+def test_incremental(grammar, rule, text, edits):
+    parser = IncrementalParser(grammar, rule, text)
+    parser.parse()
+    for offset, deleted, inserted in edits:
+        result = parser.edit(offset, deleted, inserted)
+        same = outcome(*result) == outcome(*parse(grammar, rule, TextInput(parser.text)))
+        print("incremental parses {} ... {}".format(parser.text, "ok" if same else "FAIL"))
+
+
 if __name__ == "__main__":
 
     test_matcher(RegexMatcher("[ab]+"), ["a", "b", "ab", "aaabbb"], ["", "ca", "def", "cab"])
+
+    sums = ["1", "1 + 2", "(1 + 2) * 3 * (4 + (5 * 6))", "1 + ", "(1 + 2"]
+    test_same("packrat", arithmetic, "expression", sums, PackratInput)
+    test_same("packrat (lru)", arithmetic, "expression", sums, lambda x: PackratInput(x, memo=LRUMemo(4)))
+    test_same("packrat (window)", arithmetic, "expression", sums, lambda x: PackratInput(x, memo=WindowMemo(2)))
+
+    fused = {name: rule.accept(LiteralFusion()) for name, rule in literals.items()}
+    for rule, texts in [
+        ("keyword", ["query", "mutations", "x"]),
+        ("punctuation", ["...", ")", "."]),
+        ("prefix", ["abc", "ac"]),
+        ("greedy", ["aaa"]),
+        ("escape", ["\\u00ff!", "\\u00f"]),
+    ]:
+        test_same("fused", literals, rule, texts, TextInput, lambda g, rule, input: parse(fused, rule, input))
+
+    test_same("traced", arithmetic, "expression", sums, TextInput, lambda g, rule, input: parse(g, rule, input, tracer=RingBuffer()))
+    test_same("traced (packrat)", arithmetic, "expression", sums, PackratInput, lambda g, rule, input: parse(g, rule, input, tracer=RingBuffer()))
+    traced = lambda x: StreamInput(None, buffer=StreamBuffer(io.StringIO(x), chunk_size=2), lookahead=3)
+    test_same("traced (stream)", arithmetic, "expression", sums, traced, lambda g, rule, input: parse(g, rule, input, tracer=RingBuffer()))
+    memos = [Memo(), Memo()]
+    parse(arithmetic, "expression", PackratInput("1 + (2 * 3", memo=memos[0]))
+    parse(arithmetic, "expression", PackratInput("1 + (2 * 3", memo=memos[1]), tracer=RingBuffer())
+    print("traced packrat keeps its memo ... {}".format("ok" if len(memos[1]) and memos[1].table == memos[0].table else "FAIL {}".format(memos[1])))
+    retried = {"top": choice(match("word").then(literal("!")), match("word")), "word": literal("ab")}
+    (ok, _, _), profiler = profile(retried, "top", TextInput("ab"))
+    top, word = profiler.rules["top"], profiler.rules["word"]
+    counted = (top.calls, top.successes, top.consumed, word.calls, word.successes, word.consumed, word.positions, word.reparse_ratio())
+    print("profiler counts rules ... {}".format("ok" if ok and counted == (1, 1, 2, 2, 2, 4, {0}, 2.0) else "FAIL {}".format(counted)))
+    tried = sum(s.calls for s in profiler.matchers.values())
+    print("profiler counts matchers tried ... {}".format("ok" if top.tried == tried and word.tried == 4 else "FAIL {} {}".format(top.tried, word.tried)))
+    failed = sum(s.failures for s in profiler.matchers.values())
+    print("profiler counts failures ... {}".format("ok" if failed == 2 else "FAIL {}".format(failed)))
+    print("profiler times nest ... {}".format("ok" if top.self_ns <= top.total_ns and word.total_ns <= top.total_ns else "FAIL"))
+    report = profiler.report(sort="calls").splitlines()
+    print("profiler reports rules ... {}".format("ok" if len(report) == 4 and report[2].split()[:4] == ["word", "2", "2", "0"] else "FAIL {}".format(report)))
+    report = profiler.report(kind="matchers", sort="calls", limit=2, width=6).splitlines()
+    print("profiler reports matchers ... {}".format("ok" if len(report) == 4 and all(line[:6].endswith("...") for line in report[2:]) else "FAIL {}".format(report)))
+    events = RingBuffer()
+    parse(retried, "top", TextInput("ab"), tracer=events)
+    lines = io.StringIO()
+    json_lines(events, lines)
+    records = [json.loads(line) for line in lines.getvalue().splitlines()]
+    fields = [(r["event"], r["rule"], r["matcher"], r["start"], r["end"]) for r in records]
+    same = len(records) == len(events) == 16 and fields[0] == ("enter", "top", "RuleMatcher(top)", 0, None) and fields[-1] == ("exit", "top", "RuleMatcher(top)", 0, 2)
+    print("json lines ... {}".format("ok" if same and ("fail", "top", "StringMatcher(!)", 2, None) in fields else "FAIL {}".format(fields)))
+    # One microsecond per event: word takes 3 each time it's matched, and top the other 9 of its 15.
+    stacks = collapsed_stacks([e._replace(time=i * 1000) for i, e in enumerate(events)])
+    print("collapsed stacks ... {}".format("ok" if stacks == ["top;word 6", "top 9"] else "FAIL {}".format(stacks)))
+    (ok, _, _), profiler = profile(retried, "top", TextInput("x"))
+    counted = (profiler.rules["top"].failures, profiler.rules["word"].failures)
+    print("profiler counts failed rules ... {}".format("ok" if not ok and counted == (1, 2) else "FAIL {}".format(counted)))
+    try:
+        parse(arithmetic, "expression", TextInput("1"), tracer=RingBuffer(), engine="stack")
+        print("traced stack refused ... FAIL")
+    except ValueError as e:
+        print("traced stack refused ... {}".format("ok" if "trace" in str(e) else "FAIL {}".format(e)))
+
+    dispatched = dispatch_choices(arithmetic)
+    test_same("dispatched", arithmetic, "expression", sums, TextInput, lambda g, rule, input: parse(dispatched, rule, input))
+
+    stack = lambda g, rule, input: parse(g, rule, input, engine="stack")
+    test_same("stack", arithmetic, "expression", sums, TextInput, stack)
+    test_same("stack (dispatched)", dispatched, "expression", sums, TextInput, stack)
+    deep = "(" * 10000 + "1" + ")" * 10000
+    ok, next, _ = parse(arithmetic, "expression", TextInput(deep), engine="stack")
+    print("stack parses 10000 nested parentheses ... {}".format("ok" if ok and next.position() == len(deep) else "FAIL"))
+
+    generated = codegen.load(arithmetic)
+    test_same("generated", arithmetic, "expression", sums, TextInput, lambda g, rule, input: generated.parse(rule, input))
+
+    program = vm.Program(arithmetic)
+    test_same("vm", arithmetic, "expression", sums, TextInput, lambda g, rule, input: program.parse(rule, input))
+    program = vm.Program(dispatched)
+    test_same("vm (dispatched)", arithmetic, "expression", sums, TextInput, lambda g, rule, input: program.parse(rule, input))
+
+    for x, (ok, end, r) in zip(sums, parse_many(arithmetic, "expression", sums, workers=2, chunk_size=2)):
+        expected = parse(arithmetic, "expression", TextInput(x))
+        print("batch parses {} ... {}".format(x, "ok" if (ok, end, r if ok else None) == outcome(*expected) else "FAIL"))
+
+    for file in sorted(glob.glob("grammars/*.g") + glob.glob("tests/*.g")):
+        for optimize in [True, False]:
+            try:
+                grammar(file, optimize=optimize)
+                error = None
+            except Exception as e:
+                error = e
+            print("{} loads {} ... {}".format("optimized" if optimize else "unoptimized", file, "ok" if error is None else "FAIL {!r}".format(error)))
+    ok, _, r = parse(grammar("tests/peg.g"), "r", TextInput("!"))
+    print("backtick token matches its text ... {}".format("ok" if ok and r == "!" else "FAIL {}".format(r)))
+
+    with tempfile.TemporaryDirectory() as cache:
+        cold = grammar("grammars/math.g", cache=cache)
+        warm = grammar("grammars/math.g", cache=cache)
+        same = len(os.listdir(cache)) == 1 and warm.rules == cold.rules == grammar("grammars/math.g").rules
+        print("cache reloads grammars/math.g ... {}".format("ok" if same else "FAIL"))
+
+    math = grammar("grammars/math.g")
+    lexed = Lexer(math)
+    test_same("tokens", math, "expression", sums + ["12 *3", " 1"], lexed.input)
+    test_same("tokens (stack)", math, "expression", sums, lexed.input, stack)
+    query = grammar("grammars/query.g")
+    documents = ["{ a(x: true, y: 1.5, z: -0, e: FOO, n: null) @d(if: false) }", "query Q($v: Int) { ...F ... on T { b } } fragment F on T { c }", "{ a(x: 1.) }"]
+    test_same("tokens (query)", query, "Document", documents, Lexer(query).input)
+    test_same("traced (tokens)", query, "Document", documents, Lexer(query).input, lambda g, rule, input: parse(g, rule, input, tracer=RingBuffer()))
+
+    definitions = ["\n".join(documents), "{ a }", "{ a } {", "", "{ a } x"]
+    test_threads("query", query, "Document", definitions, TextInput)
+    test_threads("lexed query", query, "Document", definitions, Lexer(query).input)
+    test_iter("plain", query, "Document", definitions, TextInput)
+    test_iter("stack", query, "Document", definitions, TextInput, lambda g, rule, input: parse_iter(g, rule, input, engine="stack"))
+    test_iter("tokens", query, "Document", definitions, Lexer(query).input)
+    test_iter("packrat", query, "Document", definitions, PackratInput)
+    test_iter("stream", query, "Document", definitions, lambda x: StreamInput(None, buffer=StreamBuffer(io.StringIO(x), chunk_size=4), lookahead=4))
+    test_iter("async", query, "Document", definitions + ["{ é }"], lambda x: x.encode(), read_async)
+
+    small = lambda x: StreamInput(None, buffer=StreamBuffer(io.StringIO(x), chunk_size=2), lookahead=3)
+    test_same("stream", arithmetic, "expression", sums, small)
+
+    test_error("plain", arithmetic, "expression", "(1 + 2", TextInput, (6, 1, 7, ["'*'", "'+'", "')'"], "term"))
+    test_error("stack", arithmetic, "expression", "(1 + 2", TextInput, (6, 1, 7, ["'*'", "'+'", "')'"], "term"), stack)
+    binary = {name: m.accept(BytesRewriter()) for name, m in literals.items()}
+    test_error("binary", binary, "escape", b"\\u00e9\n", BytesInput, (6, 1, 7, ["b'!'"], "escape"))
+    test_error("binary (memoryview)", binary, "escape", b"\\u00e9\n", lambda x: BytesInput(memoryview(x)), (6, 1, 7, ["b'!'"], "escape"))
+    with tempfile.TemporaryFile() as f:
+        f.write(b"\\u00e9\n")
+        f.flush()
+        test_error("binary (mmap)", binary, "escape", b"\\u00e9\n", lambda x: MmapInput(f), (6, 1, 7, ["b'!'"], "escape"))
+    values = ["Variable", "FloatValue", "IntValue", "StringValue", "BooleanValue", "NullValue", "EnumValue", "ListValue", "ObjectValue"]
+    test_error("plain", query, "Document", "{ hero {\n  name(x: ) }\n}", TextInput, (19, 2, 11, values, "Value"))
+    test_error("tokens", query, "Document", "{ hero {\n  name(x: ) }\n}", Lexer(query).input, (19, 2, 11, values, "Value"))
+    standalone = {}
+    exec(codegen.generate(query), standalone)
+    generated = lambda g, rule, input: standalone["parse"](rule, input)
+    test_error("standalone", query, "Document", "{ hero {\n  name(x: ) }\n}", TextInput, (19, 2, 11, values, "Value"), generated)
+    test_same("standalone", query, "Document", documents + definitions[1:], TextInput, generated)
+    test_error("linked", arithmetic, "expression", "(1 + 2", TextInput, (6, 1, 7, ["'*'", "'+'", "')'"], "term"), lambda g, rule, input: parse(link(g), rule, input))
+    program = vm.Program(arithmetic)
+    test_error("vm", arithmetic, "expression", "(1 + 2", TextInput, (6, 1, 7, ["'*'", "'+'", "')'"], "term"), lambda g, rule, input: program.parse(rule, input))
+    generated = codegen.load(arithmetic)
+    test_error("generated", arithmetic, "expression", "(1 + 2", TextInput, (6, 1, 7, ["'*'", "'+'", "')'"], "term"), lambda g, rule, input: generated.parse(rule, input))
+
+    cuts = [("(a)(b)x", None), ("x(a)", None), ("(a", 2), ("(a)(", 4), ("(b)(1)", 4)]
+    test_cut("plain", committed, "items", cuts, TextInput)
+    test_cut("packrat", committed, "items", cuts, PackratInput)
+    test_cut("stream", committed, "items", cuts, small)
+    test_cut("stack", committed, "items", cuts, TextInput, stack)
+    program = vm.Program(committed)
+    test_cut("vm", committed, "items", cuts, TextInput, lambda g, rule, input: program.parse(rule, input))
+    generated = codegen.load(committed)
+    test_cut("generated", committed, "items", cuts, TextInput, lambda g, rule, input: generated.parse(rule, input))
+    memoized = dict(committed, item=MemoMatcher(committed["item"]))
+    for name, run in [("plain", RuleMatcher("items").match_at), ("stack", lambda ctx, pos: match_stack(RuleMatcher("items"), ctx, pos))]:
+        ctx = Context(memoized, "(a)(b)(c)")
+        run(ctx, 0)
+        print("{} cuts drop memo entries ... {}".format(name, "ok" if ctx.memo and min(pos for _, pos in ctx.memo) == 6 else "FAIL {}".format(ctx.memo)))
+    settings = grammar("grammars/settings.g")
+    lines = [('a=1\nb="x"\n', None), ("a=1\nb=x\n", 6), ("a=1\nB=2\n", None)]
+    test_cut("settings", settings, "settings", lines, TextInput)
+    test_cut("settings (packrat)", settings, "settings", lines, PackratInput)
+    test_cut("settings (stream)", settings, "settings", lines, small)
+    enclosed = {"outer": choice(match("item").then(literal("X")), match("item").then(literal("Y"))), "item": committed["item"]}
+    for name, make_input in [("plain", TextInput), ("packrat", PackratInput), ("stream", small)]:
+        test_cut("{} (enclosed)".format(name), enclosed, "outer", [("(ab)Y", None), ("(ab)X", None), ("(ab", 3)], make_input)
+    test_cut("stack (enclosed)", enclosed, "outer", [("(ab)Y", None), ("(ab)X", None), ("(ab", 3)], TextInput, stack)
+    settled = ['a=1\nname="hello world"\nlong_name_here="' + "x" * 200 + '"\n', "a=1\nB=2\n"]
+    for size in [4, 64]:
+        test_iter("async (chunks of {})".format(size), settings, "settings", settled, lambda x: x.encode(), lambda g, rule, text: read_async(g, rule, text, chunk_size=size))
+    test_iter("stream", settings, "settings", settled, lambda x: StreamInput(None, buffer=StreamBuffer(io.StringIO(x), chunk_size=4), lookahead=4))
+    chunked = lambda x: StreamInput(None, buffer=StreamBuffer(io.StringIO(x), chunk_size=4), lookahead=4)
+    for x in ['name="hello world"\n', 'a=12345678\nbb="x y z w"\n']:
+        same = outcome(*parse(settings, "settings", chunked(x))) == outcome(*parse(settings, "settings", TextInput(x)))
+        print("fused (stream) parses {} ... {}".format(repr(x), "ok" if same else "FAIL"))
+
+    deferred = defer(built)
+    test_same("deferred", built, "expression", sums, TextInput, lambda g, rule, input: parse(deferred, rule, input))
+    test_same("deferred (packrat)", built, "expression", sums, PackratInput, lambda g, rule, input: parse(deferred, rule, input))
+    test_same("deferred (stack)", built, "expression", sums, TextInput, lambda g, rule, input: parse(deferred, rule, input, engine="stack"))
+    program = vm.Program(deferred)
+    test_same("deferred (vm)", built, "expression", sums, TextInput, lambda g, rule, input: program.parse(rule, input))
+    generated = codegen.load(deferred)
+    test_same("deferred (generated)", built, "expression", sums, TextInput, lambda g, rule, input: generated.parse(rule, input))
+    calls = []
+    for g in [built, deferred]:
+        Built.calls = 0
+        parse(g, "expression", TextInput("1 + (2 * 3"))
+        calls.append(Built.calls)
+    print("deferred skips abandoned builders ... {}".format("ok" if calls == [11, 4] else "FAIL {}".format(calls)))
+    linked = link(built, "expression")
+    test_same("linked", built, "expression", sums, TextInput, lambda g, rule, input: parse(linked, rule, input))
+    test_same("linked (packrat)", built, "expression", sums, PackratInput, lambda g, rule, input: parse(linked, rule, input))
+    test_same("linked (stack)", built, "expression", sums, TextInput, lambda g, rule, input: parse(linked, rule, input, engine="stack"))
+    test_same("linked (deferred)", built, "expression", sums, TextInput, lambda g, rule, input: parse(link(deferred), rule, input))
+    generated = codegen.load(linked)
+    test_same("linked (generated)", built, "expression", sums, TextInput, lambda g, rule, input: generated.parse(rule, input))
+    test_cut("linked", committed, "items", cuts, TextInput, lambda g, rule, input: parse(link(g), rule, input))
+    print(
+        "link inlines number ... {}".format(
+            "ok" if list(linked) == ["expression", "term", "factor", "number"] and str(linked["factor"].preceeding.expr[1]) == "Builder(RegexMatcher([0-9]+))" else "FAIL"
+        )
+    )
+
+    test_tree(built, "expression", sums)
+    ok, _, root = cst.Parser(arithmetic).parse("expression", TextInput("1 + (2 * 3"))
+    shape = [(root.tree.node(i).rule, root.tree.node(i).text) for i in range(len(root.tree))]
+    print("tree drops abandoned nodes ... {}".format("ok" if shape == [("expression", "1"), ("term", "1"), ("factor", "1"), ("number", "1")] else "FAIL {}".format(shape)))
+
+    words = ["ab1,c-22", "x", "-9,", ",a"]
+    ok, _, r = parse(captured, "words", TextInput("ab1,c-22"))
+    print("capture slices ab1,c-22 ... {}".format("ok" if r == ["ab1", ["c-22"]] else "FAIL {}".format(r)))
+    test_same("capture (packrat)", captured, "words", words, PackratInput)
+    test_same("capture (stream)", captured, "words", words, small)
+    test_same("capture (stack)", captured, "words", words, TextInput, stack)
+    program = vm.Program(captured)
+    test_same("capture (vm)", captured, "words", words, TextInput, lambda g, rule, input: program.parse(rule, input))
+    generated = codegen.load(captured)
+    test_same("capture (generated)", captured, "words", words, TextInput, lambda g, rule, input: generated.parse(rule, input))
+    syntax = compile_grammar("words := word (~',' word)*\nword := $((/[a-z]/ | '-') digits?)+\ndigits := /[0-9]+/\n", "<capture>", True, False)
+    test_same("capture (syntax)", captured, "words", words, TextInput, lambda g, rule, input: parse(syntax, rule, input))
+    binary = {name: m.accept(BytesRewriter()) for name, m in captured.items()}
+    program = vm.Program(binary)
+    generated = codegen.load(binary)
+    for name, parser in [
+        ("plain", parse),
+        ("traced", lambda g, rule, input: parse(g, rule, input, tracer=RingBuffer())),
+        ("stack", stack),
+        ("vm", lambda g, rule, input: program.parse(rule, input)),
+        ("generated", lambda g, rule, input: generated.parse(rule, input)),
+    ]:
+        ok, _, r = parser(binary, "words", BytesInput(memoryview(b"ab1,c-22")))
+        print("capture ({}) slices memoryview ... {}".format(name, "ok" if r == [b"ab1", [b"c-22"]] and type(r[0]) is bytes else "FAIL {}".format(r)))
+    nested = {"nest": capture(choice(literal("(").then("nest").then(literal(")")), literal("x")))}
+    deep = "(" * 5000 + "x" + ")" * 5000
+    ok, _, r = parse(nested, "nest", TextInput(deep), engine="stack")
+    print("capture (stack) nests 5000 deep ... {}".format("ok" if ok and r == deep else "FAIL"))
+
+    test_binary(unicode, "words", ["abc,déf,€uro", "😀", ","])
+    test_binary(unicode, "string", ['"héllo"', '"\\u00e9"', '"unterminated'])
+    test_binary(unicode, "any", ["é😀x", "a\tb", "ab"])
+    floats = {name: m.accept(BytesRewriter()) for name, m in grammar("grammars/query.g", optimize=False).rules.items()}
+    r = parse(floats, "FloatValue", BytesInput(b"1e3"))[2]
+    print("binary encodes implicit values ... {}".format("ok" if r == [[None, b"1", []], b"0", [b"+", [b"3"]]] else "FAIL {}".format(r)))
+
+    chosen = plan(backtracking, "values", ["1,2,3,x"])
+    same = chosen.orders == {"value": [2, 3, 0, 1]} and chosen == Plan.from_json(chosen.to_json())
+    print("plan orders disjoint alternatives by hits ... {}".format("ok" if same else "FAIL {}".format(chosen.orders)))
+    try:
+        Plan(orders={"value": [1, 0, 2, 3]}).apply(backtracking)
+        print("plan refuses reordering overlapping alternatives ... FAIL")
+    except ValueError:
+        print("plan refuses reordering overlapping alternatives ... ok")
+    pairs = ["a,b,c,d=1,2,3,4;", "a,b=true,false.", "x=1;y,z=2,3."]
+    chosen = plan(backtracking, "pairs", pairs)
+    print("plan memoizes pair ... {}".format("ok" if "pair" in chosen.memoize else "FAIL {}".format(chosen)))
+    memoized = chosen.apply(backtracking)
+    test_same("planned", backtracking, "pairs", pairs + ["a=1", "a=1;b"], TextInput, lambda g, rule, input: parse(memoized, rule, input))
+    test_same("planned (stack)", backtracking, "pairs", pairs + ["a=1", "a=1;b"], TextInput, lambda g, rule, input: parse(memoized, rule, input, engine="stack"))
+    program = vm.Program(memoized)
+    test_same("planned (vm)", backtracking, "pairs", pairs, TextInput, lambda g, rule, input: program.parse(rule, input))
+    test_same("planned (vm)", backtracking, "pairs", ["a=1", "a=1;b"], TextInput, lambda g, rule, input: program.parse(rule, input))
+    ctx = Context(memoized, pairs[0])
+    program.match_at("pairs", ctx, 0)
+    print("planned (vm) memoizes ... {}".format("ok" if ctx.memo else "FAIL"))
+    generated = codegen.load(memoized)
+    test_same("planned (generated)", backtracking, "pairs", pairs + ["a=1", "a=1;b"], TextInput, lambda g, rule, input: generated.parse(rule, input))
+    ctx = Context(memoized, pairs[0])
+    generated.rules["pairs"](ctx, 0)
+    print("planned (generated) memoizes ... {}".format("ok" if ctx.memo else "FAIL"))
+
+    planned = grammar("grammars/query.g", plan=plan(query, "Document", documents))
+    test_same("planned (query)", query, "Document", documents + definitions[1:], TextInput, lambda g, rule, input: parse(planned, rule, input))
+    test_same("planned (packrat)", query, "Document", documents, PackratInput, lambda g, rule, input: parse(planned, rule, input))
+    test_same("planned (tokens)", query, "Document", documents, TextInput, lambda g, rule, input: parse(planned, rule, Lexer(planned).input(input.text)))
+    test_same("planned (linked)", query, "Document", documents, TextInput, lambda g, rule, input: parse(link(planned), rule, input))
+    with tempfile.TemporaryDirectory() as directory:
+        file = os.path.join(directory, "math.g")
+        with open("grammars/math.g") as f, open(file, "w") as copy:
+            copy.write(f.read())
+        math = grammar(file)
+        plan(math, "expression", sums).save(plan_path(file))
+        cold = grammar(file, plan=True, cache=directory)
+        warm = grammar(file, plan=True, cache=directory)
+        same = warm.plan == cold.plan == load_plan(plan_path(file)) and warm.rules == cold.rules
+        print("grammar loads the plan saved next to it ... {}".format("ok" if same else "FAIL"))
+
+    edits = [(1, 0, "7"), (27, 1, ""), (27, 0, ")"), (4, 1, "*"), (28, 0, "0"), (0, 28, "1 + 2"), (5, 0, "3")]
+    test_incremental(arithmetic, "expression", "(1 + 2) * 3 * (4 + (5 * 6))", edits)
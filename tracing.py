@@ -0,0 +1,53 @@
+"Tracers and trace exporters for parseltongue.parse(..., tracer=...)."
+
+import json
+from collections import deque
+
+from parseltongue import RuleMatcher
+
+
+class RingBuffer:
+    "Tracer keeping only the last size events."
+
+    def __init__(self, size=10000):
+        self.events = deque(maxlen=size)
+
+    def __call__(self, event):
+        self.events.append(event)
+
+    def __iter__(self):
+        return iter(self.events)
+
+    def __len__(self):
+        return len(self.events)
+
+
+def json_lines(events, file):
+    "Write events to file as one JSON object per line. Results are left out since they needn't be serializable."
+    for e in events:
+        record = {"event": e.kind, "rule": e.rule, "matcher": str(e.matcher), "start": e.start, "end": e.end, "time": e.time}
+        file.write(json.dumps(record))
+        file.write("\n")
+
+
+def collapsed_stacks(events):
+    """
+    Fold events into the collapsed stack format used by flamegraph.pl
+    and speedscope: one "Rule;Rule;Rule microseconds" line per rule
+    stack, weighted by the time spent in the innermost rule itself.
+    """
+    totals = {}
+    stack = []
+    for e in events:
+        if not isinstance(e.matcher, RuleMatcher):
+            continue
+        if e.kind == "enter":
+            stack.append([e.matcher.expr, e.time, 0])
+        elif stack:
+            name, started, children = stack.pop()
+            elapsed = e.time - started
+            key = ";".join([s[0] for s in stack] + [name])
+            totals[key] = totals.get(key, 0) + elapsed - children
+            if stack:
+                stack[-1][2] += elapsed
+    return ["{} {}".format(key, ns // 1000) for key, ns in totals.items()]
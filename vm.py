@@ -0,0 +1,551 @@
+#!/usr/bin/env python3
+
+"""
+Compile a grammar into a flat instruction array run by a virtual machine,
+in the style of LPeg. Backtracking is a stack of choice points, rule calls
+push return addresses on the same stack, and results are recorded as a
+list of captures that is only turned into values, applying Builder
+functions, once the whole match has succeeded.
+"""
+
+import sys
+
+from parseltongue import FAIL
+from parseltongue import AndMatcher
+from parseltongue import Builder
+from parseltongue import CaptureMatcher
+from parseltongue import CharMatcher
+from parseltongue import ChoiceMatcher
+from parseltongue import Context
+from parseltongue import CutMatcher
+from parseltongue import Defer
+from parseltongue import DispatchChoiceMatcher
+from parseltongue import EofMatcher
+from parseltongue import ImplicitMatcher
+from parseltongue import MemoMatcher
+from parseltongue import Nothing
+from parseltongue import NothingMatcher
+from parseltongue import NotMatcher
+from parseltongue import OptionalMatcher
+from parseltongue import PlusMatcher
+from parseltongue import RegexMatcher
+from parseltongue import RegexSequenceMatcher
+from parseltongue import RuleMatcher
+from parseltongue import SequenceMatcher
+from parseltongue import StarMatcher
+from parseltongue import StringMatcher
+from parseltongue import TokenMatcher
+from parseltongue import cut_error
+from parseltongue import diagnose
+from parseltongue import expectations
+
+# Opcodes. Instructions are (opcode, argument) pairs; jump targets are
+# indices into the code.
+(
+    END,
+    CHAR,
+    STRING,
+    SET,
+    PREDICATE,
+    REGEX,
+    REGEX_SEQUENCE,
+    EOF,
+    PUSH,
+    OPEN,
+    CLOSE,
+    CHOICE,
+    COMMIT,
+    PARTIAL_COMMIT,
+    PARTIAL_DROP,
+    BACK_COMMIT,
+    DROP_COMMIT,
+    FAIL_TWICE,
+    FAIL_OP,
+    JUMP,
+    DISPATCH,
+    CALL,
+    RETURN,
+    ERROR,
+    MISSING,
+    MATCH,
+    MARK,
+    SPAN,
+) = range(28)
+
+NAMES = [
+    "end",
+    "char",
+    "string",
+    "set",
+    "predicate",
+    "regex",
+    "regex_sequence",
+    "eof",
+    "push",
+    "open",
+    "close",
+    "choice",
+    "commit",
+    "partial_commit",
+    "partial_drop",
+    "back_commit",
+    "drop_commit",
+    "fail_twice",
+    "fail",
+    "jump",
+    "dispatch",
+    "call",
+    "return",
+    "error",
+    "missing",
+    "match",
+    "mark",
+    "span",
+]
+
+# Capture marking where the values of a Close start.
+Open = object()
+
+
+class Close:
+    "Capture that replaces the values since the matching Open with one value."
+
+    def __init__(self, kind, fn=None):
+        self.kind = kind
+        self.fn = fn
+
+    def __repr__(self):
+        return self.kind if self.fn is None else "{} {}".format(self.kind, getattr(self.fn, "__name__", self.fn))
+
+    def value(self, values):
+        if self.kind == "sequence":
+            values = [v for v in values if v != Nothing]
+            return values if len(values) > 1 else values[0]
+        elif self.kind == "list":
+            return values
+        elif self.kind == "build":
+            return self.fn(values[0])
+        else:
+            return Nothing
+
+
+SEQUENCE = Close("sequence")
+LIST = Close("list")
+DROP = Close("drop")
+
+
+def build(captures):
+    "The value of a successful match from its captures."
+    stack = [[]]
+    for c in captures:
+        if c is Open:
+            stack.append([])
+        elif type(c) is Close:
+            values = stack.pop()
+            stack[-1].append(c.value(values))
+        else:
+            stack[-1].append(c)
+    return stack[0][0]
+
+
+class Program:
+    "A grammar compiled to instructions. Rules are entered by name with match_at or parse."
+
+    def __init__(self, grammar):
+        self.grammar = grammar
+        self.code = [[END, None]]
+        self.rules = {}
+        calls = []
+        for name, rule in getattr(grammar, "rules", grammar).items():
+            self.rules[name] = len(self.code)
+            self.compile(rule, calls)
+            self.emit(RETURN)
+        for at, name in calls:
+            if name in self.rules:
+                self.code[at][1] = self.rules[name]
+            else:
+                self.code[at] = [MISSING, name]
+        self.code = [tuple(i) for i in self.code]
+        self.names = {pc: name for name, pc in self.rules.items()}
+
+    def emit(self, op, arg=None):
+        self.code.append([op, arg])
+        return len(self.code) - 1
+
+    def here(self):
+        return len(self.code)
+
+    def compile(self, m, calls, value=True):
+        """
+        Append the instructions for m. When they succeed they leave
+        exactly one capture value (possibly Nothing), or none at all if
+        value is false because the caller throws the value away.
+        """
+        if not value:
+            self.discard(m, calls)
+        elif type(m) is StringMatcher:
+            if len(m.expr) == 1:
+                self.emit(CHAR, (m.expr[0], m.expr))
+            else:
+                self.emit(STRING, m.expr)
+        elif type(m) is CharMatcher:
+            self.emit(PREDICATE, m.expr)
+        elif type(m) is RegexSequenceMatcher:
+            self.emit(REGEX_SEQUENCE, m)
+        elif type(m) is RegexMatcher:
+            self.emit(REGEX, m.re)
+        elif isinstance(m, RuleMatcher):
+            calls.append((self.emit(CALL), m.expr))
+        elif type(m) is TokenMatcher:
+            # The value of the token is the value of its matcher.
+            self.compile(StarMatcher(m.ignore), calls, False)
+            self.compile(m.matcher, calls)
+            self.compile(StarMatcher(m.ignore), calls, False)
+        elif type(m) is Builder:
+            self.emit(OPEN)
+            self.compile(m.preceeding, calls)
+            # Captures are already only built once the match has succeeded.
+            self.emit(CLOSE, Close("build", m.fn.fn if type(m.fn) is Defer else m.fn))
+        elif type(m) is SequenceMatcher:
+            self.sequence(m, calls)
+        elif type(m) is ChoiceMatcher:
+            if all(type(c) is StringMatcher and len(c.expr) == 1 for c in m.expr):
+                chars = {}
+                for c in m.expr:
+                    chars.setdefault(c.expr[0], c.expr)
+                self.emit(SET, chars)
+            else:
+                self.choice(m.expr, calls)
+        elif type(m) is DispatchChoiceMatcher:
+            self.dispatch(m, calls)
+        elif type(m) is StarMatcher or type(m) is PlusMatcher:
+            self.emit(OPEN)
+            if type(m) is PlusMatcher:
+                self.compile(m.expr, calls)
+            loop = self.emit(CHOICE)
+            self.compile(m.expr, calls)
+            self.emit(PARTIAL_COMMIT, loop + 1)
+            self.code[loop][1] = self.emit(CLOSE, LIST)
+        elif type(m) is OptionalMatcher:
+            choice = self.emit(CHOICE)
+            self.compile(m.expr, calls)
+            commit = self.emit(COMMIT)
+            self.code[choice][1] = self.emit(PUSH, None)
+            self.code[commit][1] = self.here()
+        elif type(m) in (AndMatcher, NotMatcher, NothingMatcher, CutMatcher):
+            self.discard(m, calls)
+            self.emit(PUSH, Nothing)
+        elif type(m) is CaptureMatcher:
+            # The start position is a capture of its own until the span
+            # replaces it; the text in between leaves no captures.
+            self.emit(MARK)
+            self.discard(m.expr, calls)
+            self.emit(SPAN)
+        elif type(m) is MemoMatcher:
+            # The machine has no memo table of its own, so the interpreter matches and memoizes it in ctx.memo.
+            self.emit(MATCH, m)
+        elif type(m) is ImplicitMatcher:
+            self.emit(PUSH, m.value)
+        elif type(m) is EofMatcher:
+            self.emit(EOF)
+        else:
+            self.emit(MATCH, m)
+
+    def discard(self, m, calls):
+        "Append instructions matching m that leave no captures."
+        if type(m) is AndMatcher:
+            choice = self.emit(CHOICE)
+            self.compile(m.expr, calls)
+            commit = self.emit(BACK_COMMIT)
+            self.code[choice][1] = self.emit(FAIL_OP)
+            self.code[commit][1] = self.here()
+        elif type(m) is NotMatcher:
+            choice = self.emit(CHOICE)
+            self.compile(m.expr, calls)
+            self.emit(FAIL_TWICE)
+            self.code[choice][1] = self.here()
+        elif type(m) is NothingMatcher or type(m) is Builder or type(m) is CaptureMatcher:
+            # Builder functions are only applied to values that are kept.
+            self.discard(m.preceeding if type(m) is Builder else m.expr, calls)
+        elif type(m) is TokenMatcher:
+            self.discard(StarMatcher(m.ignore), calls)
+            self.discard(m.matcher, calls)
+            self.discard(StarMatcher(m.ignore), calls)
+        elif type(m) is CutMatcher:
+            pass
+        elif type(m) is StarMatcher or type(m) is PlusMatcher:
+            if type(m) is PlusMatcher:
+                self.discard(m.expr, calls)
+            loop = self.emit(CHOICE)
+            self.compile(m.expr, calls)
+            self.emit(PARTIAL_DROP, loop + 1)
+            self.code[loop][1] = self.here()
+        elif type(m) is OptionalMatcher:
+            choice = self.emit(CHOICE)
+            self.compile(m.expr, calls)
+            self.emit(DROP_COMMIT, self.here() + 1)
+            self.code[choice][1] = self.here()
+        else:
+            choice = self.emit(CHOICE)
+            self.compile(m, calls)
+            commit = self.emit(DROP_COMMIT)
+            self.code[choice][1] = self.emit(FAIL_OP)
+            self.code[commit][1] = self.here()
+
+    def sequence(self, m, calls):
+        kept = [type(e) not in (AndMatcher, NotMatcher, NothingMatcher, CutMatcher) for e in m.expr]
+        # The value of a sequence with one element kept is that element's value.
+        single = kept.count(True) == 1
+        if not single:
+            self.emit(OPEN)
+        for i, e in enumerate(m.expr):
+            if m.cut is not None and i > m.cut:
+                # Failing after the cut is an error rather than a backtrack.
+                choice = self.emit(CHOICE)
+                self.compile(e, calls, kept[i])
+                commit = self.emit(COMMIT)
+                self.code[choice][1] = self.emit(ERROR, expectations(e))
+                self.code[commit][1] = self.here()
+            else:
+                self.compile(e, calls, kept[i])
+        if not single:
+            self.emit(CLOSE, SEQUENCE)
+
+    def choice(self, alternatives, calls):
+        commits = []
+        for c in alternatives[:-1]:
+            choice = self.emit(CHOICE)
+            self.compile(c, calls)
+            commits.append(self.emit(COMMIT))
+            self.code[choice][1] = self.here()
+        if alternatives:
+            self.compile(alternatives[-1], calls)
+        else:
+            self.emit(FAIL_OP)
+        for at in commits:
+            self.code[at][1] = self.here()
+
+    def dispatch(self, m, calls):
+        """
+        Each alternative is compiled once and ends by committing to the
+        end of the choice; the chains for each character try their
+        alternatives with a choice point and a jump.
+        """
+        switch = self.emit(DISPATCH)
+        bodies = []
+        commits = []
+        for c in m.expr:
+            bodies.append(self.here())
+            self.compile(c, calls)
+            commits.append(self.emit(COMMIT))
+
+        chains = {}
+        for indices in [tuple(m.default)] + [tuple(indices) for indices in m.table.values()]:
+            if indices in chains:
+                continue
+            chains[indices] = self.here()
+            for i in indices:
+                choice = self.emit(CHOICE)
+                self.emit(JUMP, bodies[i])
+                self.code[choice][1] = self.here()
+            self.emit(FAIL_OP)
+
+        end = self.here()
+        for at in commits:
+            self.code[at][1] = end
+        table = {c: chains[tuple(indices)] for c, indices in m.table.items()}
+        self.code[switch][1] = (table, chains[tuple(m.default)])
+
+    def match_at(self, init, ctx, pos):
+        "Match rule init at pos, returning (end, result) or FAIL like Matcher.match_at."
+        code = self.code
+        text = ctx.text
+        n = len(text)
+        pc = self.rules[init]
+        stack = [0]
+        captures = []
+        while True:
+            op, arg = code[pc]
+            if op == CHAR:
+                if pos < n and text[pos] == arg[0]:
+                    captures.append(arg[1])
+                    pos += 1
+                    pc += 1
+                    continue
+            elif op == STRING:
+                end = pos + len(arg)
+                if text[pos:end] == arg:
+                    captures.append(arg)
+                    pos = end
+                    pc += 1
+                    continue
+            elif op == CALL:
+                stack.append(pc + 1)
+                pc = arg
+                continue
+            elif op == RETURN:
+                pc = stack.pop()
+                continue
+            elif op == CHOICE:
+                stack.append((arg, pos, len(captures)))
+                pc += 1
+                continue
+            elif op == COMMIT:
+                stack.pop()
+                pc = arg
+                continue
+            elif op == REGEX:
+                if (found := arg.match(text, pos)) is not None:
+                    captures.append(found.group(0))
+                    pos = found.end()
+                    pc += 1
+                    continue
+            elif op == OPEN:
+                captures.append(Open)
+                pc += 1
+                continue
+            elif op == CLOSE or op == PUSH:
+                captures.append(arg)
+                pc += 1
+                continue
+            elif op == PARTIAL_COMMIT:
+                assert pos > stack[-1][1]
+                stack[-1] = (stack[-1][0], pos, len(captures))
+                pc = arg
+                continue
+            elif op == DISPATCH:
+                pc = arg[0].get(text[pos], arg[1]) if pos < n else arg[1]
+                continue
+            elif op == JUMP:
+                pc = arg
+                continue
+            elif op == SET:
+                if pos < n and (c := arg.get(text[pos])) is not None:
+                    captures.append(c)
+                    pos += 1
+                    pc += 1
+                    continue
+            elif op == PREDICATE:
+                if pos < n and arg(text[pos]):
+                    captures.append(text[pos])
+                    pos += 1
+                    pc += 1
+                    continue
+            elif op == REGEX_SEQUENCE:
+                if (found := arg.re.match(text, pos)) is not None:
+                    captures.append(arg._result(found))
+                    pos = found.end()
+                    pc += 1
+                    continue
+            elif op == PARTIAL_DROP:
+                assert pos > stack[-1][1]
+                del captures[stack[-1][2] :]
+                stack[-1] = (stack[-1][0], pos, stack[-1][2])
+                pc = arg
+                continue
+            elif op == DROP_COMMIT:
+                del captures[stack.pop()[2] :]
+                pc = arg
+                continue
+            elif op == BACK_COMMIT:
+                _, pos, count = stack.pop()
+                del captures[count:]
+                pc = arg
+                continue
+            elif op == FAIL_TWICE:
+                stack.pop()
+            elif op == EOF:
+                if pos >= n:
+                    captures.append(None)
+                    pc += 1
+                    continue
+            elif op == MATCH:
+                end, r = arg.match_at(ctx, pos)
+                if end >= 0:
+                    captures.append(r)
+                    pos = end
+                    pc += 1
+                    continue
+            elif op == MARK:
+                captures.append(pos)
+                pc += 1
+                continue
+            elif op == SPAN:
+                r = text[captures.pop() : pos]
+                captures.append(bytes(r) if type(r) is memoryview else r)
+                pc += 1
+                continue
+            elif op == END:
+                return pos, build(captures)
+            elif op == ERROR:
+                # The return addresses on the stack follow the calls of the rules being matched.
+                rules = [init] + [self.names[code[at - 1][1]] for at in stack[1:] if type(at) is int]
+                raise cut_error(text, pos, arg, rules)
+            elif op == MISSING:
+                raise KeyError(arg)
+
+            # The instruction failed: return to the latest choice point,
+            # dropping rule calls made since.
+            while stack:
+                entry = stack.pop()
+                if type(entry) is tuple:
+                    pc, pos, count = entry
+                    del captures[count:]
+                    break
+            else:
+                return FAIL
+
+    def parse(self, init, input):
+        "Parse TextInput or BytesInput like parseltongue.parse."
+        end, r = self.match_at(init, Context(self.grammar, input.text), input.pos)
+        return input.ok(input.next(end), r) if end >= 0 else (False, input, diagnose(self.grammar, init, input))
+
+    def disassemble(self):
+        "The instructions as text, one per line, with the rules they start."
+        starts = {}
+        for name, pc in self.rules.items():
+            starts.setdefault(pc, []).append(name)
+        lines = []
+        for pc, (op, arg) in enumerate(self.code):
+            for name in starts.get(pc, []):
+                lines.append("{}:".format(name))
+            lines.append("{:6}  {:<15}{}".format(pc, NAMES[op], operand(op, arg, self.code)))
+        return "\n".join(lines)
+
+
+def operand(op, arg, code):
+    if op in (CHOICE, COMMIT, PARTIAL_COMMIT, PARTIAL_DROP, BACK_COMMIT, DROP_COMMIT, JUMP, CALL):
+        return "-> {}".format(arg)
+    elif op == CHAR:
+        return repr(arg[1])
+    elif op == SET:
+        return "[{}]".format("".join(str(s)[1:-1] if type(s) is bytes else s for s in sorted(arg.values())))
+    elif op == REGEX:
+        return repr(arg.pattern)
+    elif op == REGEX_SEQUENCE:
+        return "{!r} {}".format(arg.expr, arg.values)
+    elif op == DISPATCH:
+        targets = {}
+        for c, pc in arg[0].items():
+            targets.setdefault(pc, []).append(c)
+        cases = ["{} -> {}".format(repr("".join(sorted(chr(c) if type(c) is int else c for c in chars))), pc) for pc, chars in sorted(targets.items())]
+        return "{}, else -> {}".format(", ".join(cases), arg[1])
+    elif op == PREDICATE:
+        return getattr(arg, "__name__", repr(arg))
+    elif op == PUSH:
+        return "Nothing" if arg is Nothing else repr(arg)
+    elif arg is None:
+        return ""
+    else:
+        return repr(arg) if op != MATCH else str(arg)
+
+
+if __name__ == "__main__":
+
+    from peg import grammar
+
+    if len(sys.argv) < 2:
+        print("usage: {} grammar.g".format(sys.argv[0]), file=sys.stderr)
+        sys.exit(1)
+
+    print(Program(grammar(sys.argv[1])).disassemble())